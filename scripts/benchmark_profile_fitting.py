@@ -0,0 +1,115 @@
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import argparse
+import numpy as np
+import os
+import time
+
+import smh
+from smh import Session, specutils
+from smh.linelists import LineList
+from smh.spectral_models import ProfileFittingModel
+
+test_data = os.path.join(os.path.dirname(smh.__file__), "tests", "test_data")
+
+def fit(models, analytic_jacobian):
+    """
+    Fit all models, and return the number of evaluations of the objective
+    function, the total number of model evaluations, the number of jacobian
+    evaluations, the number of failed fits, the time taken, and the equivalent
+    widths.
+    """
+
+    counts = {"objective": 0, "model": 0, "jacobian": 0}
+    fitting_function, __call__, jacobian = (
+        ProfileFittingModel.fitting_function, ProfileFittingModel.__call__,
+        ProfileFittingModel.fitting_jacobian)
+
+    def counted_fitting_function(self, *args):
+        counts["objective"] += 1
+        return fitting_function(self, *args)
+
+    def counted_call(self, *args):
+        counts["model"] += 1
+        return __call__(self, *args)
+
+    def counted_jacobian(self, *args):
+        counts["jacobian"] += 1
+        return jacobian(self, *args)
+
+    ProfileFittingModel.fitting_function = counted_fitting_function
+    ProfileFittingModel.__call__ = counted_call
+    # curve_fit estimates the derivatives numerically if jac is None.
+    ProfileFittingModel.fitting_jacobian \
+        = counted_jacobian if analytic_jacobian else None
+    failures = 0
+    try:
+        np.random.seed(0)
+        start = time.time()
+        for model in models:
+            try:
+                model.fit()
+            except (ValueError, RuntimeError, TypeError):
+                model.metadata.pop("fitted_result", None)
+                failures += 1
+        t = time.time() - start
+
+    finally:
+        ProfileFittingModel.fitting_function = fitting_function
+        ProfileFittingModel.__call__ = __call__
+        ProfileFittingModel.fitting_jacobian = jacobian
+
+    equivalent_widths = np.array([
+        model.metadata["fitted_result"][2]["equivalent_width"][0] \
+        if "fitted_result" in model.metadata else np.nan for model in models])
+    return (counts["objective"], counts["model"], counts["jacobian"], failures,
+        t, equivalent_widths)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare profile fitting with analytic and numerical "
+                    "derivatives on the bundled HD 122563 spectrum")
+    parser.add_argument("--profile", default="gaussian",
+        choices=("gaussian", "lorentzian", "voigt"))
+    parser.add_argument("-N", "--num-lines", type=int, default=100)
+    args = parser.parse_args()
+
+    spectrum_path = os.path.join(test_data, "spectra", "hd122563.fits")
+    session = Session([spectrum_path])
+    session.normalized_spectrum = specutils.Spectrum1D.read(spectrum_path)
+
+    # Atomic lines within the spectrum.
+    dispersion = session.normalized_spectrum.dispersion
+    line_list = LineList.read(
+        os.path.join(test_data, "linelists", "complete.list"))
+    line_list = line_list[(line_list["species"] < 100) \
+        * (line_list["wavelength"] > dispersion.min() + 5) \
+        * (line_list["wavelength"] < dispersion.max() - 5)]
+    session.metadata["line_list"] = line_list
+    session.index_spectral_models()
+
+    models = [ProfileFittingModel(session, [h]) \
+        for h in line_list["hash"][:args.num_lines]]
+    for model in models:
+        model.metadata["profile"] = args.profile
+
+    print("Fitting {} {} profiles".format(len(models), args.profile))
+    results = {}
+    for analytic_jacobian in (False, True):
+        N_objective, N_model, N_jacobian, N_failed, t, ew \
+            = results[analytic_jacobian] = fit(models, analytic_jacobian)
+        print("{} derivatives: {} objective function evaluations ({} model "
+              "evaluations in total) and {} jacobian evaluations in {:.1f} s; "
+              "{} fits failed".format(
+                "Analytic" if analytic_jacobian else "Numerical",
+                N_objective, N_model, N_jacobian, t, N_failed))
+
+    ew_numerical, ew_analytic = results[False][-1], results[True][-1]
+    finite = np.isfinite(ew_numerical * ew_analytic)
+    print("Objective function evaluations reduced by a factor of {:.1f}".format(
+        results[False][0] / results[True][0]))
+    print("Median relative difference in equivalent width: {:.1e}".format(
+        np.median(np.abs(ew_analytic - ew_numerical)[finite] \
+            / ew_numerical[finite])))
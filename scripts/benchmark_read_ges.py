@@ -0,0 +1,72 @@
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import argparse
+import numpy as np
+import os
+import tempfile
+import time
+
+import smh
+from astropy.table import Table
+from smh.linelists import LineList
+
+test_data = os.path.join(os.path.dirname(smh.__file__), "tests", "test_data")
+
+def make_ges_line_list(filename, N):
+    """
+    Write a GES-format line list with N lines, drawn (with jittered
+    wavelengths) from the bundled line lists.
+    """
+
+    line_list = LineList.read(
+        os.path.join(test_data, "linelists", "complete.list"), cache=False)
+    line_list = line_list[line_list["species"] < 100] # Only atoms
+    np.random.seed(0)
+    indices = np.random.randint(0, len(line_list), size=N)
+
+    tab = Table()
+    tab["LAMBDA"] = np.asarray(line_list["wavelength"])[indices] \
+        + np.random.uniform(-10, 10, size=N)
+    tab["NAME"] = np.array([np.asarray(line_list["elem1"])[indices],
+        np.asarray(line_list["elem2"])[indices]], dtype="S2").T
+    tab["ISOTOPE"] = np.array([np.asarray(line_list["isotope1"])[indices],
+        np.asarray(line_list["isotope2"])[indices]], dtype=np.int16).T
+    tab["ION"] = np.asarray(line_list["ion"], dtype=np.int16)[indices]
+    tab["E_LOW"] = np.asarray(line_list["expot"])[indices]
+    tab["LOG_GF"] = np.asarray(line_list["loggf"])[indices] \
+        + np.random.uniform(-0.5, 0.5, size=N)
+    for column in ("VDW_DAMP", "E_UP", "LANDE_UP", "LANDE_LOW", "STARK_DAMP",
+        "RAD_DAMP"):
+        tab[column] = np.random.uniform(size=N)
+    tab["LOG_GF_REF"] = np.array(["synthetic"] * N)
+    tab.write(filename, format="fits", overwrite=True)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        description="Time reading a (large) GES line list")
+    parser.add_argument("filename", nargs="?", default=None,
+        help="A GES line list. By default a synthetic one is created.")
+    parser.add_argument("-N", "--num-lines", type=int, default=1000000,
+        help="The number of lines in the synthetic line list")
+    args = parser.parse_args()
+
+    filename = args.filename
+    if filename is None:
+        filename = os.path.join(tempfile.mkdtemp(), "ges.fits")
+        print("Writing synthetic GES line list with {} lines to {}".format(
+            args.num_lines, filename))
+        make_ges_line_list(filename, args.num_lines)
+
+    start = time.time()
+    line_list = LineList.read_GES(filename)
+    t = time.time() - start
+    print("Read {} lines in {:.1f} s ({:.0f} lines per second)".format(
+        len(line_list), t, len(line_list) / t))
+
+    lower, upper = np.percentile(line_list["wavelength"], [45, 55])
+    start = time.time()
+    line_list = LineList.read_GES(filename, wavelength_range=(lower, upper))
+    print("Read {} lines between {:.0f} and {:.0f} A in {:.1f} s".format(
+        len(line_list), lower, upper, time.time() - start))
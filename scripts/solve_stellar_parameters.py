@@ -0,0 +1,31 @@
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import argparse
+
+from smh.batch import solve_stellar_parameters
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        description="Solve stellar parameters for many sessions or EW tables")
+    parser.add_argument("paths", nargs="+",
+        help="saved sessions (.smh) or line lists with equivalent widths")
+    parser.add_argument("-o", "--output", default="stellar_parameters.txt",
+        help="tab-separated output table (resumed if it exists)")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+        help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--photospheres", default="castelli/kurucz",
+        help="kind of model photospheres")
+    parser.add_argument("--max-attempts", type=int, default=5)
+    parser.add_argument("--maxfev", type=int, default=30)
+    parser.add_argument("--restart", action="store_true",
+        help="ignore any existing results in the output table")
+    parser.add_argument("--retry-failed", action="store_true",
+        help="re-solve stars that previously raised an exception")
+    args = parser.parse_args()
+
+    N = solve_stellar_parameters(args.paths, args.output,
+        processes=args.processes, photosphere_kind=args.photospheres,
+        resume=not args.restart, retry_failed=args.retry_failed,
+        max_attempts=args.max_attempts, maxfev=args.maxfev)
+    print("Solved {} stars; results in {}".format(N, args.output))
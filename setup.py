@@ -81,7 +81,7 @@ setup(
     packages=find_packages(exclude=["documents", "tests"]),
     install_requires=[
         "numpy",
-        "scipy>=0.14.0",
+        "scipy>=0.18.0",
         "six",
         #"pyside>=1.1.2",
         "astropy",
@@ -10,7 +10,7 @@ import logging
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-from scipy import (integrate, interpolate, ndimage, optimize as op)
+from scipy import (integrate, interpolate, optimize as op)
 from matplotlib.ticker import MaxNLocator
 
 # HACK REMOVE TODO
@@ -18,6 +18,7 @@ try:
     from . import utils
 except ValueError:
     import utils
+from smh.spectral_models.nuisance import NuisanceKernel
 
 __all__ = ["BalmerLineModel"]
 
@@ -215,31 +216,32 @@ class BalmerLineModel(object):
 
         # Continuum.
         O = self.metadata["continuum_order"]
-        continuum = 1.0 if 0 > O \
-            else np.polyval(parameters[-(O + 1):][::-1], model_dispersion)
-
-        y = model_normalized_flux * continuum
+        continuum = None if 0 > O else parameters[-(O + 1):]
 
         # Smoothing?
         try:
             index = self.parameter_names.index("smoothing")
         except ValueError:
-            None
+            kernel = 0
         else:
             kernel = abs(parameters[index])
-            y = ndimage.gaussian_filter1d(y, kernel, axis=-1)
-
 
         # Redshift?
         try:
             index = self.parameter_names.index("redshift")
         except ValueError:
-            z = 0
+            v = 0
         else:
-            v = parameters[index]
-            z = v/299792.458 # km/s
+            v = parameters[index] # km/s
+
+        # The nuisance kernel only changes with the dispersion points.
+        nuisance_kernel = getattr(self, "_nuisance_kernel", None)
+        if nuisance_kernel is None \
+        or not nuisance_kernel.matches(model_dispersion, x, max(O, -1)):
+            nuisance_kernel = self._nuisance_kernel \
+                = NuisanceKernel(model_dispersion, x, max(O, -1))
 
-        return np.interp(x, model_dispersion * (1 + z), y)
+        return nuisance_kernel(model_normalized_flux, continuum, kernel, v)
 
 
     def fitting_function(self, x, model_disp, model_flux, *parameters):
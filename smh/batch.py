@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Headless batch processing of many stars. """
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+__all__ = ["fit_profiles", "solve_stellar_parameters",
+    "stellar_parameter_transitions"]
+
+import logging
+import multiprocessing
+import numpy as np
+import os
+import time
+
+from . import photospheres
+from .linelists import LineList
+from .optimize_stellar_params import optimize_stellar_parameters
+from .spectral_models import ProfileFittingModel
+
+logger = logging.getLogger(__name__)
+
+# The photosphere interpolator shared by all stars solved in this process. When
+# the worker pool is forked, the workers inherit the grid from the parent.
+_photosphere_interpolator = None
+
+# The session and spectral models being fit. This is set by the parent before
+# the pool is forked, so that workers share the spectrum arrays (read-only)
+# instead of having them pickled for every fit.
+_fitting_state = {}
+
+# Column names (and formats) of the output table, in order.
+_output_columns = [
+    ("path", "{}"),
+    ("name", "{}"),
+    ("tolerance_achieved", "{:d}"),
+    ("effective_temperature", "{:.0f}"),
+    ("microturbulence", "{:.3f}"),
+    ("surface_gravity", "{:.3f}"),
+    ("metallicity", "{:.3f}"),
+    ("dA_dchi", "{:.4e}"),
+    ("dA_dREW", "{:.4e}"),
+    ("dFe", "{:.4e}"),
+    ("dM", "{:.4e}"),
+    ("total_tolerance", "{:.4e}"),
+    ("num_transitions", "{:d}"),
+    ("num_moog_iterations", "{:d}"),
+    ("num_attempts", "{:d}"),
+    ("time_elapsed", "{:.1f}"),
+    ("error", "{}"),
+]
+
+
+def stellar_parameter_transitions(session):
+    """
+    Return a copy of the session line list for the acceptable spectral models
+    that are used for stellar parameter inference, with their measured
+    equivalent widths (in milliAngstroms).
+
+    :param session:
+        A session with fitted spectral models.
+    """
+
+    transition_indices = []
+    equivalent_widths = []
+    for model in session.metadata.get("spectral_models", []):
+        if model.use_for_stellar_parameter_inference \
+        and model.is_acceptable and not model.is_upper_limit:
+            transition_indices.append(model._transition_indices[0])
+            equivalent_widths.append(
+                1e3 * model.metadata["fitted_result"][-1]["equivalent_width"][0])
+
+    transitions = session.metadata["line_list"][
+        np.array(transition_indices, dtype=int)].copy()
+    transitions["equivalent_width"] = equivalent_widths
+    return transitions
+
+
+def _load_star(path, initial_guess=None):
+    """
+    Load the transitions and initial guess of stellar parameters for one star.
+
+    :param path:
+        The path of a saved session (`.smh`) or a line list with measured
+        equivalent widths.
+
+    :param initial_guess: [optional]
+        The initial guess of stellar parameters (teff, vt, logg, [M/H]). If
+        `None` is given, the guess will be taken from the session, or the
+        default session stellar parameters.
+
+    :returns:
+        A two-length tuple containing the transitions and initial guess.
+    """
+
+    if path.lower().endswith(".smh"):
+        from .session import Session
+
+        session = Session.load(path)
+        transitions = stellar_parameter_transitions(session)
+        if initial_guess is None:
+            sp = session.metadata["stellar_parameters"]
+            initial_guess = [sp["effective_temperature"],
+                sp["microturbulence"], sp["surface_gravity"], sp["metallicity"]]
+
+    else:
+        transitions = LineList.read(path)
+        try:
+            equivalent_widths = np.array(transitions["equivalent_width"])
+        except KeyError:
+            raise KeyError("no equivalent widths found in '{}'".format(path))
+
+        use = np.in1d(transitions["element"], ("Fe I", "Fe II")) \
+            * np.isfinite(equivalent_widths) * (equivalent_widths > 0.01)
+        transitions = transitions[use]
+
+    if initial_guess is None:
+        # Same as the defaults for a new session.
+        initial_guess = [5777, 1.06, 4.4, 0.0]
+
+    return (transitions, list(initial_guess))
+
+
+def _initialize_worker(kind):
+    """
+    Load the photosphere grid in a worker process, unless it was already
+    inherited from the parent process.
+    """
+
+    global _photosphere_interpolator
+    if _photosphere_interpolator is None:
+        _photosphere_interpolator = photospheres.interpolator(kind)
+    return None
+
+
+def _solve_star(args):
+    """
+    Solve the stellar parameters of a single star. This is executed by the
+    worker processes, and any exception is caught and returned in the row so
+    that one bad star does not stop the survey.
+    """
+
+    path, initial_guess, kwargs = args
+
+    row = dict(path=path, name=os.path.splitext(os.path.basename(path))[0],
+        tolerance_achieved=False, error="")
+    start = time.time()
+    try:
+        transitions, initial_guess = _load_star(path, initial_guess)
+        row["num_transitions"] = len(transitions)
+
+        tolerance_achieved, _, num_moog_iterations, num_attempts, t_elapsed, \
+            final_parameters, final_parameters_result, __ \
+            = optimize_stellar_parameters(initial_guess, transitions,
+                photosphere_interpolator=_photosphere_interpolator, **kwargs)
+
+    except Exception as e:
+        logger.exception("Exception in solving stellar parameters for {}:"\
+            .format(path))
+        row["error"] = "{}: {}".format(type(e).__name__, e)
+        row["time_elapsed"] = time.time() - start
+
+    else:
+        row.update(dict(zip(
+            ("effective_temperature", "microturbulence", "surface_gravity",
+                "metallicity"), final_parameters)))
+        row.update(dict(zip(("dA_dchi", "dA_dREW", "dFe", "dM"),
+            final_parameters_result)))
+        row.update({
+            "tolerance_achieved": bool(tolerance_achieved),
+            "total_tolerance": np.sum(np.array(final_parameters_result)**2),
+            "num_moog_iterations": num_moog_iterations,
+            "num_attempts": num_attempts,
+            "time_elapsed": t_elapsed
+        })
+
+    return row
+
+
+def _format_row(row):
+    """ Format an output row as a tab-separated line. """
+
+    values = []
+    for name, fmt in _output_columns:
+        value = row.get(name, None)
+        if value is None or (isinstance(value, float) and not np.isfinite(value)):
+            values.append("nan" if fmt != "{}" else "")
+        else:
+            # Tabs and new lines would break the table.
+            values.append(" ".join(fmt.format(value).split()))
+    return "\t".join(values) + "\n"
+
+
+def _read_completed(output_path, retry_failed=False):
+    """
+    Return the paths of stars that already have results in the output table.
+
+    :param output_path:
+        The path of the output table.
+
+    :param retry_failed: [optional]
+        Do not count stars that raised an exception as being completed.
+    """
+
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    names = [name for name, fmt in _output_columns]
+    with open(output_path, "r") as fp:
+        for i, line in enumerate(fp):
+            if i == 0 or not line.endswith("\n"):
+                # Header, or a partially written row from a crash.
+                continue
+            values = line.rstrip("\n").split("\t")
+            if len(values) != len(names):
+                continue
+
+            row = dict(zip(names, values))
+            if retry_failed and row["error"]: continue
+            completed.add(row["path"])
+
+    return completed
+
+
+def solve_stellar_parameters(paths, output_path, processes=None,
+    initial_guess=None, photosphere_kind="castelli/kurucz", resume=True,
+    retry_failed=False, callback=None, **kwargs):
+    """
+    Solve the stellar parameters of many stars with a shared pool of workers
+    and a shared photosphere grid. Results are appended to a tab-separated
+    output table as each star finishes, so an interrupted run can be resumed.
+
+    :param paths:
+        A list of saved session paths (`.smh`) and/or line lists with measured
+        equivalent widths (in milliAngstroms).
+
+    :param output_path:
+        The path of the output table. It can be read with
+        `astropy.table.Table.read(output_path, format="ascii.tab")`.
+
+    :param processes: [optional]
+        The number of worker processes to use. If `None` is given, then one
+        process per CPU will be used. If 1 is given then the stars are solved
+        in this process.
+
+    :param initial_guess: [optional]
+        The initial guess of stellar parameters (teff, vt, logg, [M/H]) for all
+        stars. By default these are taken from each session.
+
+    :param photosphere_kind: [optional]
+        The kind of photospheres to use.
+
+    :param resume: [optional]
+        Skip any stars that already have results in the output table.
+
+    :param retry_failed: [optional]
+        When resuming, re-solve stars that previously raised an exception.
+
+    :param callback: [optional]
+        A function that is called with each row of results as it is written.
+
+    :param kwargs:
+        Keyword arguments that are passed directly to
+        `optimize_stellar_parameters` (e.g., `max_attempts`, `maxfev`).
+
+    :returns:
+        The number of stars solved in this run.
+    """
+
+    global _photosphere_interpolator
+
+    paths = [os.path.abspath(path) for path in paths]
+    if resume:
+        completed = _read_completed(output_path, retry_failed)
+        pending = [path for path in paths if path not in completed]
+        if len(pending) < len(paths):
+            logger.info("Resuming: {} of {} stars already have results".format(
+                len(paths) - len(pending), len(paths)))
+
+    else:
+        pending = paths
+
+    if not os.path.exists(output_path) or not resume:
+        with open(output_path, "w") as fp:
+            fp.write("\t".join([name for name, _ in _output_columns]) + "\n")
+
+    else:
+        # Remove any partially written row from a crash, so that new rows are
+        # not appended to it.
+        with open(output_path, "rb+") as fp:
+            content = fp.read()
+            if content and not content.endswith(b"\n"):
+                fp.truncate(content.rfind(b"\n") + 1)
+
+    if not pending:
+        return 0
+
+    # Load the grid once here so that forked workers share it.
+    _initialize_worker(photosphere_kind)
+
+    tasks = [(path, initial_guess, kwargs) for path in pending]
+    if processes == 1:
+        pool = None
+        results = (_solve_star(task) for task in tasks)
+
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_initialize_worker,
+            initargs=(photosphere_kind, ))
+        results = pool.imap_unordered(_solve_star, tasks)
+
+    N = 0
+    start = time.time()
+    try:
+        with open(output_path, "a") as fp:
+            for row in results:
+                fp.write(_format_row(row))
+                fp.flush()
+                os.fsync(fp.fileno())
+
+                N += 1
+                logger.info("Solved {} ({}/{}) in {:.0f}s".format(
+                    row["name"], N, len(tasks), time.time() - start))
+                if callback is not None:
+                    callback(row)
+
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+
+    else:
+        if pool is not None:
+            pool.close()
+
+    finally:
+        if pool is not None:
+            pool.join()
+
+    return N
+
+
+def _initialize_fitting_worker():
+    """ Ensure the covariance draws in each worker process are different. """
+    np.random.seed()
+    return None
+
+
+def _fit_profile(index):
+    """
+    Fit one profile model. This is executed by the worker processes.
+
+    :param index:
+        The index of the model in the list of spectral models being fit.
+
+    :returns:
+        A two-length tuple containing the index and the metadata of the model
+        after fitting, or `None` if the fit raised an exception.
+    """
+
+    model = _fitting_state["spectral_models"][index]
+    try:
+        model.fit(_fitting_state["spectrum"], **_fitting_state["kwargs"])
+    except Exception:
+        logger.exception("Exception in fitting {}:".format(model))
+        return (index, None)
+
+    return (index, model.metadata)
+
+
+def fit_profiles(session, spectral_models=None, processes=None, callback=None,
+    cancel=None, spectrum=None, **kwargs):
+    """
+    Fit many profile models in parallel, and update the models with the
+    results.
+
+    :param session:
+        The session that the spectral models belong to.
+
+    :param spectral_models: [optional]
+        The spectral models to fit. By default, all profile models in the
+        session are fit. Any models that are not profile models are ignored.
+
+    :param processes: [optional]
+        The number of worker processes to use. If `None` is given, then one
+        process per CPU will be used. If 1 is given then the models are fit
+        in this process.
+
+    :param callback: [optional]
+        A function that is called with the model, the number of models fit so
+        far, and the total number of models to fit, as each fit finishes.
+
+    :param cancel: [optional]
+        A function that returns True if the remaining fits should be cancelled.
+        This is checked after each fit finishes.
+
+    :param spectrum: [optional]
+        The spectrum to fit. By default this is the normalized rest-frame
+        spectrum in the session.
+
+    :param kwargs:
+        Keyword arguments that are passed directly to the `fit` method of each
+        model.
+
+    :returns:
+        The number of models that were fit successfully.
+    """
+
+    if spectral_models is None:
+        spectral_models = session.metadata.get("spectral_models", [])
+    spectral_models = [model for model in spectral_models \
+        if isinstance(model, ProfileFittingModel)]
+    if not spectral_models:
+        return 0
+
+    if spectrum is None:
+        spectrum = session.normalized_spectrum
+
+    _fitting_state.update(spectral_models=spectral_models, spectrum=spectrum,
+        kwargs=kwargs)
+
+    indices = range(len(spectral_models))
+    if processes == 1:
+        pool = None
+        results = (_fit_profile(index) for index in indices)
+
+    else:
+        pool = multiprocessing.Pool(processes,
+            initializer=_initialize_fitting_worker)
+        chunksize = max(1, len(spectral_models) \
+            // (8 * (processes or multiprocessing.cpu_count())))
+        results = pool.imap_unordered(_fit_profile, indices, chunksize)
+
+    N, N_successful = 0, 0
+    start = time.time()
+    try:
+        for index, metadata in results:
+            model = spectral_models[index]
+            if metadata is not None:
+                model.metadata = metadata
+                session.update_spectral_model_results([model])
+                N_successful += 1
+
+            N += 1
+            if callback is not None:
+                callback(model, N, len(spectral_models))
+
+            if cancel is not None and cancel():
+                logger.info("Cancelled fitting after {} of {} models".format(
+                    N, len(spectral_models)))
+                break
+
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+
+    else:
+        if pool is not None:
+            # The remaining results are not needed if fitting was cancelled.
+            pool.terminate()
+
+    finally:
+        if pool is not None:
+            pool.join()
+        _fitting_state.clear()
+
+    logger.debug("Time to fit {} profile models: {:.1f}".format(
+        N, time.time() - start))
+
+    return N_successful
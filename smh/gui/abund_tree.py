@@ -268,7 +268,7 @@ class AbundTreeModel(QtCore.QAbstractItemModel):
             if role == QtCore.Qt.CheckStateRole:
                 #assert isinstance(value, bool),value
                 m = self.parenttab.spectral_models[item.sm_ix]
-                m.metadata["is_acceptable"] = value
+                m.is_acceptable = value
                 # Also edit the parent summary here!
                 item.parent.compute_summary()
                 topLeft = self.createIndex(0, 0, item.parent)
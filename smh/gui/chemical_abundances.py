@@ -839,42 +839,31 @@ class ChemicalAbundancesTab(QtGui.QWidget):
         current_element_index = self.filter_combo_box.currentIndex()
 
         # Fit all acceptable
-        num_unacceptable = 0
-        for i,spectral_model in enumerate(self.all_spectral_models.spectral_models):
-            if not spectral_model.is_acceptable:
-                num_unacceptable += 1
-                continue
-            if isinstance(spectral_model, SpectralSynthesisModel):
-                num_unacceptable += 1
-                continue
-                #try:
-                #    res = spectral_model.fit()
-                #except (ValueError, RuntimeError, TypeError) as e:
-                #    logger.debug("Fitting error",spectral_model)
-                #    logger.debug(e)
-            elif isinstance(spectral_model, ProfileFittingModel):
-                try:
-                    res = spectral_model.fit()
-                except (ValueError, RuntimeError, TypeError) as e:
-                    logger.debug("Fitting error",spectral_model)
-                    logger.debug(e)
+        spectral_models = [spectral_model \
+            for spectral_model in self.all_spectral_models.spectral_models \
+            if spectral_model.is_acceptable \
+            and isinstance(spectral_model, ProfileFittingModel)]
+
         # If none are acceptable, then fit all
-        if num_unacceptable == self.all_spectral_models.rowCount(None):
+        if len(spectral_models) == 0:
             print("Found no acceptable spectral models, fitting all!")
-            for i,spectral_model in enumerate(self.all_spectral_models.spectral_models):
-                if isinstance(spectral_model, SpectralSynthesisModel):
-                    continue
-                    #try:
-                    #    res = spectral_model.fit()
-                    #except (ValueError, RuntimeError, TypeError) as e:
-                    #    logger.debug("Fitting error",spectral_model)
-                    #    logger.debug(e)
-                elif isinstance(spectral_model, ProfileFittingModel):
-                    try:
-                        res = spectral_model.fit()
-                    except (ValueError, RuntimeError, TypeError) as e:
-                        logger.debug("Fitting error",spectral_model)
-                        logger.debug(e)
+            spectral_models = [spectral_model \
+                for spectral_model in self.all_spectral_models.spectral_models \
+                if isinstance(spectral_model, ProfileFittingModel)]
+
+        progress = QtGui.QProgressDialog("Fitting profiles..", "Cancel",
+            0, len(spectral_models), self)
+        progress.setWindowModality(QtCore.Qt.WindowModal)
+
+        def callback(spectral_model, N, total):
+            progress.setValue(N)
+            QtGui.QApplication.processEvents()
+
+        # Forking a pool from inside the Qt event loop is not safe, so the
+        # models are fit in this process.
+        self.parent.session.fit_profiles(spectral_models, processes=1,
+            callback=callback, cancel=progress.wasCanceled)
+        progress.setValue(len(spectral_models))
 
         self.proxy_spectral_models.reset()
         self.populate_filter_combo_box()
@@ -1753,6 +1742,7 @@ class ChemicalAbundancesTab(QtGui.QWidget):
         spectral_model, proxy_index, index = self._get_selected_model(True)
         spectral_model.metadata["is_upper_limit"] \
             = self.checkbox_upper_limit.isChecked()
+        spectral_model._update_session_results()
         self.table_view.update_row(proxy_index.row())
         self.update_cache(proxy_index)
         self.summarize_current_table()
@@ -1762,6 +1752,7 @@ class ChemicalAbundancesTab(QtGui.QWidget):
         spectral_model = self._get_selected_model()
         spectral_model.metadata["mask"] = []
         spectral_model.metadata.pop("fitted_result", None)
+        spectral_model._update_session_results()
         self.fit_one()
         return None
 
@@ -1920,6 +1911,9 @@ class ChemicalAbundancesTab(QtGui.QWidget):
                 fitted_result[0][key] = abund
                 fitted_result[2]["abundances"][i] = abund
 
+            # The session summary reads the abundances from the results.
+            selected_model._update_session_results()
+
         self.synth_abund_table.model().endResetModel()
 
         print(summary_dict)
@@ -2332,6 +2326,9 @@ class SynthesisAbundanceTableModel(QtCore.QAbstractTableModel):
                     if _elem == elem: break
                 else: raise ValueError(elem+" "+str(self.spectral_model.elements))
                 fitted_result[2]["abundances"][i] = value
+
+                # The session summary reads the abundances from the results.
+                self.spectral_model._update_session_results()
                 return True
         else:
             raise ValueError(elem+" "+str(self.spectral_model.elements))
@@ -95,6 +95,7 @@ class LineListTableModel(QtCore.QAbstractTableModel):
                 # but shouldn't be an issue
         try:
             self.session.metadata["line_list"][column][index.row()] = value
+            self.session.metadata["line_list"].reset_wavelength_index()
         except:
             return False
         return value
@@ -122,9 +123,9 @@ class LineListTableModel(QtCore.QAbstractTableModel):
             self.createIndex(self.rowCount(0), self.columnCount(0)))
         self.emit(QtCore.SIGNAL("layoutChanged()"))
         
-        # Must update hash sorting after any modification to line list
-        self.session.metadata["line_list_argsort_hashes"] = np.argsort(
-            self.session.metadata["line_list"]["hash"])
+        # Must update hash sorting (and the spectral models that index the line
+        # list) after any modification to line list
+        self.session.index_spectral_models()
 
     def flags(self, index):
         if not index.isValid():
@@ -396,9 +397,9 @@ class LineListTableView(QtGui.QTableView):
         self.session.metadata["line_list"] \
             = self.session.metadata["line_list"][mask]
 
-        # Must update hash sorting after any modification to line list
-        self.session.metadata["line_list_argsort_hashes"] = np.argsort(
-            self.session.metadata["line_list"]["hash"])
+        # Must update hash sorting (and the spectral models that index the line
+        # list) after any modification to line list
+        self.session.index_spectral_models()
 
         self._parent.models_view.model().reset()
 
@@ -602,7 +603,9 @@ class SpectralModelsTableModel(QtCore.QAbstractTableModel):
             return False
 
         else:
-            self.session.metadata["spectral_models"][index.row()].metadata[a] = value
+            spectral_model = self.session.metadata["spectral_models"][index.row()]
+            spectral_model.metadata[a] = value
+            spectral_model._update_session_results()
             self.dataChanged.emit(index, index)
 
             self.session._spectral_model_conflicts = spectral_model_conflicts(
@@ -78,6 +78,7 @@ class SpectralModelsTableModel(QtCore.QAbstractTableModel):
             return False
 
         self._data[index.row()].metadata[attr] = value
+        self._data[index.row()]._update_session_results()
         self.dataChanged.emit(index, index)
         return value
 
@@ -434,7 +434,7 @@ class SpectralModelsTableModelBase(QtCore.QAbstractTableModel):
             row = index.row()
             value = (value != 0)
             model = self.spectral_models[row]
-            model.metadata["is_acceptable"] = value
+            model.is_acceptable = value
             
             # Emit data change for this row.
             # TODO this is slow.
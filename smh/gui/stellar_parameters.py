@@ -25,6 +25,7 @@ from smh.spectral_models import (ProfileFittingModel, SpectralSynthesisModel)
 from smh import utils
 from linelist_manager import TransitionsDialog
 from smh.optimize_stellar_params import optimize_stellar_parameters
+from smh.batch import stellar_parameter_transitions
 
 from spectral_models_table import SpectralModelsTableViewBase, SpectralModelsFilterProxyModel, SpectralModelsTableModelBase
 from quality_control import QualityControlDialog
@@ -1562,15 +1563,7 @@ class StellarParametersTab(QtGui.QWidget):
                          sp["surface_gravity"], sp["metallicity"]]
 
         ## grab transitions for stellar parameters
-        transition_indices = []
-        EWs = []
-        for i, model in enumerate(self.parent.session.metadata["spectral_models"]):
-            if model.use_for_stellar_parameter_inference and model.is_acceptable and not model.is_upper_limit:
-                transition_indices.append(model._transition_indices[0])
-                EWs.append(1e3 * model.metadata["fitted_result"][-1]["equivalent_width"][0])
-        transition_indices = np.array(transition_indices)
-        transitions = self.parent.session.metadata["line_list"][transition_indices].copy()
-        transitions["equivalent_width"] = EWs
+        transitions = stellar_parameter_transitions(self.parent.session)
         
         ## TODO the optimization does not use the error weights yet
         ## TODO allow specification of tolerances and other params in QDialog widget
@@ -1674,7 +1667,7 @@ class SpectralModelsTableView(SpectralModelsTableViewBase):
             for idx in indices:
                 spectral_model \
                     = self.parent.parent.session.metadata["spectral_models"][idx]
-                spectral_model.metadata["is_acceptable"] = False
+                spectral_model.is_acceptable = False
 
             # Update trend lines and scatter points.
             if len(indices) > 0:
@@ -1687,8 +1680,7 @@ class SpectralModelsTableView(SpectralModelsTableViewBase):
             for idx in indices:
                 spectral_model \
                     = self.parent.parent.session.metadata["spectral_models"][idx]
-                if "fitted_result" in spectral_model.metadata:
-                    spectral_model.metadata["is_acceptable"] = True
+                spectral_model.is_acceptable = True
 
             # Update trend lines and scatter points.
             if len(indices) > 0:
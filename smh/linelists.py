@@ -6,8 +6,11 @@ import astropy.units as u
 from astropy.io import ascii,fits,registry
 from astropy.table import Table, Column, MaskedColumn
 from astropy import table
+from scipy import sparse
+from scipy.sparse import csgraph
 from .utils import element_to_species, species_to_element
 from .utils import elems_isotopes_ion_to_species, species_to_elems_isotopes_ion
+from .utils import species_to_element_array, species_to_elems_isotopes_ion_array
 
 import logging
 logger = logging.getLogger(__name__)
@@ -17,6 +20,9 @@ handler.setFormatter(logging.Formatter(
 logger.addHandler(handler)
 
 import os
+import json
+import shutil
+import itertools
 
 import md5
 
@@ -29,6 +35,265 @@ class LineListConflict(Exception):
     def __str__(self):
         return "LineListConflict ({} conflicts)\nConflicts from current list\n{}\nConflicts from new list\n{}".format(len(self.conflicts1), repr(self.conflicts1), repr(self.conflicts2)) 
 
+def _line_keys(*line_lists):
+    """
+    Return an integer key for every line in some line lists, such that lines
+    have the same key if (and only if) they have the same elements and
+    ionization state. Isotopes are ignored.
+    """
+    N = [len(ll) for ll in line_lists]
+    keys = np.zeros(sum(N), dtype=int)
+    for column in ("elem1", "elem2", "ion"):
+        values = np.hstack([np.asarray(ll[column]) for ll in line_lists])
+        unique, inverse = np.unique(values, return_inverse=True)
+        keys = keys * len(unique) + inverse
+    # Keep the keys small
+    keys = np.unique(keys, return_inverse=True)[1]
+    return np.split(keys, np.cumsum(N)[:-1])
+
+def _match_lines(ll1, ll2, thresh, expot_thresh):
+    """
+    Find all pairs of lines in two line lists that have the same elements and
+    ionization state (but not necessarily the same isotopes), wavelengths that
+    differ by less than `thresh`, and excitation potentials that differ by
+    less than `expot_thresh`.
+
+    The lines in `ll1` are sorted by their key and wavelength, and the range
+    of matching lines for each line in `ll2` is found by a binary search, so
+    this takes O((N + M) log N) time (plus the number of matches) instead of
+    O(N * M).
+
+    Returns the indices of the matching lines in `ll1` and `ll2`, ordered by
+    the index in `ll2` and then by the index in `ll1`.
+    """
+    if len(ll1) == 0 or len(ll2) == 0:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+
+    key1, key2 = _line_keys(ll1, ll2)
+    wl1 = np.asarray(ll1["wavelength"], dtype=float)
+    wl2 = np.asarray(ll2["wavelength"], dtype=float)
+
+    # Offset the wavelengths of each key so that a single sorted array can be
+    # searched for all keys at once.
+    lower = min(wl1.min(), wl2.min())
+    span = max(wl1.max(), wl2.max()) - lower + 2 * thresh + 1
+    x1 = wl1 - lower + key1 * span
+    x2 = wl2 - lower + key2 * span
+
+    sorter = np.argsort(x1, kind="mergesort")
+    x1 = x1[sorter]
+    pad = thresh + 1e-6
+    start = x1.searchsorted(x2 - pad, side="left")
+    counts = x1.searchsorted(x2 + pad, side="right") - start
+
+    # Expand the ranges into candidate pairs.
+    indices2 = np.repeat(np.arange(len(ll2)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    indices1 = sorter[np.repeat(start, counts) + offsets]
+
+    # Apply the exact criteria to the candidates.
+    expot1 = np.asarray(ll1["expot"], dtype=float)
+    expot2 = np.asarray(ll2["expot"], dtype=float)
+    ok = (key1[indices1] == key2[indices2]) \
+       * (np.abs(wl1[indices1] - wl2[indices2]) < thresh) \
+       * (np.abs(expot1[indices1] - expot2[indices2]) < expot_thresh)
+    indices1, indices2 = indices1[ok], indices2[ok]
+    order = np.lexsort((indices1, indices2))
+    return (indices1[order], indices2[order])
+
+def _group_indices(labels, indices):
+    """
+    Return a dictionary with the sorted unique indices that have each label
+    """
+    if len(labels) == 0: return {}
+    order = np.lexsort((indices, labels))
+    labels, indices = labels[order], indices[order]
+    unique = np.ones(len(labels), dtype=bool)
+    unique[1:] = (labels[1:] != labels[:-1]) | (indices[1:] != indices[:-1])
+    labels, indices = labels[unique], indices[unique]
+    boundaries = np.flatnonzero(np.diff(labels)) + 1
+    return dict(zip(labels[np.hstack([0, boundaries])],
+                    np.split(indices, boundaries)))
+
+def _species_columns(species):
+    """
+    Return the number of elements, element name, first element, first isotope,
+    second element, second isotope and ionization state for an array of
+    species. Each unique species is only converted once.
+    """
+    species = np.asarray(species)
+    elements = species_to_element_array(species)
+    elem1, elem2, isotope1, isotope2, ion = species_to_elems_isotopes_ion_array(species)
+    numelems = np.where(species >= 100, 2, 1)
+    return (numelems, elements, elem1, isotope1, elem2, isotope2, ion)
+
+def _filter_mask(wavelength, species, wavelength_range=None, keep_species=None,
+                 loggf=None, loggf_range=None):
+    """
+    Return which lines are within a (lower, upper) wavelength range, are
+    one of some species (ignoring isotopes) and have loggf within a
+    (lower, upper) range
+    """
+    keep = np.ones(len(wavelength), dtype=bool)
+    if wavelength_range is not None:
+        keep *= (wavelength >= min(wavelength_range)) * (wavelength <= max(wavelength_range))
+    if keep_species is not None:
+        keep *= np.in1d(np.floor(species * 10 + 1e-8) / 10, keep_species)
+    if loggf_range is not None:
+        with np.errstate(invalid='ignore'):
+            keep *= (loggf >= min(loggf_range)) * (loggf <= max(loggf_range))
+    return keep
+
+def _read_chunks(f, chunk_size):
+    """
+    Yield lists of (at most) chunk_size lines from an open file
+    """
+    while True:
+        lines = list(itertools.islice(f, chunk_size))
+        if len(lines) == 0: return
+        yield lines
+
+def _parse_moog_lines(lines, wavelength_range=None, species=None, loggf_range=None):
+    """
+    Parse lines of a MOOG line list (without a header), only keeping the lines
+    that pass the wavelength, species and loggf cuts.
+    Lines pass the loggf cut if either the value or its log10 pass, because
+    whether the list has gf or loggf is only known after reading all of it.
+
+    Returns whether all loggf >= 0 (before the cuts), and the wavelength,
+    species, EP, loggf, damping, dissociation energy, EW and comments
+    of the kept lines
+    """
+    # wl, transition, EP, loggf, VDW damping C6, dissociation D0, EW, comments
+    tokens = [line.split(None, 4) for line in lines]
+    try:
+        values = np.array([t[:4] for t in tokens], dtype=float).reshape(-1, 4)
+    except ValueError:
+        # Report the first invalid line
+        for line, t in zip(lines, tokens):
+            try:
+                _wl,_species,_EP,_loggf = map(float,t[:4])
+            except ValueError:
+                raise IOError("Invalid line: {}".format(line))
+        raise
+    wl, species_, EP, loggf = values.T
+    has_more = np.array([len(t) > 4 for t in tokens], dtype=bool)
+    all_positive = np.all(loggf >= 0)
+
+    # Only keep the lines that we want
+    keep = _filter_mask(wl, species_, wavelength_range, species)
+    if loggf_range is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            keep *= _filter_mask(wl, None, loggf=loggf, loggf_range=loggf_range) \
+                  | _filter_mask(wl, None, loggf=np.log10(loggf), loggf_range=loggf_range)
+    if not np.all(keep):
+        lines = [line for line, _keep in zip(lines, keep) if _keep]
+        wl, species_, EP, loggf = wl[keep], species_[keep], EP[keep], loggf[keep]
+        has_more = has_more[keep]
+
+    # The fixed-width columns
+    N = len(wl)
+    ew = np.zeros(N) * np.nan
+    damping = np.zeros(N) * np.nan
+    dissoc = np.zeros(N) * np.nan
+    comments = np.array([''] * N, dtype=object)
+    if np.any(has_more):
+        extra = np.flatnonzero(has_more)
+        width = max(80, max([len(lines[i]) for i in extra]))
+        chars = np.array([lines[i] for i in extra], dtype="S{}".format(width))
+        chars = chars.view("S1").reshape(-1, width)
+        def column(start, end=width):
+            return np.char.strip(np.ascontiguousarray(chars[:, start:end]) \
+                                 .view("S{}".format(end - start)).flatten())
+        damping[extra], _ = _parse_floats(column(40, 50))
+        dissoc[extra], _ = _parse_floats(column(50, 60))
+        _ew, parsed = _parse_floats(column(60, 70))
+        # It seems some linelists have -1 in the EW location as a placeholder
+        has_ew = parsed * ~(_ew <= 0)
+        ew[extra[has_ew]] = _ew[has_ew]
+        comments[extra] = np.where(has_ew, column(70), column(60))
+    comments = [str(comment) for comment in comments]
+    return (all_positive, wl, species_, EP, loggf, damping, dissoc, ew, comments)
+
+def _ges_species(names, isotopes, ions):
+    """
+    Return the species of GES line list entries from their NAME (N, 2),
+    ISOTOPE (N, 2) and ION columns. Each unique combination of names,
+    isotopes and ion is only decoded once.
+    """
+    names, isotopes = np.asarray(names), np.asarray(isotopes)
+    columns = [names[:, 0], names[:, 1], isotopes[:, 0], isotopes[:, 1], np.asarray(ions)]
+    keys = np.zeros(len(columns[-1]), dtype=int)
+    for column in columns:
+        unique, inverse = np.unique(column, return_inverse=True)
+        # Keep the keys small
+        keys = np.unique(keys * len(unique) + inverse, return_inverse=True)[1]
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    species = np.array([elems_isotopes_ion_to_species(*[column[i] for column in columns]) \
+                        for i in first], dtype=float)
+    return species[inverse]
+
+def _read_ges_table(filename, wavelength_range=None, species=None, loggf_range=None,
+                    chunk_size=100000):
+    """
+    Read the rows of a GES line list (FITS) that pass the wavelength, species
+    and loggf cuts. The table is memory-mapped and cut a chunk at a time, so
+    only the rows that are kept are ever read into memory.
+    """
+    if wavelength_range is None and species is None and loggf_range is None:
+        return Table.read(filename)
+    tables = []
+    with fits.open(filename, memmap=True) as hdulist:
+        hdu = [hdu for hdu in hdulist if isinstance(hdu, fits.BinTableHDU)][0]
+        data = hdu.data
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            keep = _filter_mask(np.asarray(chunk['LAMBDA'], dtype=float), None, wavelength_range,
+                                loggf=np.asarray(chunk['LOG_GF'], dtype=float), loggf_range=loggf_range)
+            if species is not None:
+                # Only find the species of lines that pass the other cuts
+                indices = np.flatnonzero(keep)
+                chunk_species = np.array(_ges_species(chunk['NAME'][indices],
+                    chunk['ISOTOPE'][indices], chunk['ION'][indices]), dtype=float)
+                keep[indices] = _filter_mask(chunk_species, chunk_species, keep_species=species)
+            tables.append(Table(chunk[keep]))
+    return table.vstack(tables)
+
+def _parse_floats(values):
+    """
+    Convert an array of strings to floats. Values that cannot be converted are
+    NaN. Also returns whether each value was converted.
+    """
+    floats = np.zeros(len(values)) * np.nan
+    parsed = np.array([len(value) > 0 for value in values], dtype=bool)
+    try:
+        floats[parsed] = values[parsed].astype(float)
+    except ValueError:
+        for i in np.flatnonzero(parsed):
+            try:
+                floats[i] = float(values[i])
+            except ValueError:
+                parsed[i] = False
+    return (floats, parsed)
+
+def _lines_equal(ll1, indices1, ll2, indices2, dwl_thresh=.001, dEP_thresh=.01,
+                 dgf_thresh=.001):
+    """
+    Vectorized version of LineList.lines_equal for pairs of lines
+    """
+    equal = np.ones(len(indices1), dtype=bool)
+    for column, thresh in (("wavelength", dwl_thresh), ("expot", dEP_thresh),
+                           ("loggf", dgf_thresh)):
+        equal *= np.abs(np.asarray(ll1[column])[indices1] \
+                      - np.asarray(ll2[column])[indices2]) < thresh
+    return equal
+
+def _lines_exactly_equal(ll1, indices1, ll2, indices2):
+    """
+    Vectorized version of LineList.lines_exactly_equal for pairs of lines
+    """
+    return np.asarray(ll1["hash"])[indices1] == np.asarray(ll2["hash"])[indices2]
+
 class LineList(Table):
     full_colnames = ['wavelength','species','expot','loggf','damp_vdw','dissoc_E','comments',
                      'numelems','elem1','isotope1','elem2','isotope2','ion',
@@ -82,7 +347,7 @@ class LineList(Table):
             except IOError:
                 pass
             else:
-                hashes = [self.hash(line) for line in self]
+                hashes = self.compute_hashes(self)
                 self.add_column(Column(hashes,name='hash'))
 
         if 'hash' in self.columns and (not self.has_duplicates):
@@ -146,65 +411,56 @@ class LineList(Table):
     def identify_conflicts(ll1, ll2, 
                            skip_exactly_equal_lines=False,
                            skip_equal_loggf=False,
-                           dwl_thresh=.001,dEP_thresh=.01,dgf_thresh=.001):
+                           dwl_thresh=.001,dEP_thresh=.01,dgf_thresh=.001,
+                           matches=None):
         """
         skip_exactly_equal_lines: if True, skips single-line conflicts that are identical hashes
         skip_equal_loggf: if True, skips single-line conflicts that are almost identical
+        matches: the (ll1 indices, ll2 indices) of matching lines, if they are already known
         """
+        if matches is None:
+            matches = _match_lines(ll1, ll2, .1, .01)
         if len(ll1) > len(ll2): #swap
             swap = True
             _ll = ll1; ll1 = ll2; ll2 = _ll
+            matches = matches[::-1]
         else:
             swap = False
-        matches = np.zeros((len(ll1),len(ll2)),dtype=bool)
-        for i,line in enumerate(ll1):
-            ii1 = np.logical_and(np.logical_and(ll2['elem1']==line['elem1'], ll2['elem2']==line['elem2']), ll2['ion']==line['ion'])
-            ii2 = np.abs(ll2['wavelength']-line['wavelength']) < .1
-            ii3 = np.abs(ll2['expot']-line['expot']) < .01
-            matches[i,ii1&ii2&ii3] = True
-        #indices of all matches
-        conflicts = np.array(np.where(matches)).T
-        used = np.zeros(len(conflicts),dtype=bool)
-        equivalence_classes = [] #list of lists of indices of conflicts
-        while np.sum(used) != len(used):
-            next_conflict = np.min(np.where(~used)[0])
-            eq_class = [next_conflict]
-            used[next_conflict] = True
-            while True:
-                N_last = len(eq_class)
-                for conflict in conflicts[eq_class]:
-                    # find indices of all unused conflicts that match this conflict
-                    new_ii = np.where(np.logical_and(~used, np.logical_or(conflict[0]==conflicts[:,0], conflict[1]==conflicts[:,1])))[0]
-                    if len(new_ii)==0: continue
-                    eq_class.extend(list(new_ii))
-                    used[new_ii] = True
-                if len(eq_class) == N_last: break
-            equivalence_classes.append(eq_class)
-        assert np.sum([len(eq_class) for eq_class in equivalence_classes]) == len(conflicts)
-        equivalence_lines1 = []
-        equivalence_lines2 = []
-        for eq_class in equivalence_classes:
-            this_conflicts = conflicts[eq_class]
-            equivalence_lines1.append( ll1[np.unique(this_conflicts[:,0])] )
-            equivalence_lines2.append( ll2[np.unique(this_conflicts[:,1])] )
-        if skip_exactly_equal_lines or skip_equal_loggf:
-            if skip_equal_loggf: 
-                equal_fn = lambda x,y: LineList.lines_equal(x,y,dwl_thresh=dwl_thresh,
-                                                            dEP_thresh=dEP_thresh,dgf_thresh=dgf_thresh)
+        indices1, indices2 = matches
+
+        # Conflicts are connected groups of matching lines, ordered by their
+        # first line in ll1
+        order = np.lexsort((indices2, indices1))
+        indices1, indices2 = indices1[order], indices2[order]
+        N1 = len(ll1)
+        graph = sparse.coo_matrix((np.ones(len(indices1)), (indices1, N1 + indices2)),
+                                  shape=(N1 + len(ll2), N1 + len(ll2)))
+        labels = csgraph.connected_components(graph, directed=False)[1][indices1]
+        _, first = np.unique(labels, return_index=True)
+        group_order = labels[np.sort(first)]
+        group_lines1 = _group_indices(labels, indices1)
+        group_lines2 = _group_indices(labels, indices2)
+        groups = [(group_lines1[label], group_lines2[label]) for label in group_order]
+
+        if (skip_exactly_equal_lines or skip_equal_loggf) and len(groups) > 0:
+            # Skip conflicts where all lines are equal (in order)
+            same_size = [k for k, (x, y) in enumerate(groups) if len(x) == len(y)]
+            x = np.hstack([groups[k][0] for k in same_size] + [np.zeros(0, dtype=int)])
+            y = np.hstack([groups[k][1] for k in same_size] + [np.zeros(0, dtype=int)])
             if skip_exactly_equal_lines: #overwrite skip_equal_loggf
-                equal_fn = lambda x,y: LineList.lines_exactly_equal(x,y)
-
-            _drop_indices = []
-            for i,(x,y) in enumerate(zip(equivalence_lines1,equivalence_lines2)):
-                if len(x)==1 and len(y)==1 and equal_fn(x[0],y[0]):
-                    _drop_indices.append(i)
-                elif len(x)==len(y): # check for identical HFS/molecule blocks
-                    for _x, _y in zip(x,y):
-                        if not equal_fn(_x, _y): break
-                    else: #all equal
-                        _drop_indices.append(i)
-            equivalence_lines1 = [v for i,v in enumerate(equivalence_lines1) if i not in _drop_indices]
-            equivalence_lines2 = [v for i,v in enumerate(equivalence_lines2) if i not in _drop_indices]
+                equal = _lines_exactly_equal(ll1, x, ll2, y)
+            else:
+                equal = _lines_equal(ll1, x, ll2, y, dwl_thresh=dwl_thresh,
+                                     dEP_thresh=dEP_thresh, dgf_thresh=dgf_thresh)
+            keep = np.ones(len(groups), dtype=bool)
+            if len(same_size) > 0:
+                sizes = [len(groups[k][0]) for k in same_size]
+                num_unequal = np.add.reduceat(~equal, np.cumsum([0] + sizes[:-1]))
+                keep[same_size] = num_unequal > 0
+            groups = [group for group, _keep in zip(groups, keep) if _keep]
+
+        equivalence_lines1 = [ll1[x] for x, y in groups]
+        equivalence_lines2 = [ll2[y] for x, y in groups]
         if swap: return equivalence_lines2, equivalence_lines1
         return equivalence_lines1, equivalence_lines2
 
@@ -263,68 +519,77 @@ class LineList(Table):
             if not in_place:
                 return new_ll.copy()
             else:
-                n_cols = len(new_ll.colnames)
-                names = new_ll.colnames
-                dtype = [None] * n_cols
-                self._init_indices = self._init_indices and new_ll._copy_indices
-                self._init_from_table(new_ll, names, dtype, n_cols, True)
+                self._replace_data(new_ll)
                 return None
 
         if ignore_conflicts:
             if self.verbose:
                 print("Ignoring conflicts: adding {} lines".format(len(new_ll)))
+            combined = table.vstack([self, new_ll])
             if not in_place:
-                return table.vstack([self, new_ll])
-            else:
-                #combined = table.vstack([self, new_ll])
-                #names = combined.colnames
-                #dtype = [None] * n_cols
-                #self._init_indices = self._init_indices and combined._copy_indices
-                #self._init_from_table(combined, names, dtype, n_cols, True)
-                #return None
-                raise NotImplementedError
+                return combined
+            self._replace_data(combined, copy=False)
+            return None
         num_in_list = 0
         num_with_multiple_conflicts = 0
-        lines_to_add = []
 
-        for j,new_line in enumerate(new_ll):
-            index = self.find_match(new_line,thresh)
-            if index==-1: # New Line
-                lines_to_add.append(new_line)
-            elif raise_exception: # Record all conflicts later
-                pass
-            else: # use self.pick_best_line to find best line
-                if index < -1:
+        # Find all matches at once
+        matches, new_matches = _match_lines(self, new_ll, thresh, self.default_expot_thresh)
+        num_matches = np.bincount(new_matches, minlength=len(new_ll))
+        lines_to_add = new_ll[num_matches == 0]
+
+        # Lines to overwrite, and the new lines to overwrite them with
+        replace, replace_with = [], []
+        if not raise_exception: # use self.pick_best_line to find best line
+            match_starts = np.cumsum(num_matches) - num_matches
+            if skip_exactly_equal_lines:
+                # Lines that are already in this list are skipped
+                in_list = np.in1d(np.asarray(new_ll['hash']), np.asarray(self['hash']))
+            else:
+                in_list = np.zeros(len(new_ll), dtype=bool)
+            for j in np.flatnonzero(num_matches):
+                if in_list[j]:
+                    num_in_list += 1
+                    continue
+                if num_matches[j] > 1:
                     num_with_multiple_conflicts += 1
-                    index = self.pick_best_line(new_line,thresh)
+                    indices = matches[match_starts[j]:match_starts[j] + num_matches[j]]
+                    index = self.pick_best_line(new_ll[j],thresh,indices=indices)
                     # index < 0 is the convention that you should just skip the line rather than overwriting
                     if index < 0: continue 
-                    if override_current:
-                        self[index] = new_line
-                elif index >= 0:
+                else:
                     num_in_list += 1
-                    if override_current:
-                        self[index] = new_line
+                    index = matches[match_starts[j]]
+                if override_current:
+                    replace.append(index)
+                    replace_with.append(j)
+
+        new_data = self if in_place else self.copy()
+        if len(replace) > 0:
+            for name in new_data.colnames:
+                new_data[name][replace] = new_ll[name][replace_with]
+            new_data.reset_wavelength_index()
+
         num_lines_added = len(lines_to_add)
         if add_new_lines and len(lines_to_add) > 0:
+            # One concatenation, instead of growing the table a row at a time
+            # During the vstack creates an empty LineList and warns
+            combined = table.vstack([new_data, Table(lines_to_add)])
             if in_place:
-                for line in lines_to_add:
-                    self.add_row(line)
+                self._replace_data(combined, copy=False)
             else:
-                new_lines = Table(rows=lines_to_add,names=lines_to_add[0].colnames)
-                old_lines = self.copy()
-                # During the vstack creates an empty LineList and warns
-                new_data = table.vstack([old_lines,new_lines])
-        else:
-            if not in_place:
-                new_data = self.copy()
+                new_data = combined
         
         # Note: if in_place == True, then it merges new lines BEFORE raising the exception
         if raise_exception:
+            # The matches can be reused if this list has not changed
+            reuse = (thresh == .1) and (self.default_expot_thresh == .01) \
+                and not (in_place and add_new_lines and len(lines_to_add) > 0)
             conflicts1,conflicts2 = self.identify_conflicts(self,new_ll,
                                                             skip_exactly_equal_lines=skip_exactly_equal_lines,
                                                             skip_equal_loggf=skip_equal_loggf,
-                                                            dwl_thresh=thresh, dgf_thresh=loggf_thresh)
+                                                            dwl_thresh=thresh, dgf_thresh=loggf_thresh,
+                                                            matches=(matches, new_matches) if reuse else None)
             if len(conflicts1) > 0:
                 raise LineListConflict(conflicts1, conflicts2)
         if self.verbose:
@@ -336,8 +601,68 @@ class LineList(Table):
             return LineList(new_data)
         else:
             return None
+
+    def _replace_data(self, new_data, copy=True):
+        """
+        Replace all of the columns of this LineList (in place) with those of another table
+        """
+        names = new_data.colnames
+        dtype = [None] * len(names)
+        self._init_indices = self._init_indices and new_data._copy_indices
+        self._init_from_table(new_data, names, dtype, len(names), copy)
+        self.reset_wavelength_index()
+
+    def __setitem__(self, item, value):
+        super(LineList, self).__setitem__(item, value)
+        self.reset_wavelength_index()
+
+    def sort(self, *args, **kwargs):
+        self.reset_wavelength_index()
+        return super(LineList, self).sort(*args, **kwargs)
+
+    def reverse(self):
+        self.reset_wavelength_index()
+        return super(LineList, self).reverse()
+
+    def insert_row(self, *args, **kwargs):
+        self.reset_wavelength_index()
+        return super(LineList, self).insert_row(*args, **kwargs)
+
+    def remove_rows(self, *args, **kwargs):
+        self.reset_wavelength_index()
+        return super(LineList, self).remove_rows(*args, **kwargs)
+
+    def wavelength_index(self):
+        """
+        Return the indices that sort the lines by wavelength, and the sorted wavelengths.
+        The index is built on first use and dropped whenever the LineList changes
+        (setting rows or columns, sorting, reversing, adding or removing rows, merging).
+        Writing into a column directly (e.g. ll['wavelength'][i] = w) bypasses the
+        LineList, so call reset_wavelength_index() after doing that
+        """
+        index = getattr(self, '_wavelength_index', None)
+        if index is None or len(index[0]) != len(self):
+            wl = np.asarray(self['wavelength'])
+            sorter = np.argsort(wl, kind='mergesort')
+            index = self._wavelength_index = (sorter, wl[sorter])
+        return index
+
+    def reset_wavelength_index(self):
+        self._wavelength_index = None
+
+    def in_wavelength_range(self, lower, upper, return_indices=False):
+        """
+        Return the lines with lower <= wavelength <= upper (in their original order),
+        found by a binary search of the sorted wavelength index.
+
+        return_indices:
+            If True, return the indices of the lines instead of a LineList
+        """
+        sorter, wl = self.wavelength_index()
+        indices = np.sort(sorter[wl.searchsorted(lower, side='left'):wl.searchsorted(upper, side='right')])
+        return indices if return_indices else self[indices]
         
-    def pick_best_line(self,new_line,thresh):
+    def pick_best_line(self,new_line,thresh,indices=None):
         """
         Given a line and assuming there are multiple matches, pick the best line.
         By default picks line closest in wavelength.
@@ -345,8 +670,13 @@ class LineList(Table):
         The convention is to return -1 if you want to skip the line.
         (This is so if you replace this function with some sort of interactive
         line picking, you can choose to not replace any lines.)
+
+        indices:
+            The indices of the lines that match new_line, if they are already
+            known (e.g., during a merge). Otherwise they are found here.
         """
-        indices = self.find_match(new_line,thresh=thresh,return_multiples=True)
+        if indices is None:
+            indices = self.find_match(new_line,thresh=thresh,return_multiples=True)
         if isinstance(indices,int): return -1 #Only one match, skip
         assert len(indices) >= 2
         matches = self[indices]
@@ -413,14 +743,11 @@ class LineList(Table):
         # The idea here is that you can increase the threshold to see if you were too weak in finding duplicates
         # This is not useful if you have molecular lines (e.g. carbon) because there are too many collisions
         if thresh==None: thresh = self.default_thresh
-        duplicate_indices = []
-        mask = np.ones(len(self),dtype=bool)
-        # This is really inefficient and can likely be redone
-        for i,line in enumerate(self):
-            matches = self.find_match(line,thresh=thresh,return_multiples=True)
-            if len(matches) > 1: duplicate_indices.append(i)
-        duplicate_lines = self[np.array(duplicate_indices)]
-        return duplicate_indices,duplicate_lines
+        # Every line matches itself
+        _, matches = _match_lines(self, self, thresh, self.default_expot_thresh)
+        duplicate_indices = np.flatnonzero(np.bincount(matches, minlength=len(self)) > 1)
+        duplicate_lines = self[duplicate_indices]
+        return list(duplicate_indices),duplicate_lines
 
     def remove_exact_duplicates(self, in_place=False):
         """
@@ -438,12 +765,31 @@ class LineList(Table):
         return self[ix]
 
 
+    _hash_format = "{:.3f}_{:.3f}_{:.3f}_{}_{}_{}_{}_{}"
+    _hash_colnames = ['wavelength','expot','loggf','elem1','elem2','ion','isotope1','isotope2']
+    # Same as _hash_format for unmasked values, but %-formatting a native str is faster
+    _fast_hash_format = str("%.3f_%.3f_%.3f_%s_%s_%s_%s_%s")
+
     @staticmethod
     def hash(line):
-        s = "{:.3f}_{:.3f}_{:.3f}_{}_{}_{}_{}_{}".format(line['wavelength'],line['expot'],line['loggf'],
-                                                         line['elem1'],line['elem2'],line['ion'],line['isotope1'],line['isotope2'])
+        s = LineList._hash_format.format(*[line[col] for col in LineList._hash_colnames])
         return md5.new(s).hexdigest()
 
+    @staticmethod
+    def compute_hashes(lines):
+        """
+        Return the hashes of many lines (a table or LineList). This is the same
+        as calling LineList.hash for every line, but the columns are converted
+        in bulk instead of going through each Row.
+        """
+        columns = [lines[col] for col in LineList._hash_colnames]
+        if any([isinstance(col, MaskedColumn) and np.any(col.mask) for col in columns]):
+            # Masked values are formatted differently
+            return [LineList.hash(line) for line in lines]
+        fmt = LineList._fast_hash_format
+        return [md5.new(fmt % values).hexdigest() \
+                for values in zip(*[np.asarray(col).tolist() for col in columns])]
+
     @staticmethod
     def lines_equal(l1,l2,dwl_thresh=.001,dEP_thresh=.01,dgf_thresh=.001):
         dwl = np.abs(l1['wavelength']-l2['wavelength'])
@@ -472,27 +818,8 @@ class LineList(Table):
         nans = np.zeros(N) + np.nan
         empty = np.array(["" for x in range(N)])
 
-        spec2element = {}
-        spec2elem1= {}
-        spec2elem2= {}
-        spec2iso1 = {}
-        spec2iso2 = {}
-        spec2ion  = {}
-        for this_species in np.unique(species):
-            spec2element[this_species] = species_to_element(this_species)
-            _e1, _e2, _i1, _i2, _ion = species_to_elems_isotopes_ion(this_species)
-            spec2elem1[this_species] = _e1
-            spec2elem2[this_species] = _e2
-            spec2iso1[this_species] = _i1
-            spec2iso2[this_species] = _i2
-            spec2ion[this_species] = _ion
-        numelems = np.array([2 if x >= 100 else 1 for x in species])
-        elements = [spec2element[this_species] for this_species in species]
-        elem1 = [spec2elem1[this_species] for this_species in species]
-        elem2 = [spec2elem2[this_species] for this_species in species]
-        isotope1 = [spec2iso1[this_species] for this_species in species]
-        isotope2 = [spec2iso2[this_species] for this_species in species]
-        ion  = [spec2ion[this_species] for this_species in species]
+        numelems, elements, elem1, isotope1, elem2, isotope2, ion \
+            = _species_columns(species)
 
         # Fill required non-MOOG fields with nan
         data = [wavelength, species, expot, loggf, nans, nans, empty,
@@ -515,17 +842,151 @@ class LineList(Table):
 
         if not os.path.exists(filename):
             raise IOError("No such file or directory: {}".format(filename))
+
+        # Reuse the binary cache of this file if it is up to date.
+        # Filters are applied to the cached list, but a filtered read never
+        # writes the cache (that needs the whole file).
+        cache = kwargs.pop('cache', True)
+        filters = dict([(key, kwargs.pop(key)) for key in ('wavelength_range', 'species', 'loggf_range') \
+                        if kwargs.get(key, None) is not None])
+        if cache:
+            ll = cls.read_cache(filename, **kwargs)
+            if ll is not None:
+                return ll.filter_lines(**filters) if filters else ll
+
         for reader in [cls.read_moog, cls.read_GES]:
             try:
-                return reader(filename,**kwargs)
+                ll = reader(filename,**dict(kwargs, **filters))
             except (IOError, KeyError, UnicodeDecodeError) as e:
                 # KeyError: Issue #87
                 # UnicodeDecodeError: read_moog fails this way for fits
                 pass
+            else:
+                if cache and not filters:
+                    ll.write_cache(filename, kwargs.get('moog_columns', False))
+                return ll
         raise IOError("Cannot identify linelist format (specify format if possible)")
 
+    # Increase this if the columns of the line list readers (or the cache
+    # format) change
+    _cache_version = 2
+
+    @staticmethod
+    def cache_path(filename, moog_columns=False):
+        """
+        The binary cache of a line list file is a hidden directory next to it,
+        with one .npy file per column and an index.json
+        """
+        directory, basename = os.path.split(os.path.abspath(filename))
+        return os.path.join(directory, ".{}{}.llcache".format(
+                basename, ".moog" if moog_columns else ""))
+
     @classmethod
-    def read_moog(cls,filename,moog_columns=False,**kwargs):
+    def _cache_key(cls, filename, moog_columns=False):
+        stat = os.stat(filename)
+        return {"source": os.path.abspath(filename), "mtime": stat.st_mtime,
+                "size": stat.st_size, "moog_columns": bool(moog_columns),
+                "version": cls._cache_version}
+
+    @classmethod
+    def read_cache(cls, filename, moog_columns=False, **kwargs):
+        """
+        Read a line list from the binary cache of a file. The columns are
+        memory-mapped copy-on-write, so changes are never written back.
+        Returns None if there is no cache, or if the file has changed since
+        the cache was written.
+        """
+        path = cls.cache_path(filename, moog_columns)
+        try:
+            with open(os.path.join(path, "index.json")) as f:
+                index = json.load(f)
+            if index["key"] != cls._cache_key(filename, moog_columns):
+                return None
+            columns = []
+            for i, name in enumerate(index["colnames"]):
+                if name in index["filename_columns"]:
+                    # Cite the filename as it was given, like the readers do
+                    columns.append(Column([filename] * index["length"], name=name, dtype=str))
+                    continue
+                data = np.load(os.path.join(path, "{}.npy".format(i)), mmap_mode="c")
+                if name in index["masked"]:
+                    mask = np.load(os.path.join(path, "{}.mask.npy".format(i)))
+                    columns.append(MaskedColumn(data, name=name, mask=mask, copy=False))
+                else:
+                    columns.append(Column(data, name=name, copy=False))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        return cls(columns, copy=False, moog_columns=moog_columns, **kwargs)
+
+    def write_cache(self, filename, moog_columns=False):
+        """
+        Write the binary cache of the line list read from filename.
+        Failing to write the cache (e.g., in a read-only directory) is not an error.
+        """
+        if any([self[name].dtype.hasobject for name in self.colnames]):
+            logger.debug("Not caching {}: object columns".format(filename))
+            return None
+        path = self.cache_path(filename, moog_columns)
+        index = {"key": self._cache_key(filename, moog_columns),
+                 "colnames": self.colnames, "masked": [], "length": len(self),
+                 "filename_columns": []}
+        try:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.mkdir(path)
+            for i, name in enumerate(self.colnames):
+                col = self[name]
+                # Columns that only cite the filename (e.g., references from
+                # read_moog) depend on how the filename was spelled, so they
+                # are rebuilt when the cache is read
+                if len(self) > 0 and col.dtype.kind in "SU" and not isinstance(col, MaskedColumn) \
+                and np.all(np.asarray(col) == np.array(filename, dtype=col.dtype)):
+                    index["filename_columns"].append(name)
+                    continue
+                np.save(os.path.join(path, "{}.npy".format(i)), np.asarray(col))
+                if isinstance(col, MaskedColumn) and np.any(col.mask):
+                    np.save(os.path.join(path, "{}.mask.npy".format(i)), np.asarray(col.mask))
+                    index["masked"].append(name)
+            # The index is written last, so an incomplete cache is never read
+            with open(os.path.join(path, "index.json"), "w") as f:
+                json.dump(index, f)
+        except (IOError, OSError) as e:
+            logger.info("Could not write line list cache {}: {}".format(path, e))
+        return None
+
+    def filter_lines(self, wavelength_range=None, species=None, loggf_range=None):
+        """
+        Return the lines within a (lower, upper) wavelength range, of some
+        species (ignoring isotopes) and/or within a (lower, upper) loggf range,
+        like the read_moog filters
+        """
+        return self[_filter_mask(np.asarray(self['wavelength']), np.asarray(self['species']),
+                                 wavelength_range, species,
+                                 np.asarray(self['loggf']), loggf_range)]
+
+    @classmethod
+    def read_moog(cls,filename,moog_columns=False,wavelength_range=None,
+                  species=None,loggf_range=None,chunk_size=100000,**kwargs):
+        """
+        Read a MOOG line list. The first four (whitespace-separated) columns
+        are the wavelength, species, excitation potential, and loggf (or gf).
+        Optional fixed-width columns are the VDW damping (characters 40-50),
+        dissociation energy (50-60), equivalent width (60-70) and comments.
+
+        wavelength_range:
+            If given, only read lines within this (lower, upper) range
+
+        species:
+            If given, only read lines of these species (ignoring isotopes)
+
+        loggf_range:
+            If given, only read lines with loggf within this (lower, upper) range
+
+        chunk_size:
+            The file is parsed this many lines at a time, and only the lines
+            that pass the cuts are kept, so huge lists can be cut down
+            without holding the whole file in memory
+        """
         if moog_columns:
             colnames = cls.moog_colnames
             dtypes = cls.moog_dtypes
@@ -533,83 +994,46 @@ class LineList(Table):
             colnames = cls.full_colnames
             dtypes = cls.full_dtypes
     
+        # Parse the file in chunks, so only the lines that pass the cuts are kept
+        all_positive, chunks = True, []
         with open(filename) as f:
-            lines = f.readlines()
-        N = len(lines)
-        wl = np.zeros(N)
-        species = np.zeros(N)
-        EP = np.zeros(N)
-        loggf = np.zeros(N)
-        ew = np.zeros(N) * np.nan
-        damping = np.zeros(N) * np.nan
-        dissoc = np.zeros(N) * np.nan
-        comments = ['' for i in range(N)]
-        # wl, transition, EP, loggf, VDW damping C6, dissociation D0, EW, comments
-        has_header_line = False
-        for i,line in enumerate(lines):
-            s = line.split()
-            try:
-                _wl,_species,_EP,_loggf = map(float,s[:4])
-            except:
-                if i==0:
-                    has_header_line = True
-                    continue
-                else:
-                    raise IOError("Invalid line: {}".format(line))
-            if len(s) > 4:
-                try: damping[i] = float(line[40:50])
-                except: pass
-                
-                try: dissoc[i] = float(line[50:60])
-                except: pass
-                
-                try: 
-                    _ew = float(line[60:70])
-                    # It seems some linelists have -1 in the EW location as a placeholder
-                    if _ew <= 0: 
-                        raise ValueError("EW <= 0: {}".format(_ew))
-                    ew[i] = _ew
-                    comments[i] = line[70:].strip()
-                except:
-                    comments[i] = line[60:].strip()
-            wl[i] = _wl; species[i] = _species; EP[i] = _EP; loggf[i] = _loggf
-        if has_header_line:
-            wl = wl[1:]; species = species[1:]; EP = EP[1:]; loggf = loggf[1:]
-            damping = damping[1:]; dissoc = dissoc[1:]; comments = comments[1:]
-            ew = ew[1:]
+            for i, lines in enumerate(_read_chunks(f, chunk_size)):
+                if i == 0:
+                    try:
+                        tokens = lines[0].split(None, 4)
+                        map(float,tokens[:4])
+                        if len(tokens) < 4: raise ValueError
+                    except ValueError:
+                        # Header line
+                        lines = lines[1:]
+                chunk = _parse_moog_lines(lines, wavelength_range, species, loggf_range)
+                all_positive = all_positive and chunk[0]
+                chunks.append(chunk[1:])
+        if len(chunks) == 0:
+            chunks = [_parse_moog_lines([])[1:]]
+        wl, species, EP, loggf, damping, dissoc, ew = \
+            [np.hstack([chunk[j] for chunk in chunks]) for j in range(7)]
+        comments = list(itertools.chain.from_iterable([chunk[7] for chunk in chunks]))
+        del chunks
         
         # check if gf by assuming there is at least one line with loggf < 0
-        if np.all(loggf >= 0): 
+        if all_positive: 
             loggf = np.log10(loggf)
             # TODO this is the MOOG default, but it may not be a good idea...
             print("Warning: no lines with loggf < 0 in {}, assuming input is gf".format(filename))
+        if loggf_range is not None:
+            keep = _filter_mask(wl, None, loggf=loggf, loggf_range=loggf_range)
+            wl, species, EP, loggf, damping, dissoc, ew = \
+                [x[keep] for x in (wl, species, EP, loggf, damping, dissoc, ew)]
+            comments = [c for c, _keep in zip(comments, keep) if _keep]
         
         # TODO
         # Cite the filename as the reference for now
         refs = [filename for x in wl]
     
         # Species to element
-        spec2element = {}
-        spec2elem1= {}
-        spec2elem2= {}
-        spec2iso1 = {}
-        spec2iso2 = {}
-        spec2ion  = {}
-        for this_species in np.unique(species):
-            spec2element[this_species] = species_to_element(this_species)
-            _e1, _e2, _i1, _i2, _ion = species_to_elems_isotopes_ion(this_species)
-            spec2elem1[this_species] = _e1
-            spec2elem2[this_species] = _e2
-            spec2iso1[this_species] = _i1
-            spec2iso2[this_species] = _i2
-            spec2ion[this_species] = _ion
-        numelems = np.array([2 if x >= 100 else 1 for x in species])
-        elements = [spec2element[this_species] for this_species in species]
-        elem1 = [spec2elem1[this_species] for this_species in species]
-        elem2 = [spec2elem2[this_species] for this_species in species]
-        isotope1 = [spec2iso1[this_species] for this_species in species]
-        isotope2 = [spec2iso2[this_species] for this_species in species]
-        ion  = [spec2ion[this_species] for this_species in species]
+        numelems, elements, elem1, isotope1, elem2, isotope2, ion \
+            = _species_columns(species)
 
         # Fill required non-MOOG fields with nan
         if moog_columns:
@@ -632,7 +1056,15 @@ class LineList(Table):
         return cls(Table(data,names=colnames,dtype=dtypes),moog_columns=moog_columns,**kwargs)
 
     @classmethod
-    def read_GES(cls,filename,moog_columns=False,**kwargs):
+    def read_GES(cls,filename,moog_columns=False,wavelength_range=None,
+                 species=None,loggf_range=None,chunk_size=100000,**kwargs):
+        """
+        Read a GES line list (FITS table).
+
+        wavelength_range, species, loggf_range:
+            If given, only read the lines that pass these cuts (as in read_moog).
+            The table is then read chunk_size rows at a time
+        """
         if moog_columns:
             colnames = cls.moog_colnames
             dtypes = cls.moog_dtypes
@@ -640,38 +1072,21 @@ class LineList(Table):
             colnames = cls.full_colnames
             dtypes = cls.full_dtypes
 
-        tab = Table.read(filename)
+        tab = _read_ges_table(filename, wavelength_range, species, loggf_range, chunk_size)
         wl = tab['LAMBDA']
 
-        elem1 = [x.strip() for x in tab['NAME'][:,0]]
-        elem2 = [x.strip() for x in tab['NAME'][:,1]]
-        numelems = [2 if x=='' else 1 for x in elem2]
+        names = np.asarray(tab['NAME'])
+        elem1 = np.char.strip(names[:,0])
+        elem2 = np.char.strip(names[:,1])
+        numelems = np.where(elem2 == '', 1, 2)
         isotope1 = tab['ISOTOPE'][:,0]
         isotope2 = tab['ISOTOPE'][:,1]
         ion = tab['ION']
 
-        # it turns out to be super slow to loop through all the rows; memoizing helps a bit
-        memo = {}
-        def _get_key(row): 
-            return "{}_{}_{}_{}_{}".format(row['NAME'][0],row['NAME'][1],row['ISOTOPE'][0],row['ISOTOPE'][1],row['ION'])
-        def _get_species(row):
-            key = _get_key(row)
-            if key in memo: return memo[key]
-            species = elems_isotopes_ion_to_species(row['NAME'][0],row['NAME'][1],row['ISOTOPE'][0],row['ISOTOPE'][1],row['ION'])
-            memo[key] = species
-            return species
-        import time
-        start = time.time()
-        species = map(_get_species, tab)
-        print('{:.1f}s to compute species'.format(time.time()-start))
-
-        memo = {}
-        def _get_element(species):
-            if species in memo: return memo[species]
-            element = species_to_element(species)
-            memo[species] = element
-            return element
-        elements = map(_get_element, species)
+        species = _ges_species(names, tab['ISOTOPE'], ion)
+
+        # Each unique species is only converted once
+        elements = _species_columns(species)[1]
 
         expot = tab['E_LOW']
         loggf = tab['LOG_GF']
@@ -688,7 +1103,7 @@ class LineList(Table):
         #ref_concatenator = lambda row: refstr.format(row['LAMBDA_REF'],row['LOG_GF_REF'],row['E_LOW_REF'],row['E_UP_REF'],
         #                                             row['LANDE_REF'],row['RAD_DAMP_REF'],row['STARK_DAMP_REF'],row['VDW_DAMP_REF'])
         #comments = map(ref_concatenator, tab)
-        comments = ['' for row in tab]
+        comments = np.array([''] * len(tab))
 
         refs = tab['LOG_GF_REF']
 
@@ -75,7 +75,8 @@ def optimize_stellar_parameters(initial_guess, transitions, EWs=None,
                                 rt=radiative_transfer.moog,
                                 max_attempts=5, total_tolerance=1e-4, 
                                 individual_tolerances=None, 
-                                maxfev=30, use_nlte_grid=None):
+                                maxfev=30, use_nlte_grid=None,
+                                photosphere_interpolator=None):
     """
     Assumes these are all transitions you want to use for stellar parameters
     Assumes you only want to balance neutral ions against Expot and REW
@@ -83,6 +84,9 @@ def optimize_stellar_parameters(initial_guess, transitions, EWs=None,
     If specify EWs, all EWs are in same order as transitions
 
     initial_guess order : [teff, vt, logg, feh]
+
+    photosphere_interpolator: an existing photosphere interpolator to use.
+        Pass one in when solving many stars so the grid is only loaded once.
     """
     
     if EWs is None:
@@ -95,7 +99,8 @@ def optimize_stellar_parameters(initial_guess, transitions, EWs=None,
     idx_I  = transitions["ion"] == 1
     idx_II = transitions["ion"] == 2
 
-    photosphere_interpolator = photospheres.interpolator()
+    if photosphere_interpolator is None:
+        photosphere_interpolator = photospheres.interpolator()
     parameter_ranges = {
         "teff": (3500, 7000),
         "vt": (0.0, 4.0),
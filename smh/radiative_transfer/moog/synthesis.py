@@ -22,7 +22,7 @@ with resource_stream(__name__, "defaults.yaml") as fp:
 
 
 def synthesize(photosphere, transitions, abundances=None, isotopes=None,
-    verbose=False, twd=None, **kwargs):
+    verbose=False, twd=None, trim_transitions=True, **kwargs):
     """
     Sythesize a stellar spectrum given the model photosphere and list of
     transitions provided. This wraps the MOOG `synth` driver.
@@ -41,13 +41,18 @@ def synthesize(photosphere, transitions, abundances=None, isotopes=None,
 
     :param verbose: [optional]
         Specify verbose flags to MOOG. This is primarily used for debugging.
+
+    :param trim_transitions: [optional]
+        If `dispersion_min` or `dispersion_max` are given, only give MOOG the
+        transitions that are within `opacity_contribution` of the synthesis
+        range. MOOG ignores the others, but its run time grows with the number
+        of transitions.
     """
 
-    # Create a temporary directory and write out the photoshere and transitions.
+    # Create a temporary directory and write out the photoshere.
     path = utils.twd_path(twd=twd,**kwargs)
     model_in, lines_in = path("model.in"), path("lines.in")
     photosphere.write(model_in, format="moog")
-    transitions.write(lines_in, format="moog")
     
     # Load the synth driver template.
     with resource_stream(__name__, "synth.in") as fp:
@@ -86,6 +91,14 @@ def synthesize(photosphere, transitions, abundances=None, isotopes=None,
     kwds.setdefault("dispersion_max", max(transitions["wavelength"]) \
         + kwds["opacity_contribution"] + kwds["dispersion_delta"])
 
+    # Write out the transitions that can contribute to the synthesis.
+    if trim_transitions \
+    and ("dispersion_min" in kwargs or "dispersion_max" in kwargs):
+        transitions = _trim_transitions(transitions,
+            kwds["dispersion_min"] - kwds["opacity_contribution"],
+            kwds["dispersion_max"] + kwds["opacity_contribution"])
+    transitions.write(lines_in, format="moog")
+
     # Parse I/O files (these must be overwritten for us to run things.)
     kwds.update({
         "standard_out": path("synth.std.out"),
@@ -126,6 +139,39 @@ def synthesize(photosphere, transitions, abundances=None, isotopes=None,
     return spectra
 
 
+def _trim_transitions(transitions, lower, upper):
+    """
+    Return the transitions with wavelengths between `lower` and `upper`. All
+    transitions are returned if none are in that range, because MOOG requires
+    at least one transition.
+
+    :param transitions:
+        A table of transitions.
+
+    :param lower:
+        The lowest wavelength to include.
+
+    :param upper:
+        The highest wavelength to include.
+    """
+
+    try:
+        indices = transitions.in_wavelength_range(lower, upper,
+            return_indices=True)
+    except AttributeError:
+        # Not a LineList.
+        wavelength = np.asarray(transitions["wavelength"])
+        indices = np.where((wavelength >= lower) * (wavelength <= upper))[0]
+
+    if indices.size == 0:
+        return transitions
+
+    logger.debug("Synthesizing with {} of {} transitions".format(
+        indices.size, len(transitions)))
+    return transitions[indices] if indices.size < len(transitions) \
+        else transitions
+
+
 def _parse_single_spectrum(lines):
     """
     Parse the header, dispersion and depth information for a single spectrum 
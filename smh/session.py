@@ -9,6 +9,7 @@ from __future__ import (division, print_function, absolute_import,
 __all__ = ["Session"]
 
 import atexit
+import copy
 import logging
 import numpy as np
 import os
@@ -24,8 +25,11 @@ from shutil import copyfile, rmtree
 import astropy.table
 from .linelists import LineList
 from .utils import mkdtemp
-from . import (photospheres, radiative_transfer, specutils, isoutils, utils)
-from .spectral_models import ProfileFittingModel, SpectralSynthesisModel
+from . import (batch, photospheres, radiative_transfer, specutils, isoutils,
+               utils, systematics)
+from .spectral_models import (ProfileFittingModel, SpectralSynthesisModel,
+                              SpectralModelResults)
+from .spectral_models.base import _index_transitions
 from smh.photospheres.abundances import asplund_2009 as solar_composition
 from . import (smh_plotting)
 
@@ -47,6 +51,9 @@ class Session(BaseSession):
     # The default settings path is only defined (hard-coded) here.
     _default_settings_path = os.path.expanduser("~/.smh_session.defaults")
 
+    # The default settings are only re-read when the file changes.
+    _default_settings_cache = None
+
     def __init__(self, spectrum_paths, twd=None, **kwargs):
         """
         Create a new session from input spectra.
@@ -126,24 +133,8 @@ class Session(BaseSession):
 
             # Reconstruct them.
             self.metadata.setdefault("spectral_models", [])
-
-            for state in deconstructed_spectral_models:
-
-                args = [self, state["transition_hashes"]]
-                if state["type"] == "SpectralSynthesisModel":
-                    klass = SpectralSynthesisModel
-                    args.append(state["metadata"]["elements"])
-
-                elif state["type"] == "ProfileFittingModel":
-                    klass = ProfileFittingModel
-
-                else:
-                    raise ValueError("unrecognized spectral model class '{}'"\
-                        .format(state["type"]))
-
-                model = klass(*args)
-                model.metadata = state["metadata"]
-                self.metadata["spectral_models"].append(model)
+            self.metadata["spectral_models"].extend(
+                self._reconstruct_spectral_models(deconstructed_spectral_models))
 
         return None
 
@@ -327,24 +318,11 @@ class Session(BaseSession):
         # Add the spectral models.
         self.metadata.setdefault("spectral_models", [])
 
-        reconstructed_spectral_models = []
-        for state in spectral_model_states:
-
-            args = [self, state["transition_hashes"]]
-            if state["type"] == "SpectralSynthesisModel":
-                klass = SpectralSynthesisModel
-                args.append(state["metadata"]["elements"])
-
-            elif state["type"] == "ProfileFittingModel":
-                klass = ProfileFittingModel
-
-            else:
-                raise ValueError("unrecognized spectral model class '{}'"\
-                    .format(state["type"]))
-
-            model = klass(*args)
-            model.metadata = state["metadata"]
-            reconstructed_spectral_models.append(model)
+        # The merged line list needs to be re-sorted.
+        self.metadata["line_list_argsort_hashes"] = np.argsort(
+            self.metadata["line_list"]["hash"])
+        reconstructed_spectral_models \
+            = self._reconstruct_spectral_models(spectral_model_states)
 
         self.metadata["spectral_models"].extend(reconstructed_spectral_models)
         return len(reconstructed_spectral_models)
@@ -413,29 +391,9 @@ class Session(BaseSession):
             return session
 
         # Reconstruct any spectral models.
-        reconstructed_spectral_models = []
         start = time.time()
-        for state in session.metadata.get("spectral_models", []):
-            start2 = time.time()
-
-            args = [session, state["transition_hashes"]]
-            if state["type"] == "SpectralSynthesisModel":
-                klass = SpectralSynthesisModel
-                args.append(state["metadata"]["elements"])
-
-            elif state["type"] == "ProfileFittingModel":
-                klass = ProfileFittingModel
-
-            else:
-                raise ValueError("unrecognized spectral model class '{}'"\
-                    .format(state["type"]))
-
-            model = klass(*args)
-            model.metadata = state["metadata"]
-            reconstructed_spectral_models.append(model)
-            t2 = time.time()-start2
-            if t2 > 1.0:
-                logger.debug("  Long time to load model {:.3f} {} {} {}\n".format(t2, len(model._transitions), model.elements, model.wavelength))
+        reconstructed_spectral_models = session._reconstruct_spectral_models(
+            session.metadata.get("spectral_models", []))
         logger.debug("Time to reconstruct spectral models: {:.3f}".format(time.time()-start))
         
         # Update the session with the spectral models.
@@ -450,6 +408,49 @@ class Session(BaseSession):
         return session
 
 
+    def _reconstruct_spectral_models(self, states):
+        """
+        Reconstruct spectral models from their serialized states. The
+        transitions of all models are found in the session line list at once,
+        and the models are restored from their saved metadata without
+        repeating the validation done when a model is first created.
+
+        :param states:
+            A list of serialized spectral model states.
+
+        :returns:
+            A list of spectral models.
+        """
+
+        klasses = {
+            "ProfileFittingModel": ProfileFittingModel,
+            "SpectralSynthesisModel": SpectralSynthesisModel
+        }
+        for state in states:
+            if state["type"] not in klasses:
+                raise ValueError("unrecognized spectral model class '{}'"\
+                    .format(state["type"]))
+
+        if not states:
+            return []
+
+        line_list = self.metadata["line_list"]
+        sorter = self.metadata.get("line_list_argsort_hashes", None)
+        if sorter is None or len(sorter) != len(line_list):
+            sorter = self.metadata["line_list_argsort_hashes"] \
+                = np.argsort(line_list["hash"])
+
+        # Index all transitions at once.
+        N = [len(state["transition_hashes"]) for state in states]
+        indices = _index_transitions(line_list, [transition_hash \
+            for state in states for transition_hash in state["transition_hashes"]],
+            sorter)
+        offsets = np.cumsum([0] + N)
+
+        return [klasses[state["type"]].from_state(self, state, indices[a:b]) \
+            for state, a, b in zip(states, offsets[:-1], offsets[1:])]
+
+
     def index_spectral_models(self):
         """
         (Re-)Index the spectral models so that they are linked correctly
@@ -460,6 +461,44 @@ class Session(BaseSession):
             self.metadata["line_list"]["hash"])
         for spectral_model in self.metadata.get("spectral_models", []):
             spectral_model.index_transitions()
+
+        # The results store the transition indices and atomic data.
+        self.update_spectral_model_results()
+        return None
+
+
+    @property
+    def spectral_model_results(self):
+        """
+        Return a columnar store of the results from all spectral models in this
+        session. The store is rebuilt if the list of spectral models changes,
+        and individual rows are updated when spectral models are fit or their
+        flags are changed.
+        """
+
+        spectral_models = self.metadata.get("spectral_models", [])
+        results = getattr(self, "_spectral_model_results", None)
+        if results is None or results.spectral_models != spectral_models:
+            results = self._spectral_model_results \
+                = SpectralModelResults(spectral_models)
+        return results
+
+
+    def update_spectral_model_results(self, spectral_models=None):
+        """
+        Update the columnar store of spectral model results, if it exists.
+
+        :param spectral_models: [optional]
+            The spectral models to update. If `None` is given then all results
+            are rebuilt.
+        """
+
+        results = getattr(self, "_spectral_model_results", None)
+        if results is not None:
+            if spectral_models is None:
+                results.refresh()
+            else:
+                results.update(spectral_models)
         return None
 
 
@@ -486,16 +525,21 @@ class Session(BaseSession):
             and optionally, the indices of those affected spectral models.
         """
 
-        indices = []
-        only = only or (lambda model: True)
-        self.metadata.setdefault("spectral_models", [])
-        for i, spectral_model in enumerate(self.metadata["spectral_models"]):
-            if not only(spectral_model) \
-            or not spectral_model.is_acceptable \
-            or spectral_model.is_upper_limit: continue
+        spectral_models = self.metadata.setdefault("spectral_models", [])
+        results = self.spectral_model_results
 
-            if not spectral_model.apply_quality_constraints(constraints):
-                indices.append(i)
+        # Evaluate the constraints for all models at once.
+        rows = (results["element_index"] == 0) * results["is_first_species"]
+        affected = results["is_acceptable"][rows] \
+            * ~results["is_upper_limit"][rows] \
+            * ~results.meets_quality_constraints(constraints)
+        if only is not None:
+            affected *= np.array([bool(only(spectral_model)) \
+                for spectral_model in spectral_models], dtype=bool)
+
+        indices = [int(i) for i in np.where(affected)[0]]
+        for i in indices:
+            spectral_models[i].is_acceptable = False
 
         N = len(indices)
         return N if not full_output else (N, indices)
@@ -527,8 +571,7 @@ class Session(BaseSession):
 
         except KeyError:
             # Check in defaults.
-            with open(self._default_settings_path, "rb") as fp:
-                default = yaml.load(fp)
+            default = self._default_settings()
 
             try:
                 for key in key_tree:
@@ -537,12 +580,29 @@ class Session(BaseSession):
                 return default_return_value
 
             else:
-                return default
+                # Don't let the cached defaults be changed.
+                return copy.deepcopy(default)
 
         else:
             return value
 
 
+    @classmethod
+    def _default_settings(cls):
+        """
+        Return the default settings. The settings file is only read again if
+        it has been modified since it was last read.
+        """
+
+        path = cls._default_settings_path
+        key = (path, os.path.getmtime(path))
+        if cls._default_settings_cache is None \
+        or cls._default_settings_cache[0] != key:
+            with open(path, "rb") as fp:
+                cls._default_settings_cache = (key, yaml.load(fp))
+        return cls._default_settings_cache[1]
+
+
     def update_default_setting(self, key_tree, value):
         """
         Update a default value in the local settings file.
@@ -566,6 +626,7 @@ class Session(BaseSession):
 
         with open(self._default_settings_path, "w") as fp:
             fp.write(yaml.dump(defaults))
+        Session._default_settings_cache = None
 
         return True
 
@@ -823,43 +884,31 @@ class Session(BaseSession):
         """
 
         # Get the transitions & EWs together from spectral models.
-        ews = []
-        rews = []
-        ew_uncertainties = []
-
-        transition_indices = []
-        spectral_model_indices = []
-
-        filtering = kwargs.pop("filtering",
-            lambda model: model.use_for_stellar_parameter_inference)
-        for i, model in enumerate(self.metadata["spectral_models"]):
+        spectral_models = self.metadata["spectral_models"]
+        results = self.spectral_model_results
 
-            transition_indices.append(model._transition_indices[0])
-            
-            # TODO assert it is a profile model.
-            if filtering(model):
-                spectral_model_indices.append(i)
+        # One row for each spectral model.
+        rows = (results["element_index"] == 0) * results["is_first_species"]
 
-                if model.is_acceptable and not model.is_upper_limit:
-
-                    meta = model.metadata["fitted_result"][-1]
-                    model_ew = meta["equivalent_width"]
+        filtering = kwargs.pop("filtering", None)
+        if filtering is None:
+            selected = results["use_for_stellar_parameter_inference"][rows]
+        else:
+            selected = np.array([bool(filtering(model)) \
+                for model in spectral_models], dtype=bool)
 
-                    ews.append(1e3 * model_ew[0])
-                    rews.append(meta["reduced_equivalent_width"][0])
+        # TODO assert it is a profile model.
+        measured = selected * results["is_acceptable"][rows] \
+            * ~results["is_upper_limit"][rows]
+        ews = np.where(measured, results["equivalent_width"][rows], np.nan)
+        rews = np.where(measured,
+            results["reduced_equivalent_width"][rows], np.nan)
+        ew_uncertainties = np.where(measured,
+            results["equivalent_width_uncertainty"][rows], np.nan)
 
-                    # Get the largest absolute uncertainty.
-                    ew_uncertainties.append(1e3 * np.abs(model_ew[1:]).max())
-
-                else:
-                    ews.append(np.nan)
-                    rews.append(np.nan)
-                    ew_uncertainties.append(np.nan)
-            else:
-                spectral_model_indices.append(np.nan)
-                ews.append(np.nan)
-                rews.append(np.nan)
-                ew_uncertainties.append(np.nan)
+        transition_indices = results["transition_index"][rows]
+        spectral_model_indices = np.where(selected,
+            np.arange(len(spectral_models)), np.nan)
 
 
         if len(ews) == 0 \
@@ -868,8 +917,6 @@ class Session(BaseSession):
 
 
         # Construct a copy of the line list table.
-        transition_indices = np.array(transition_indices)
-        spectral_model_indices = np.array(spectral_model_indices)
         transitions = self.metadata["line_list"][transition_indices].copy()
         transitions["equivalent_width"] = ews
         transitions["reduced_equivalent_width"] = rews
@@ -908,6 +955,10 @@ class Session(BaseSession):
                 .metadata["fitted_result"][-1]["abundance_uncertainties"] \
                     = [propagated_abundance - abundance]
 
+        self.update_spectral_model_results([spectral_models[int(index)] \
+            for index in spectral_model_indices[np.isfinite(
+                spectral_model_indices)]])
+
         transitions["abundance_uncertainty"] = np.nan * np.ones(len(transitions))
         transitions["abundance_uncertainty"][finite] \
             = propagated_abundances - transitions["abundance"][finite]
@@ -1039,13 +1090,105 @@ class Session(BaseSession):
                     zip(spectral_model_indices[finite], abundances, uncertainties):
                 spectral_models[index].metadata["fitted_result"][-1]["abundances"] = [abundance]
                 spectral_models[index].metadata["fitted_result"][-1]["abundance_uncertainties"] = [uncertainty]
+                spectral_models[index].metadata["fitted_result"][-1]["abundance_stellar_parameters"] \
+                    = self.metadata["stellar_parameters"].copy()
+            self.update_spectral_model_results(
+                [spectral_models[index] for index in spectral_model_indices])
         print("Time to measure {} abundances: {:.1f}".format(np.sum(finite), time.time()-start))
         return abundances, uncertainties if calculate_uncertainties else abundances
 
+    def fit_profiles(self, spectral_models=None, **kwargs):
+        """
+        Fit profile models in parallel and update them with the results.
+
+        :param spectral_models: [optional]
+            The spectral models to fit. By default all profile models in the
+            session are fit.
+
+        See `smh.batch.fit_profiles` for the keyword arguments (e.g., the
+        number of processes, progress callbacks, and cancellation).
+        """
+        return batch.fit_profiles(self, spectral_models, **kwargs)
+
+    def refresh_spectral_models(self, spectral_models=None,
+        measure_abundances=True, **kwargs):
+        """
+        Re-fit only the spectral models whose inputs (spectrum, mask, fitting
+        metadata, transitions, or relevant session state) have changed since
+        they were last fit, and re-measure abundances from profile models that
+        were re-fit or were measured with different stellar parameters.
+
+        :param spectral_models: [optional]
+            The spectral models to refresh. By default all spectral models in
+            the session are refreshed.
+
+        :param measure_abundances: [optional]
+            Re-measure the abundances of acceptable profile models.
+
+        Keyword arguments are passed to `smh.batch.fit_profiles`.
+
+        :returns:
+            A two-length tuple containing the spectral models that were re-fit
+            and the profile models whose abundances were re-measured.
+        """
+
+        if spectral_models is None:
+            spectral_models = self.metadata.get("spectral_models", [])
+
+        stale = [model for model in spectral_models if model.is_stale]
+        logger.info("Re-fitting {} of {} spectral models".format(
+            len(stale), len(spectral_models)))
+
+        profile_models = [model for model in stale \
+            if isinstance(model, ProfileFittingModel)]
+        if profile_models:
+            batch.fit_profiles(self, profile_models, **kwargs)
+
+        for model in stale:
+            if isinstance(model, SpectralSynthesisModel):
+                try:
+                    model.fit()
+                except:
+                    logger.exception("Exception in fitting {}".format(model))
+
+        remeasure = []
+        if measure_abundances:
+            for model in spectral_models:
+                if not isinstance(model, ProfileFittingModel) \
+                or not model.is_acceptable \
+                or "fitted_result" not in model.metadata:
+                    continue
+                measured = model.metadata["fitted_result"][2].get(
+                    "abundance_stellar_parameters", None)
+                if measured != self.metadata["stellar_parameters"]:
+                    remeasure.append(model)
+
+            if remeasure:
+                self.measure_abundances(remeasure)
+
+        return (stale, remeasure)
+
+    def propagate_stellar_parameter_uncertainties(self, covariance, **kwargs):
+        """
+        Propagate uncertainties in stellar parameters to the abundances of all
+        acceptable spectral models by Monte Carlo sampling. The systematic
+        uncertainties are saved for each spectral model and each species.
+
+        :param covariance:
+            The covariance matrix of (effective temperature, surface gravity,
+            metallicity, microturbulence).
+
+        See `smh.systematics.propagate_stellar_parameter_uncertainties` for
+        the keyword arguments.
+        """
+        return systematics.propagate_stellar_parameter_uncertainties(
+            self, covariance, **kwargs)
+
     def summarize_spectral_models(self, spectral_models=None, organize_by_element=False,
                                   use_weights = None, use_finite = True):
         """
-        Loop through all spectral_models and return a summary dict
+        Summarize the abundances of all acceptable spectral_models and return
+        a summary dict
 
         Returns:
         summary_dict[key] = [num_models, logeps, stdev, stderr, XH, XFe]
@@ -1065,90 +1208,9 @@ class Session(BaseSession):
             If False, use any acceptable abundances
             I cannot imagine why you'd set it to False unless debugging
         """
-        what_key_type = "element" if organize_by_element else "species"
-
-        start = time.time()
-        if spectral_models is None:
-            spectral_models = self.metadata.get("spectral_models", [])
-
-        all_logeps = {}
-        # TODO abundance uncertainties too
-        def update_one_key(key,logeps):
-            if key not in all_logeps:
-                all_logeps[key] = []
-            all_logeps[key].append(logeps)
-            return
-        for spectral_model in spectral_models:
-            if not spectral_model.is_acceptable or spectral_model.is_upper_limit: continue
-            
-            abundances = spectral_model.abundances
-            if abundances is None: continue
-
-            for elem,species,logeps in zip(spectral_model.elements, \
-                                          spectral_model.species, abundances):
-                # Elements doesn't have the ionization
-                # Species do
-                if organize_by_element:
-                    key = elem
-                else:
-                    key = species
-
-                if isinstance(key,list):
-                    # In synthesis, species may be a list
-                    for species in key:
-                        if isinstance(species,float):
-                            update_one_key(species, logeps)
-                        elif isinstance(species,list):
-                            for _species in species: update_one_key(_species, logeps)
-                        else:
-                            raise TypeError("key {} is of type {} (organized by {})".format(\
-                                    species,type(species),what_key_type))
-                elif isinstance(key,float):
-                    assert not organize_by_element
-                    update_one_key(key, logeps)
-                elif isinstance(key,str):
-                    assert organize_by_element
-                    update_one_key(key, logeps)
-                else:
-                    raise TypeError("key {} is of type {} (organized by {})".format(\
-                            key,type(key),what_key_type))
-
-        summary_dict = {}
-        for key in all_logeps:
-            logepss = np.array(all_logeps[key])
-            if use_finite:
-                finite = np.isfinite(logepss)
-                num_models = np.sum(finite)
-                logepss = logepss[finite]
-            else:
-                num_models = len(logepss)
-
-            logeps = np.mean(logepss)
-            # TODO weight
-            stdev = np.std(logepss)
-            stderr= stdev/np.sqrt(num_models)
-            XH = logeps - solar_composition(key)
-            summary_dict[key] = [num_models, logeps, stdev, stderr, XH, np.nan]
-
-        try:
-            if organize_by_element:
-                FeH = summary_dict['Fe'][4]
-            else:
-                # TODO: using Fe I for now, should make this configurable
-                FeH = summary_dict[26.0][4]
-        except KeyError:
-            # Fe not measured yet
-            FeH = np.nan
-        for key in all_logeps:
-            summary = summary_dict[key]
-            summary[5] = summary[4] - FeH
-            summary_dict[key] = summary
-
-        total_num_models_summarized = np.sum([len(x) for x in all_logeps.values()])
-        ## This is basically instantaneous, which is good!
-        #print("Time to summarize {} measurements (organized by {}): {:.1f}".format(\
-        #        total_num_models_summarized, what_key_type, time.time()-start))
-        return summary_dict
+        results = self.spectral_model_results if spectral_models is None \
+            else SpectralModelResults(spectral_models)
+        return results.summarize(organize_by_element, use_finite)
     
     def export_abundance_table(self, filepath):
         ## TODO: put in upper limits too.
@@ -1181,33 +1243,19 @@ class Session(BaseSession):
         ## TODO: 
         ## Make sure to include synthesis measurements.
         ## We'll eventually put in upper limits too.
-        spectral_models = self.metadata.get("spectral_models", [])
-        linedata = np.zeros((len(spectral_models), 6)) + np.nan
-        for i,spectral_model in enumerate(spectral_models):
-            # TODO include upper limits
-            if not spectral_model.is_acceptable or spectral_model.is_upper_limit: continue
-            # TODO make this work with syntheses as well
-            if isinstance(spectral_model, SpectralSynthesisModel):
-                raise NotImplementedError
-            elif isinstance(spectral_model, ProfileFittingModel):
-                line = spectral_model.transitions[0]
-                wavelength = line['wavelength']
-                species = line['species']
-                expot = line['expot']
-                loggf = line['loggf']
-
-                try:
-                    EW = 1000.*spectral_model.metadata["fitted_result"][2]["equivalent_width"][0]
-                    logeps = spectral_model.abundances[0]
-                except Exception as e:
-                    print(e)
-                    EW = np.nan
-                    logeps = np.nan
-                if EW is None: EW = np.nan
-                if logeps is None: logeps = np.nan
-            else:
-                raise NotImplementedError
-            linedata[i,:] = [species, wavelength, expot, loggf, EW, logeps]
+        results = self.spectral_model_results
+
+        # TODO include upper limits
+        rows = results["is_acceptable"] * ~results["is_upper_limit"]
+        # TODO make this work with syntheses as well
+        if not np.all(results["is_profile"][rows]):
+            raise NotImplementedError
+
+        species = self.metadata["line_list"]["species"][
+            results["transition_index"][rows]]
+        linedata = np.array([species] + [results[column][rows] for column in \
+            ("wavelength", "expot", "loggf", "equivalent_width", "abundance")])\
+            .T.reshape(-1, 6)
         ii_bad = np.logical_or(np.isnan(linedata[:,5]), np.isnan(linedata[:,4]))
         linedata = linedata[~ii_bad,:]
 
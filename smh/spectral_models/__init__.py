@@ -10,6 +10,7 @@ from __future__ import (division, print_function, absolute_import,
 from .base import *
 from .profile import *
 from .synthesis import *
+from .results import *
 
 
 
@@ -8,12 +8,126 @@ from __future__ import (division, print_function, absolute_import,
 
 __all__ = ["BaseSpectralModel"]
 
+import copy
+import hashlib
 import numpy as np
+from six import iteritems, string_types, text_type
 
 from .quality_constraints import constraints
 
+
+def _hashable(value):
+    """
+    Return a hashable representation of a (possibly nested) dictionary, list, or
+    array so that it can be used as part of a cache key.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted(
+            [(str(k), _hashable(v)) for k, v in iteritems(value)]))
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple([_hashable(v) for v in value])
+    if isinstance(value, string_types):
+        return text_type(value)
+    return value
+
+
+def _index_transitions(line_list, transition_hashes, sorter=None):
+    """
+    Return the indices of transitions in a line list, given their hashes.
+
+    :param line_list:
+        The line list.
+
+    :param transition_hashes:
+        The hashes of the transitions to find.
+
+    :param sorter: [optional]
+        The indices that sort the hashes of the line list. These will be
+        calculated if they are not given.
+
+    :raises ValueError:
+        If any of the transition hashes are not in the line list.
+    """
+
+    hashes = np.asarray(line_list["hash"])
+    sorter = np.argsort(hashes) if sorter is None else np.asarray(sorter)
+    transition_hashes = np.asarray(transition_hashes, dtype=hashes.dtype)
+
+    indices = sorter[np.clip(np.searchsorted(hashes, transition_hashes,
+        sorter=sorter), 0, max(0, hashes.size - 1))]
+    missing = hashes[indices] != transition_hashes
+    if np.any(missing):
+        raise ValueError("transition hash '{}' not found in parent session"\
+            .format(transition_hashes[missing][0]))
+    return indices
+
+
+class FittingMetadata(dict):
+
+    # The arrays that show the fit. These are calculated from the fitted result
+    # when they are first needed, and they are never pickled.
+    _derived_keys = ("model_x", "model_y", "model_yerr", "residual")
+
+    def __init__(self, *args, **kwargs):
+        """
+        Metadata from fitting a spectral model. This behaves like a dictionary,
+        except the arrays that show the fit (the model dispersion, flux,
+        flux uncertainty, and residuals) are calculated by the spectral model
+        when they are first accessed, so they do not need to be kept in memory
+        or saved with the session.
+        """
+
+        super(FittingMetadata, self).__init__(*args, **kwargs)
+        self.model = None
+        return None
+
+
+    def __missing__(self, key):
+        model = self.model
+        if key not in self._derived_keys or model is None:
+            raise KeyError(key)
+
+        # Only the current fitted result of a model can be shown.
+        fitted_result = model.metadata.get("fitted_result", None)
+        if fitted_result is None or fitted_result[2] is not self:
+            raise KeyError(key)
+
+        self.update(zip(self._derived_keys, model._fitted_arrays(fitted_result)))
+        return dict.__getitem__(self, key)
+
+
+    def _stored_items(self):
+        """ Return the items that are not calculated on demand. """
+        return [(key, value) for key, value in iteritems(self) \
+            if key not in self._derived_keys]
+
+
+    def __reduce__(self):
+        # Neither the model nor the derived arrays are pickled.
+        return (self.__class__, (), None, None, iter(self._stored_items()))
+
+
+    def __copy__(self):
+        copied = self.__class__(self._stored_items())
+        copied.model = self.model
+        return copied
+
+
+    def __deepcopy__(self, memo):
+        copied = self.__class__(copy.deepcopy(self._stored_items(), memo))
+        copied.model = self.model
+        return copied
+
+
+
 class BaseSpectralModel(object):
 
+    # Metadata that describe the outcome of a fit, or how the result is used,
+    # rather than what goes into the fit.
+    _fingerprint_ignore = ("fitted_result", "is_acceptable", "is_upper_limit",
+        "use_for_stellar_parameter_inference",
+        "use_for_stellar_composition_inference")
+
     def __init__(self, session, transition_hashes, **kwargs):
         """
         Initialize a base class for modelling spectra.
@@ -35,39 +149,132 @@ class BaseSpectralModel(object):
         if len(session.metadata.get("line_list", [])) == 0:
             raise ValueError("session does not have a line list")
 
-        # Validate the transition_hashes
-        transition_hashes = list(transition_hashes)
-        for transition_hash in transition_hashes:
-            if transition_hash not in session.metadata["line_list"]["hash"]:
-                raise ValueError(
-                    "transition hash '{}' not found in parent session"\
-                    .format(transition_hash))
-
         self._session = session
-        self._transition_hashes = transition_hashes
+        self._transition_hashes = list(transition_hashes)
 
-        # Link the .transitions attribute to the parent session.
+        # Link the .transitions attribute to the parent session. This also
+        # validates the transition hashes.
         self.index_transitions()
-        
+
+        elements = self._transition_column("element")
         self.metadata = {
             "is_upper_limit": False,
             "use_for_stellar_composition_inference": True,
             "use_for_stellar_parameter_inference": (
-                "Fe I" in self.transitions["element"] or
-                "Fe II" in self.transitions["element"])
+                "Fe I" in elements or "Fe II" in elements)
         }
+        return None
+
+
+    @classmethod
+    def from_state(cls, session, state, transition_indices=None):
+        """
+        Restore a spectral model from a serialized state (e.g., in a saved
+        session) without repeating the validation done when a model is first
+        created.
 
-        # Create a _repr_wavelength property.
-        if len(self.transitions) == 1:
-            self._repr_wavelength \
-                = "{0:.1f}".format(self.transitions["wavelength"][0])
+        :param session:
+            The session that this spectral model will be associated with.
+
+        :param state:
+            The serialized state of the spectral model.
+
+        :param transition_indices: [optional]
+            The indices of the transitions in the session line list. These will
+            be found from the transition hashes if they are not given.
+        """
+
+        model = cls.__new__(cls)
+        model._session = session
+        model._transition_hashes = list(state["transition_hashes"])
+        if transition_indices is None:
+            model.index_transitions()
         else:
-            self._repr_wavelength \
-                = "~{0:.0f}".format(np.mean(self.transitions["wavelength"]))
-        
+            model._transition_indices = transition_indices
+
+        model.metadata = state["metadata"]
+
+        # The parameter names (and bounds) depend on the metadata, and will be
+        # updated when they are first needed.
+        model._parameter_names, model._parameter_bounds = (None, None)
+        return model
+
+
+    def _representation(self):
+        """
+        Return the wavelength and element(s) that are used to represent this
+        model.
+        """
+
+        wavelengths = self._transition_column("wavelength")
+        if wavelengths.size == 1:
+            wavelength = "{0:.1f}".format(wavelengths[0])
+        else:
+            wavelength = "~{0:.0f}".format(np.mean(wavelengths))
+        return (wavelength, ", ".join(self.elements))
+
+
+    @property
+    def _repr_wavelength(self):
+        """ Return the wavelength used to represent this model. """
+        # Re-index first, in case the session line list has changed.
+        self._transition_indices
+        if self._repr is None:
+            self._repr = self._representation()
+        return self._repr[0]
+
+
+    @property
+    def _repr_element(self):
+        """ Return the element(s) used to represent this model. """
+        self._transition_indices
+        if self._repr is None:
+            self._repr = self._representation()
+        return self._repr[1]
+
+
+    @property
+    def _transition_indices(self):
+        """
+        Return the indices of the transitions in the session line list. The
+        transitions are re-indexed if the line list has changed (e.g., it was
+        sorted, or lines were removed) since they were last indexed.
+        """
+
+        indices = self._indices
+        hashes = np.asarray(self._session.metadata["line_list"]["hash"])
+        if indices.size > 0 and (indices.max() >= hashes.size \
+            or np.any(hashes[indices] != self._transition_hashes)):
+            indices = self.index_transitions()
+        return indices
+
+
+    @_transition_indices.setter
+    def _transition_indices(self, indices):
+        """
+        Set the indices of the transitions in the session line list.
+
+        :param indices:
+            The indices of the transitions.
+        """
+        self._indices = np.asarray(indices, dtype=int)
+        self._transitions, self._repr = (None, None)
         return None
 
 
+    def _transition_column(self, name):
+        """
+        Return the values of a column for the transitions associated with this
+        model, without creating a table of the transitions.
+
+        :param name:
+            The name of the column.
+        """
+
+        return np.asarray(
+            self._session.metadata["line_list"][name])[self._transition_indices]
+
+
     @property
     def wavelength(self):
         """
@@ -75,8 +282,9 @@ class BaseSpectralModel(object):
         occurs.
         """
 
-        wavelength = np.mean(self.transitions["wavelength"])
-        return int(wavelength) if len(self.transitions) > 1 else wavelength
+        wavelengths = self._transition_column("wavelength")
+        wavelength = np.mean(wavelengths)
+        return int(wavelength) if wavelengths.size > 1 else wavelength
 
 
     @property
@@ -96,6 +304,7 @@ class BaseSpectralModel(object):
         decision = bool(decision)
         if not decision or (decision and "fitted_result" in self.metadata):
             self.metadata["is_acceptable"] = bool(decision)
+        self._update_session_results()
         return None
 
 
@@ -114,6 +323,7 @@ class BaseSpectralModel(object):
             A boolean flag.
         """
         self.metadata["is_upper_limit"] = bool(decision)
+        self._update_session_results()
         return None
 
 
@@ -136,6 +346,7 @@ class BaseSpectralModel(object):
             A boolean flag.
         """
         self.metadata["use_for_stellar_parameter_inference"] = bool(decision)
+        self._update_session_results()
         return None
 
 
@@ -159,6 +370,7 @@ class BaseSpectralModel(object):
             A boolean flag.
         """
         self.metadata["use_for_stellar_composition_inference"] = bool(decision)
+        self._update_session_results()
         return None
 
 
@@ -205,49 +417,81 @@ class BaseSpectralModel(object):
             self._session.setting(("spectral_model_quality_constraints", )) or {})
 
 
+    @property
+    def metadata(self):
+        """ Return the metadata associated with this spectral model. """
+        return self._metadata
+
+
+    @metadata.setter
+    def metadata(self, metadata):
+        """
+        Set the metadata associated with this spectral model.
+
+        :param metadata:
+            A dictionary of metadata.
+        """
+
+        self._metadata = metadata
+
+        # Link any fitting metadata to this model, so that the arrays that show
+        # the fit can be calculated when they are needed.
+        try:
+            fitting_metadata = metadata["fitted_result"][2]
+        except (KeyError, IndexError, TypeError):
+            None
+        else:
+            if isinstance(fitting_metadata, FittingMetadata):
+                fitting_metadata.model = self
+        return None
+
+
+    def _update_session_results(self):
+        """ Update the results of this model in the parent session. """
+        try:
+            update = self._session.update_spectral_model_results
+        except AttributeError:
+            return None
+        return update([self])
+
+
     @property
     def transitions(self):
         """ Return the transitions associateed with this class. """
 
         # This is left as a property to prevent users from arbitrarily setting
-        # the .transitions attribute.
+        # the .transitions attribute. The table is only created when needed.
+        indices = self._transition_indices
+        if self._transitions is None:
+            self._transitions = self._session.metadata["line_list"][indices]
         return self._transitions
 
 
     def index_transitions(self):
         """
-        Index the transitions to the parent session.
-        
-        This step is very slow for large linelists.
-        """
-
-        #if len(self._transition_hashes) < 50:
-        #if True:
-        if False:
-            ## Brute force loop for small N
-            indices = np.zeros(len(self._transition_hashes), dtype=int)
-            for i, each in enumerate(self._transition_hashes):
-                index = np.where(
-                    self._session.metadata["line_list"]["hash"] == each)[0]
-                #assert len(index) == 1, len(index)
-                if len(index) != 1: 
-                    #print("WARNING: hash {} appears {} times in session linelist".format(each,len(index)))
-                    index = index[0]
-                indices[i] = index
-        else:
-            ## Use searchsorted binary search, speeds up by ~1.8x
-            #iisort = np.argsort(self._session.metadata["line_list"]["hash"])
-            iisort = self._session.metadata["line_list_argsort_hashes"]
-            sorted = np.searchsorted(self._session.metadata["line_list"]["hash"],
-                                     self._transition_hashes,
-                                     sorter=iisort)
-            indices = iisort[sorted]
-            ## Check for correctness, i.e. all hashes are actually in linelist
-            assert np.all(self._transition_hashes == self._session.metadata["line_list"]["hash"][indices])
+        Index the transitions to the parent session. The table of transitions
+        is only created when it is first needed.
+        """
 
-        self._transition_indices = indices
-        self._transitions = self._session.metadata["line_list"][indices]
+        line_list = self._session.metadata["line_list"]
+        sorter = self._session.metadata.get("line_list_argsort_hashes", None)
+        indices = None
+        if sorter is not None and len(sorter) == len(line_list):
+            try:
+                indices = _index_transitions(
+                    line_list, self._transition_hashes, sorter)
+            except ValueError:
+                # The sorted hashes may be out of date (e.g., if the line list
+                # was sorted in place).
+                None
+
+        if indices is None:
+            sorter = self._session.metadata["line_list_argsort_hashes"] \
+                = np.argsort(line_list["hash"])
+            indices = _index_transitions(
+                line_list, self._transition_hashes, sorter)
 
+        self._transition_indices = indices
         return indices
 
 
@@ -277,6 +521,55 @@ class BaseSpectralModel(object):
             return None
         
 
+    def _fingerprint_state(self):
+        """
+        Return the state of the parent session that a fit depends on, other
+        than the spectrum. Sub-classes should extend this as necessary.
+        """
+        return ()
+
+
+    def fingerprint(self, spectrum=None):
+        """
+        Return a fingerprint of everything that a fit of this model depends on:
+        the unmasked pixels of the spectrum, the fitting metadata, the
+        transitions, and any relevant state of the parent session.
+
+        :param spectrum: [optional]
+            The observed spectrum. If None is given, this will default to the
+            normalized rest-frame spectrum in the parent session.
+        """
+
+        spectrum = spectrum or self.session.normalized_spectrum
+
+        # Sessions store the normalized spectrum to four decimal places, so
+        # the fingerprint should not change when a session is re-loaded.
+        digest = hashlib.md5()
+        for array in self.windowed_data(spectrum)[:3]:
+            digest.update(np.round(array.astype(float), 4))
+        digest.update(self.transitions.as_array().tobytes())
+
+        metadata = dict([(k, v) for k, v in iteritems(self.metadata) \
+            if k not in self._fingerprint_ignore])
+        digest.update(repr(_hashable(
+            (metadata, self._fingerprint_state()))).encode("utf-8"))
+        return digest.hexdigest()
+
+
+    @property
+    def is_stale(self):
+        """
+        Return whether this model needs to be fit again because it has not been
+        fit, or because something it depends on has changed since the fit.
+        """
+
+        try:
+            fingerprint = self.metadata["fitted_result"][2]["fingerprint"]
+        except (KeyError, IndexError):
+            return True
+        return fingerprint != self.fingerprint()
+
+
     @property
     def parameters(self):
         """
@@ -290,12 +583,16 @@ class BaseSpectralModel(object):
     @property
     def parameter_bounds(self):
         """ Return the fitting limits on the parameters. """
+        if self._parameter_bounds is None:
+            self._update_parameter_names()
         return self._parameter_bounds
 
 
     @property
     def parameter_names(self):
         """ Return the model parameter names. """
+        if self._parameter_names is None:
+            self._update_parameter_names()
         return self._parameter_names
 
 
@@ -355,42 +652,104 @@ class BaseSpectralModel(object):
         return spectrum
 
 
-    def mask(self, spectrum):
+    def window(self, spectrum):
         """
-        Return a pixel mask based on the metadata and existing mask information
-        available.
+        Resolve the fitting window and any masked regions of this model to
+        ranges of pixels in the spectrum. The dispersion points of the spectrum
+        are assumed to be sorted. The result is cached until the spectrum, the
+        window, or the masked regions change.
 
         :param spectrum:
-            A spectrum to generate a mask for.
+            A spectrum to resolve the window for.
+
+        :returns:
+            A slice of the spectrum that contains all the pixels used by this
+            model, and a boolean array over the slice that indicates which
+            pixels are used (or `None` if all pixels in the slice are used).
         """
 
         # HACK
         if "antimask_flag" not in self.metadata:
             self.metadata["antimask_flag"] = False
+
+        dispersion = spectrum.dispersion
+        wavelengths = self._transition_column("wavelength")
+        key = (dispersion.size, dispersion[0], dispersion[-1],
+            wavelengths[0], wavelengths[-1], self.metadata.get("window", None),
+            self.metadata["antimask_flag"], _hashable(self.metadata["mask"]))
+
+        cached = getattr(self, "_window_cache", None)
+        if cached is not None and cached[0] is dispersion and cached[1] == key:
+            return cached[2]
+
+        regions = [(dispersion.searchsorted(start, side="left"),
+            dispersion.searchsorted(end, side="right")) \
+            for start, end in self.metadata["mask"]]
+
         if self.metadata["antimask_flag"]:
-            antimask = np.ones_like(spectrum.dispersion,dtype=bool)
-            for start, end in self.metadata["mask"]:
-                antimask *= ~((spectrum.dispersion >= start) \
-                            * (spectrum.dispersion <= end))
-            return ~antimask
-
-        window = abs(self.metadata["window"])
-        wavelengths = self.transitions["wavelength"]
-        try:
-            lower_wavelength = wavelengths[0]
-            upper_wavelength = wavelengths[-1]
-        except IndexError:
-            # Single row.
-            lower_wavelength, upper_wavelength = (wavelengths, wavelengths)
+            # Only the masked regions are used.
+            regions = [(lower, upper) for lower, upper in regions \
+                if upper > lower]
+            if not regions:
+                window, pixels = (slice(0, 0), None)
+            else:
+                window = slice(min(regions)[0], max([u for l, u in regions]))
+                pixels = np.zeros(window.stop - window.start, dtype=bool)
+                for lower, upper in regions:
+                    pixels[lower - window.start:upper - window.start] = True
+
+        else:
+            size = abs(self.metadata["window"])
+            window = slice(
+                dispersion.searchsorted(wavelengths[0] - size, side="left"),
+                dispersion.searchsorted(wavelengths[-1] + size, side="right"))
 
-        mask = (spectrum.dispersion >= lower_wavelength - window) \
-             * (spectrum.dispersion <= upper_wavelength + window)
+            # Any masked ranges specified in the metadata?
+            pixels = None
+            for lower, upper in regions:
+                lower, upper = (max(lower, window.start), min(upper, window.stop))
+                if upper > lower:
+                    if pixels is None:
+                        pixels = np.ones(window.stop - window.start, dtype=bool)
+                    pixels[lower - window.start:upper - window.start] = False
 
-        # Any masked ranges specified in the metadata?
-        for start, end in self.metadata["mask"]:
-            mask *= ~((spectrum.dispersion >= start) \
-                     * (spectrum.dispersion <= end))
+        self._window_cache = (dispersion, key, (window, pixels))
+        return (window, pixels)
+
+
+    def windowed_data(self, spectrum):
+        """
+        Return the data used by this model.
+
+        :param spectrum:
+            The observed spectrum.
+
+        :returns:
+            The dispersion, flux, and inverse variance of the pixels used by
+            this model, and the indices of those pixels in the spectrum. If no
+            regions are masked then the arrays are views of the spectrum.
+        """
+
+        window, pixels = self.window(spectrum)
+        data = [spectrum.dispersion[window], spectrum.flux[window],
+            spectrum.ivar[window], np.arange(window.start, window.stop)]
+        if pixels is not None:
+            data = [each[pixels] for each in data]
+        return tuple(data)
+
+
+    def mask(self, spectrum):
+        """
+        Return a pixel mask based on the metadata and existing mask information
+        available.
+
+        :param spectrum:
+            A spectrum to generate a mask for.
+        """
 
+        window, pixels = self.window(spectrum)
+        mask = np.zeros(spectrum.dispersion.size, dtype=bool)
+        mask[window] = True if pixels is None else pixels
         return mask
 
 
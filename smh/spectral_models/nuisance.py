@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Fast application of nuisance operations to model spectra. """
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+__all__ = ["NuisanceKernel"]
+
+import numpy as np
+from scipy import ndimage
+
+
+class NuisanceKernel(object):
+
+    # km/s
+    _speed_of_light = 299792.458
+
+    # The maximum number of smoothing kernels to keep.
+    _maximum_cached_weights = 100
+
+    def __init__(self, model_dispersion, dispersion, continuum_order=-1,
+        left=None, right=None):
+        """
+        A kernel to apply nuisance operations (a multiplicative continuum,
+        Gaussian smoothing, and a Doppler shift) to model spectra that are
+        calculated on a fixed dispersion grid, and to evaluate them at fixed
+        dispersion points. This is equivalent to:
+
+            continuum = np.polyval(coefficients[::-1], model_dispersion)
+            y = ndimage.gaussian_filter1d(flux * continuum, sigma)
+            np.interp(dispersion, model_dispersion * (1 + v/c), y, left, right)
+
+        but everything that only depends on the dispersion grids is calculated
+        once, only the pixels that are needed are smoothed, and many parameter
+        vectors can be evaluated at once.
+
+        :param model_dispersion:
+            The dispersion points of the model spectra.
+
+        :param dispersion:
+            The dispersion points to evaluate the model spectra at.
+
+        :param continuum_order: [optional]
+            The order of the continuum polynomial. If negative then no
+            continuum is applied.
+
+        :param left: [optional]
+            The value to return for points bluer than the model dispersion. By
+            default this is the first model value.
+
+        :param right: [optional]
+            The value to return for points redder than the model dispersion. By
+            default this is the last model value.
+        """
+
+        self.model_dispersion = np.asarray(model_dispersion, dtype=float)
+        self.dispersion = np.asarray(dispersion, dtype=float)
+        self.continuum_order = continuum_order
+        self.left, self.right = (left, right)
+
+        M = self.model_dispersion.size
+        if 2 > M:
+            raise ValueError("at least two model dispersion points required")
+
+        # The mean pixel size, for converting smoothing widths to pixels.
+        self.pixel_scale = np.mean(np.diff(self.model_dispersion))
+
+        # Continuum coefficients are in increasing order of power.
+        self._vander = np.vander(self.model_dispersion, continuum_order + 1,
+            increasing=True) if continuum_order >= 0 else None
+
+        # On a uniform grid the pixel positions can be calculated directly.
+        start, end = self.model_dispersion[[0, -1]]
+        self._step = (end - start)/(M - 1)
+        self._uniform = np.allclose(self.model_dispersion,
+            start + self._step * np.arange(M), rtol=0, atol=1e-6 * self._step)
+
+        self._weights = {}
+        self._locations = {}
+        return None
+
+
+    def matches(self, model_dispersion, dispersion, continuum_order=-1):
+        """
+        Return whether this kernel can be used for the given dispersion points
+        and continuum order.
+        """
+
+        def same(a, b):
+            return a is b or (np.shape(a) == np.shape(b) \
+                and np.array_equal(a, b))
+
+        return continuum_order == self.continuum_order \
+            and same(model_dispersion, self.model_dispersion) \
+            and same(dispersion, self.dispersion)
+
+
+    def _smoothing_weights(self, sigma):
+        """
+        Return the (normalized) Gaussian weights used by `gaussian_filter1d`
+        for a smoothing width of `sigma` pixels, or `None` if no smoothing is
+        necessary.
+        """
+
+        try:
+            return self._weights[sigma]
+        except KeyError:
+            None
+
+        radius = int(4.0 * sigma + 0.5)
+        if 1 > radius:
+            weights = None
+        else:
+            x = np.arange(-radius, radius + 1)
+            weights = np.exp(-0.5 * x**2 / sigma**2)
+            weights /= weights.sum()
+
+        if len(self._weights) >= self._maximum_cached_weights:
+            self._weights.clear()
+        self._weights[sigma] = weights
+        return weights
+
+
+    def _locate(self, v):
+        """
+        Locate the dispersion points in the model dispersion, after applying a
+        Doppler shift to the model.
+
+        :param v:
+            The radial velocity (km/s).
+
+        :returns:
+            The index of the model pixel to the left of each dispersion point,
+            the fractional distance to the next pixel, and boolean arrays that
+            indicate which points are outside the model on the left and right.
+        """
+
+        try:
+            return self._locations[v]
+        except KeyError:
+            None
+
+        md, M = (self.model_dispersion, self.model_dispersion.size)
+        x = self.dispersion / (1 + v/self._speed_of_light)
+
+        if self._uniform:
+            index = np.clip(np.floor((x - md[0])/self._step).astype(int),
+                0, M - 2)
+            # Correct for any small departures from a uniform grid.
+            index += (x >= md[index + 1]) * (index < M - 2)
+            index -= (x < md[index]) * (index > 0)
+
+        else:
+            index = np.clip(md.searchsorted(x, side="right") - 1, 0, M - 2)
+
+        fraction = (x - md[index])/(md[index + 1] - md[index])
+        location = (index, fraction, x < md[0], x > md[-1])
+
+        # Radial velocity is often fixed, so only keep the most recent.
+        self._locations = {v: location}
+        return location
+
+
+    def __call__(self, flux, continuum=None, sigma=0, v=0):
+        """
+        Apply the nuisance operations to model spectra.
+
+        :param flux:
+            The model flux at the model dispersion points. This can be a single
+            spectrum, or an array of shape (N, M) for N spectra.
+
+        :param continuum: [optional]
+            The continuum coefficients, in increasing order of power. For N
+            spectra this can be an array of shape (N, continuum_order + 1).
+
+        :param sigma: [optional]
+            The standard deviation of the Gaussian smoothing kernel, in pixels.
+
+        :param v: [optional]
+            The radial velocity of the model (km/s).
+
+        :returns:
+            The model spectra evaluated at the dispersion points.
+        """
+
+        flux = np.asarray(flux, dtype=float)
+        single = (flux.ndim == 1) and np.ndim(sigma) == 0 and np.ndim(v) == 0 \
+            and (continuum is None or np.ndim(continuum) == 1)
+
+        flux = np.atleast_2d(flux)
+        if continuum is not None and self._vander is not None:
+            flux = flux * np.dot(np.atleast_2d(continuum), self._vander.T)
+
+        N = max(flux.shape[0], np.size(sigma), np.size(v))
+        flux = np.broadcast_to(flux, (N, flux.shape[1]))
+        sigma = np.broadcast_to(np.abs(sigma), (N, ))
+        v = np.broadcast_to(v, (N, ))
+
+        # Locate the dispersion points for every spectrum.
+        locations = [self._locate(vi) for vi in v]
+        index = np.array([location[0] for location in locations])
+        fraction = np.array([location[1] for location in locations])
+
+        # Only smooth the pixels that are needed (plus the kernel width).
+        weights = [self._smoothing_weights(s) for s in sigma]
+        radius = max([0] + [(w.size - 1)//2 for w in weights if w is not None])
+        lower = max(0, index.min() - radius)
+        upper = min(flux.shape[1], index.max() + 2 + radius)
+
+        smoothed = np.array(flux[:, lower:upper])
+        for s in np.unique(sigma):
+            w = self._smoothing_weights(s)
+            if w is None: continue
+            rows = (sigma == s)
+            smoothed[rows] = ndimage.correlate1d(smoothed[rows], w, axis=-1,
+                mode="reflect")
+
+        # Linearly interpolate.
+        rows = np.arange(N)[:, None]
+        index = index - lower
+        y = smoothed[rows, index] * (1 - fraction) \
+          + smoothed[rows, index + 1] * fraction
+
+        for i, (_, __, outside_left, outside_right) in enumerate(locations):
+            if np.any(outside_left):
+                y[i, outside_left] \
+                    = smoothed[i, 0] if self.left is None else self.left
+            if np.any(outside_right):
+                y[i, outside_right] \
+                    = smoothed[i, -1] if self.right is None else self.right
+
+        return y[0] if single else y
@@ -16,12 +16,14 @@ from astropy.table import Row
 from astropy.constants import c as speed_of_light
 from collections import OrderedDict
 from scipy.special import wofz
-from scipy import integrate
 
-from .base import BaseSpectralModel
+from .base import BaseSpectralModel, FittingMetadata
 
 logger = logging.getLogger(__name__)
 
+# km/s
+_speed_of_light = speed_of_light.to("km/s").value
+
 
 def _gaussian(x, *parameters):
     """
@@ -78,6 +80,130 @@ def _voigt(x, *parameters):
     return profile
 
 
+def _gaussian_jacobian(x, *parameters):
+    """
+    Evaluate the partial derivatives of a Gaussian profile with respect to the
+    profile parameters at x.
+
+    :param x:
+        The x-values to evaluate the derivatives at.
+
+    :param parameters:
+        The position, sigma, and amplitude of the Gaussian profile.
+
+    :returns:
+        An array of shape (len(x), 3) with the derivatives with respect to the
+        position, sigma, and amplitude.
+    """
+    position, sigma, amplitude = parameters
+    dx = x - position
+    g = np.exp(-dx**2 / (2.0 * sigma**2))
+    return np.vstack([
+        amplitude * g * dx / sigma**2,
+        amplitude * g * dx**2 / sigma**3,
+        g
+    ]).T
+
+
+def _lorentzian_jacobian(x, *parameters):
+    """
+    Evaluate the partial derivatives of a Lorentzian profile with respect to
+    the profile parameters at x.
+
+    :param x:
+        The x-values to evaluate the derivatives at.
+
+    :param parameters:
+        The position, width, and amplitude of the Lorentzian profile.
+
+    :returns:
+        An array of shape (len(x), 3) with the derivatives with respect to the
+        position, width, and amplitude.
+    """
+    position, width, amplitude = parameters
+    dx = x - position
+    denominator = dx**2 + width**2
+    return np.vstack([
+        (amplitude/np.pi) * 2 * width * dx / denominator**2,
+        (amplitude/np.pi) * (dx**2 - width**2) / denominator**2,
+        width / (np.pi * denominator)
+    ]).T
+
+
+def _voigt_jacobian(x, *parameters):
+    """
+    Evaluate the partial derivatives of a Voigt profile with respect to the
+    profile parameters at x, using the derivative of the Faddeeva function:
+
+        w'(z) = -2 * z * w(z) + 2i/sqrt(PI)
+
+    :param x:
+        The x-values to evaluate the derivatives at.
+
+    :param parameters:
+        The position, fwhm, amplitude, and shape of the Voigt profile.
+
+    :returns:
+        An array of shape (len(x), 4) with the derivatives with respect to the
+        position, fwhm, amplitude, and shape.
+    """
+    position, fwhm, amplitude, shape = parameters
+
+    k = np.sqrt(np.log(2.0))
+    z = 2 * k * (x - position)/fwhm + 1j * k * shape
+    z0 = 1j * k * shape
+
+    w, w0 = wofz(z), wofz(z0)
+    dw = -2 * z * w + 2j/np.sqrt(np.pi)
+    dw0 = -2 * z0 * w0 + 2j/np.sqrt(np.pi)
+
+    # The profile is amplitude * Re[w(z)] / Re[w(z0)].
+    norm = w0.real
+    dnorm_dshape = -k * dw0.imag
+    return np.vstack([
+        amplitude * dw.real * (-2 * k / fwhm) / norm,
+        amplitude * dw.real * (-2 * k * (x - position) / fwhm**2) / norm,
+        w.real / norm,
+        amplitude * (-k * dw.imag * norm - w.real * dnorm_dshape) / norm**2
+    ]).T
+
+
+# Fixed Gauss-Legendre quadrature nodes and weights on [-1, 1], which are
+# sufficient to integrate a Voigt profile over +/- 10 FWHM to ~1e-12.
+_quadrature_nodes, _quadrature_weights = np.polynomial.legendre.leggauss(128)
+
+def _integrate_profiles(profile, lower, upper, parameters):
+    """
+    Integrate many profiles between the same limits at once.
+
+    :param profile:
+        The profile function.
+
+    :param lower:
+        The lower integration limit.
+
+    :param upper:
+        The upper integration limit.
+
+    :param parameters:
+        An array of shape (M, N) containing the N profile parameters for each
+        of the M profiles.
+
+    :returns:
+        An array containing the integral of each profile.
+    """
+
+    parameters = np.atleast_2d(parameters)
+    if profile == _lorentzian:
+        position, width, amplitude = parameters.T
+        return (amplitude/np.pi) * (np.arctan((upper - position)/width) \
+            - np.arctan((lower - position)/width))
+
+    x = 0.5 * (upper - lower) * _quadrature_nodes + 0.5 * (upper + lower)
+    y = profile(x, *[p[:, None] for p in parameters.T])
+    return 0.5 * (upper - lower) * np.dot(y, _quadrature_weights)
+
+
 
 class ProfileFittingModel(BaseSpectralModel):
 
@@ -87,6 +213,12 @@ class ProfileFittingModel(BaseSpectralModel):
         "voigt": (_voigt, ("mean", "fwhm", "amplitude", "shape"))
     }
 
+    _profile_jacobians = {
+        "gaussian": _gaussian_jacobian,
+        "lorentzian": _lorentzian_jacobian,
+        "voigt": _voigt_jacobian
+    }
+
     def __init__(self, session, transition_hashes, **kwargs):
         """
         Initialize a base class for modelling spectra.
@@ -124,12 +256,18 @@ class ProfileFittingModel(BaseSpectralModel):
         self._verify_transitions()
         self._verify_metadata()
 
-        # Create a _repr_element for this.
-        self._repr_element = self.transitions["element"][0]
-
         return None
 
 
+    def _representation(self):
+        """
+        Return the wavelength and element that are used to represent this
+        model.
+        """
+        wavelength, _ = super(ProfileFittingModel, self)._representation()
+        return (wavelength, self._transition_column("element")[0])
+
+
     def _verify_transitions(self):
         """
         Verify that the atomic or molecular transitions associated with this
@@ -157,14 +295,14 @@ class ProfileFittingModel(BaseSpectralModel):
         """
         Return the element that will be measured by this model.
         """
-        return self.transitions["element"][0].split()[0]
+        return self._transition_column("element")[0].split()[0]
         
     def _verify_species(self):
         """
         Return the species that will be measured by this model.
         Ignore isotopes.
         """
-        return np.floor(self.transitions["species"][0]*10)/10
+        return np.floor(self._transition_column("species")[0]*10)/10
 
     def _verify_metadata(self):
         """
@@ -203,16 +341,11 @@ class ProfileFittingModel(BaseSpectralModel):
         or self.metadata["velocity_tolerance"] is not None:
 
             # Convert velocity tolerance into wavelength.
-            wavelength = self.transitions["wavelength"]
-            try:
-                wavelength = wavelength[0]
-            except IndexError:
-                None
+            wavelength = self._transition_column("wavelength")[0]
             vt = abs(self.metadata.get("velocity_tolerance", None) or np.inf)
             wt = abs(self.metadata.get("wavelength_tolerance", None) or np.inf)
 
-            bound = np.nanmin([
-                wt, wavelength * vt/speed_of_light.to("km/s").value])
+            bound = np.nanmin([wt, wavelength * vt/_speed_of_light])
 
             bounds["mean"] = (wavelength - bound, wavelength + bound)
 
@@ -290,10 +423,9 @@ class ProfileFittingModel(BaseSpectralModel):
         # Get a bad initial guess.
         p0 = self._initial_guess(spectrum, **kwargs)
 
-        # Build a mask based on the window fitting range, and prepare the data.
-        mask = self.mask(spectrum)
-        x, y = spectrum.dispersion[mask], spectrum.flux[mask]
-        yerr, absolute_sigma = ((1.0/spectrum.ivar[mask])**0.5, True)
+        # Get the data in the window fitting range, excluding masked regions.
+        x, y, ivar, data_indices = self.windowed_data(spectrum)
+        yerr, absolute_sigma = ((1.0/ivar)**0.5, True)
         if not np.all(np.isfinite(yerr)):
             yerr, absolute_sigma = (np.ones_like(x), False)
 
@@ -313,6 +445,7 @@ class ProfileFittingModel(BaseSpectralModel):
                 except KeyError:
                     None
 
+                self._update_session_results()
                 return failure
 
             try:
@@ -320,7 +453,8 @@ class ProfileFittingModel(BaseSpectralModel):
                     xdata=x[iterative_mask],
                     ydata=y[iterative_mask],
                     sigma=yerr[iterative_mask],
-                    p0=p0, absolute_sigma=absolute_sigma)
+                    p0=p0, absolute_sigma=absolute_sigma,
+                    jac=self.fitting_jacobian)
 
             except:
                 logger.exception(
@@ -334,6 +468,7 @@ class ProfileFittingModel(BaseSpectralModel):
                     except KeyError:
                         None
 
+                    self._update_session_results()
                     return failure
 
             # Look for outliers peaks.
@@ -374,6 +509,14 @@ class ProfileFittingModel(BaseSpectralModel):
                     
                     return model[iterative_mask] * self(x_, *p)
 
+                def model_nearby_line_jacobian(x_, *p):
+                    if not (lower_group_wl <= p[0] <= upper_group_wl) \
+                    or abs(p[1]) > p_opt[1] \
+                    or not (1 >= p[2] > 0):
+                        return np.nan * np.ones((len(x_), len(p)))
+
+                    return model[iterative_mask][:, None] * self.jacobian(x_, *p)
+
                 # Initial parameters for this line.
                 p0_outlier = [
                     np.mean(x[indices]),
@@ -389,7 +532,7 @@ class ProfileFittingModel(BaseSpectralModel):
                             ydata=y[iterative_mask],
                             sigma=yerr[iterative_mask],
                             p0=p0_outlier, absolute_sigma=absolute_sigma,
-                            check_finite=True)
+                            check_finite=True, jac=model_nearby_line_jacobian)
 
                 except:
                     # Just take a narrow range and exclude that?
@@ -403,7 +546,7 @@ class ProfileFittingModel(BaseSpectralModel):
                     l, u = (p_out[0] - 3 * p_out[1], p_out[0] + 3 * p_out[1])
                     
                     # Store this line and the region masked out by it.
-                    nearby_lines.append([p_out, (u, l)])
+                    nearby_lines.append([p_out.tolist(), (float(u), float(l))])
 
                     # Now update the iterative mask to exclude this line.                    
                     iterative_mask *= ~((u > x) * (x > l))
@@ -417,7 +560,8 @@ class ProfileFittingModel(BaseSpectralModel):
             xdata=x[iterative_mask],
             ydata=y[iterative_mask],
             sigma=yerr[iterative_mask],
-            p0=p0, absolute_sigma=absolute_sigma)
+            p0=p0, absolute_sigma=absolute_sigma,
+            jac=self.fitting_jacobian)
 
         assert p_cov is not None
 
@@ -445,13 +589,11 @@ class ProfileFittingModel(BaseSpectralModel):
                 p_opt[0] + integrate_sigma * p_opt[1]
             )
 
-            ew = integrate.quad(profile, l, u, args=tuple(p_opt[:N]))[0]
-            ew_alt = [integrate.quad(profile, l, u, args=tuple(_[:N]))[0] \
-                for _ in p_alt]
+            ew = _integrate_profiles(profile, l, u, p_opt[:N])[0]
+            ew_alt = _integrate_profiles(profile, l, u, p_alt[:, :N])
             ew_uncertainty = np.percentile(ew_alt, percentiles) - ew
         
         # Calculate chi-square for the points that we modelled.
-        ivar = spectrum.ivar[mask]
         if not np.any(np.isfinite(ivar)): ivar = 1
         residuals = y - self(x, *p_opt)
         residuals[~iterative_mask] = np.nan
@@ -461,11 +603,6 @@ class ProfileFittingModel(BaseSpectralModel):
         chi_sq = np.nansum(chi_sq)
         
 
-        model_y = self(x, *p_opt)
-        model_yerr = np.percentile(
-            [self(x, *_) for _ in p_alt], percentiles, axis=0) - model_y
-        model_yerr = np.max(np.abs(model_yerr), axis=0)
-
         """
         # DEBUG PLOT
         fig, ax = plt.subplots()
@@ -488,36 +625,36 @@ class ProfileFittingModel(BaseSpectralModel):
         ax.fill_between(x, model_err[0] + model_y, model_err[1] + model_y,
             edgecolor="None", facecolor="b", alpha=0.5)
         """
-        
-        # Convert x, model_y, etc back to real-spectrum indices.
-        x, model_y, model_yerr, residuals = self._fill_masked_arrays(
-            spectrum, x, model_y, model_yerr, residuals)
-
 
         # We ignore the uncertainty in wavelength position because it only
         # affects the uncertainty in REW at the ~10^-5 level.
         rew = np.log10(ew/p_opt[0])
         rew_uncertainty = np.log10((ew + ew_uncertainty)/p_opt[0]) - rew
 
-        fitting_metadata = {
-            "equivalent_width": (ew, ew_uncertainty[0], ew_uncertainty[1]),
-            "reduced_equivalent_width": np.hstack([rew, rew_uncertainty]),
-            "data_indices": np.where(mask)[0][iterative_mask],
-            "model_x": x,
-            "model_y": model_y,
-            "model_yerr": model_yerr,
-            "residual": residuals,
+        # The arrays that show the fit (model_x, model_y, model_yerr and
+        # residual) are calculated from the fitted result when needed, and
+        # scalars are stored as Python floats so they are compact when pickled.
+        window = self.window(spectrum)[0]
+        fitting_metadata = FittingMetadata({
+            "equivalent_width": tuple(map(float,
+                (ew, ew_uncertainty[0], ew_uncertainty[1]))),
+            "reduced_equivalent_width": tuple(map(float,
+                np.hstack([rew, rew_uncertainty]))),
+            "data_indices": data_indices[iterative_mask].astype(np.int32),
             "nearby_lines": nearby_lines,
-            "chi_sq": chi_sq,
-            "dof": dof
-        }
+            "chi_sq": float(chi_sq),
+            "dof": int(dof),
+            "window": (int(window.start), int(window.stop)),
+            "fingerprint": self.fingerprint(spectrum)
+        })
+        fitting_metadata.model = self
 
         # Update the equivalent width in the transition.
         # REMOVED: see Issue #38
         #self.transitions["equivalent_width"] = ew
 
         # Convert p_opt to ordered dictionary
-        named_p_opt = OrderedDict(zip(self.parameter_names, p_opt))
+        named_p_opt = OrderedDict(zip(self.parameter_names, p_opt.tolist()))
         self.metadata["fitted_result"] = (named_p_opt, p_cov, fitting_metadata)
 
         # Only mark as acceptable if the model meets the quality constraints.
@@ -526,6 +663,74 @@ class ProfileFittingModel(BaseSpectralModel):
         return self.metadata["fitted_result"]
 
 
+    def _fitted_arrays(self, fitted_result, spectrum=None):
+        """
+        Calculate the arrays that show a fitted result: the dispersion points
+        across the fitting window, the model flux and its uncertainty, and the
+        residuals. Pixels that were not used in the fit are filled with NaNs.
+
+        If the spectrum, window, mask, or transitions have changed since the
+        fit (i.e., the model is stale), then the model is shown across the
+        pixels of the window at the time of the fit, and the residuals are all
+        NaNs because the data that were fit are no longer available.
+
+        :param fitted_result:
+            The fitted result of this model.
+
+        :param spectrum: [optional]
+            The spectrum that was fit. By default this is the normalized
+            rest-frame spectrum in the parent session.
+
+        :returns:
+            A four-length tuple containing the dispersion points, the model
+            flux, the model flux uncertainty, and the residuals.
+        """
+
+        spectrum = spectrum or self.session.normalized_spectrum
+        named_p_opt, p_cov, meta = fitted_result
+        p_opt = np.array(list(named_p_opt.values()))
+
+        if meta.get("fingerprint", None) == self.fingerprint(spectrum):
+            x, y, ivar, data_indices = self.windowed_data(spectrum)
+
+        else:
+            logger.debug("Inputs to {} have changed since it was fit".format(
+                self))
+            start, stop = meta.get("window", (
+                np.min(meta["data_indices"]), 1 + np.max(meta["data_indices"])))
+            data_indices = np.arange(start, min(stop, spectrum.dispersion.size))
+            x = spectrum.dispersion[data_indices]
+            y = np.nan * np.ones_like(x)
+            if x.size == 0:
+                return (x, y, y, y)
+
+        model_y = self(x, *p_opt)
+
+        # The uncertainty in the model from draws of the covariance matrix.
+        draws = self.session.setting("covariance_draws", 100)
+        percentiles = self.session.setting("error_percentiles", (2.5, 97.5))
+        if np.all(np.isfinite(p_cov)):
+            p_alt = np.random.RandomState(0).multivariate_normal(
+                p_opt, p_cov, size=draws)
+
+            # Evaluate all draws at once as a (draws, pixels) array.
+            model_yerr = np.percentile(
+                self(x, *[_[:, None] for _ in p_alt.T]), percentiles, axis=0) \
+                - model_y
+            model_yerr = np.max(np.abs(model_yerr), axis=0)
+
+        else:
+            model_yerr = np.nan * np.ones_like(x)
+
+        # Residuals are only given for the pixels used in the fit.
+        residuals = np.where(np.in1d(data_indices, meta["data_indices"]),
+            y - model_y, np.nan)
+
+        # Convert x, model_y, etc back to real-spectrum indices.
+        return self._fill_masked_arrays(
+            spectrum, x, model_y, model_yerr, residuals)
+
+
     def __call__(self, dispersion, *parameters):
         """
         Generate data at the dispersion points, given the parameters.
@@ -548,6 +753,60 @@ class ProfileFittingModel(BaseSpectralModel):
         
         return y
 
+
+    def jacobian(self, dispersion, *parameters):
+        """
+        Calculate the partial derivatives of the model with respect to the
+        parameters, at the dispersion points.
+
+        :param dispersion:
+            An array of dispersion points to calculate the derivatives for.
+
+        :param parameters:
+            The model parameters.
+
+        :returns:
+            An array of shape (len(dispersion), len(parameters)).
+        """
+
+        function, profile_parameters = self._profiles[self.metadata["profile"]]
+        jacobian = self._profile_jacobians[self.metadata["profile"]]
+
+        N = len(profile_parameters)
+        d_profile = jacobian(dispersion, *parameters[:N])
+        if not parameters[N:]:
+            return -d_profile
+
+        # The model is (1 - profile) * continuum.
+        continuum = np.polyval(parameters[N:], dispersion)
+        d_continuum = np.vander(dispersion, len(parameters) - N)
+        y = 1.0 - function(dispersion, *parameters[:N])
+        return np.hstack([
+            -d_profile * continuum[:, None],
+            d_continuum * y[:, None]
+        ])
+
+
+    def fitting_jacobian(self, dispersion, *parameters):
+        """
+        Calculate the partial derivatives of the model with respect to the
+        parameters, respecting the boundaries specified on model parameters in
+        the same way as `fitting_function`.
+
+        :param dispersion:
+            An array of dispersion points to calculate the derivatives for.
+
+        :param parameters:
+            The model parameters.
+        """
+
+        for parameter_name, (lower, upper) in self.parameter_bounds.items():
+            value = parameters[self.parameter_names.index(parameter_name)]
+            if not (upper >= value and value >= lower):
+                return np.nan * np.ones((len(dispersion), len(parameters)))
+
+        return self.jacobian(dispersion, *parameters)
+
     """
     @property
     def abundances(self):
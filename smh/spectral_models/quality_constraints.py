@@ -6,7 +6,7 @@
 from __future__ import (division, print_function, absolute_import,
                         unicode_literals)
 
-__all__ = ["constraint", "constraints"]
+__all__ = ["constraint", "constraints", "evaluate_constraints"]
 
 import logging
 import numpy as np
@@ -51,6 +51,31 @@ _get_data_from_model = {}
 [_get_data_from_model.update(_constraint) for _constraint in \
     (_common_constraints, _profile_constraints, _synthesis_constraints)]
 
+# The same constraints evaluated on the columns of a SpectralModelResults
+# store. Each function returns the values for every row, and whether that
+# value exists for the model.
+_profile_result = lambda results: results["is_profile"] * results["is_fitted"]
+_get_data_from_results = {
+    "wavelength": lambda results: (results["wavelength"], True),
+    "abundance": lambda results: \
+        (results["abundance"], results["has_abundance"]),
+    "abundance_uncertainty": lambda results: \
+        (np.abs(results["abundance_uncertainty"]),
+            results["has_abundance_uncertainty"]),
+
+    "equivalent_width": lambda results: \
+        (results["equivalent_width"], _profile_result(results)),
+    "equivalent_width_uncertainty": lambda results: \
+        (results["equivalent_width_uncertainty"], _profile_result(results)),
+    "equivalent_width_percentage_uncertainty": lambda results: \
+        (100 * results["equivalent_width_uncertainty"] \
+            / results["equivalent_width"], _profile_result(results)),
+    "reduced_equivalent_width": lambda results: \
+        (results["reduced_equivalent_width"], _profile_result(results)),
+    "loggf": lambda results: (results["loggf"], True),
+    "excitation_potential": lambda results: (results["expot"], True),
+}
+
 
 def constraint(spectral_model, constraint_name, lower, upper, full_output=False):
     """
@@ -102,7 +127,10 @@ def constraint(spectral_model, constraint_name, lower, upper, full_output=False)
 
     # If we get back an array of values from get_model_data, we will
     # apply the constraint to *every* value. All values must fit within
-    # the constraints.
+    # the constraints. Lists (e.g., profile model abundances) cannot be
+    # compared to the bounds directly.
+    if isinstance(value, (list, tuple)):
+        value = np.array(value)
     qualifier = np.all if isinstance(value, np.ndarray) else np.any    
     is_ok = qualifier((upper >= value) * (value >= lower))
     return is_ok if not full_output else (is_ok, value)
@@ -134,4 +162,46 @@ def constraints(spectral_model, quality_constraints):
                     spectral_model, constraint_name, lower, value, upper))
             return False
 
-    return True
\ No newline at end of file
+    return True
+
+
+def evaluate_constraints(results, quality_constraints):
+    """
+    Evaluate a set of quality constraints for many spectral models at once.
+    This is equivalent to calling `constraints` for every spectral model.
+
+    :param results:
+        A `SpectralModelResults` store of the spectral models.
+
+    :param quality_constraints:
+        A dictionary containing constraint names as keys and a 2-length tuple
+        with the (lower, upper) bounds specified as values.
+
+    :returns:
+        A boolean array indicating whether each spectral model in the results
+        meets the constraints.
+    """
+
+    N = len(results.spectral_models)
+    is_ok = np.ones(len(results), dtype=bool)
+    for constraint_name, (lower, upper) in quality_constraints.items():
+        lower, upper = (lower or -np.inf, upper or +np.inf)
+        if not np.any(np.isfinite([lower, upper])):
+            # Nothing to check.
+            continue
+
+        try:
+            func = _get_data_from_results[constraint_name]
+        except KeyError:
+            raise KeyError(
+                "unrecognized constraint name '{}' (available: {})".format(
+                    constraint_name, ", ".join(_get_data_from_results.keys())))
+
+        value, exists = func(results)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            is_ok *= ~np.asarray(exists, dtype=bool) \
+                | ((upper >= value) * (value >= lower))
+
+    # A spectral model only meets the constraints if all of its rows do.
+    fails = np.bincount(results["model_index"], weights=~is_ok, minlength=N)
+    return (fails == 0)
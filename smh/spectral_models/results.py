@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" A columnar store of the results from many spectral models. """
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+__all__ = ["SpectralModelResults"]
+
+import logging
+import numpy as np
+from astropy.table import Table
+
+from .profile import ProfileFittingModel
+from .quality_constraints import evaluate_constraints
+from smh.photospheres.abundances import asplund_2009 as solar_composition
+
+logger = logging.getLogger(__name__)
+
+
+class SpectralModelResults(object):
+
+    # Column names and types. There is one row for every species measured by
+    # a spectral model: one row for profile models, and one or more rows for
+    # synthesis models. Equivalent widths are in mA.
+    _columns = (
+        ("model_index", int),
+        ("element_index", int),
+        ("is_first_species", bool),
+        ("element", object),
+        ("species", float),
+        ("wavelength", float),
+        ("transition_index", int),
+        ("expot", float),
+        ("loggf", float),
+        ("is_profile", bool),
+        ("is_fitted", bool),
+        ("is_acceptable", bool),
+        ("is_upper_limit", bool),
+        ("use_for_stellar_parameter_inference", bool),
+        ("use_for_stellar_composition_inference", bool),
+        ("equivalent_width", float),
+        ("equivalent_width_uncertainty", float),
+        ("reduced_equivalent_width", float),
+        ("has_abundance", bool),
+        ("abundance", float),
+        ("has_abundance_uncertainty", bool),
+        ("abundance_uncertainty", float),
+        ("chi_sq", float),
+        ("dof", float)
+    )
+
+    def __init__(self, spectral_models):
+        """
+        A columnar store of the results from spectral models, which allows for
+        fast filtering, grouping, and summaries of many spectral models.
+
+        :param spectral_models:
+            A list of spectral models.
+        """
+
+        self.refresh(spectral_models)
+        return None
+
+
+    def __len__(self):
+        return self._data["model_index"].size
+
+
+    def __getitem__(self, column):
+        """ Return a column of the results. """
+        return self._data[column]
+
+
+    @property
+    def columns(self):
+        """ Return the column names. """
+        return [name for name, dtype in self._columns]
+
+
+    def _model_rows(self, index, model):
+        """
+        Return the rows for a spectral model.
+
+        :param index:
+            The index of the spectral model.
+
+        :param model:
+            The spectral model.
+
+        :returns:
+            A list of rows, where each row is a tuple of values in the same
+            order as the columns.
+        """
+
+        is_profile = isinstance(model, ProfileFittingModel)
+
+        try:
+            meta = model.metadata["fitted_result"][2]
+        except KeyError:
+            meta = {}
+
+        equivalent_width = meta.get("equivalent_width", None)
+        if equivalent_width is None:
+            equivalent_width, equivalent_width_uncertainty = (np.nan, np.nan)
+        else:
+            uncertainty = np.abs(equivalent_width[1:])
+            equivalent_width_uncertainty = 1e3 * np.nanmax(uncertainty) \
+                if np.any(np.isfinite(uncertainty)) else np.nan
+            equivalent_width = 1e3 * equivalent_width[0]
+
+        reduced_equivalent_width = meta.get("reduced_equivalent_width",
+            [np.nan])[0]
+        abundances = meta.get("abundances", None)
+        uncertainties = meta.get("abundance_uncertainties", None)
+
+        common = (model.wavelength, model._transition_indices[0],
+            model._transition_column("expot")[0],
+            model._transition_column("loggf")[0], is_profile,
+            "fitted_result" in model.metadata, model.is_acceptable,
+            model.is_upper_limit,
+            model.metadata.get("use_for_stellar_parameter_inference", False),
+            model.metadata.get("use_for_stellar_composition_inference", False),
+            equivalent_width, equivalent_width_uncertainty,
+            reduced_equivalent_width)
+
+        rows = []
+        for i, (element, species) in enumerate(zip(model.elements,
+            model.species)):
+
+            # Synthesis models can have many species for each element.
+            species = np.array(species, dtype=float).flatten()
+
+            has_abundance = abundances is not None and len(abundances) > i
+            abundance = abundances[i] if has_abundance else np.nan
+            has_abundance_uncertainty \
+                = uncertainties is not None and len(uncertainties) > i
+            abundance_uncertainty = uncertainties[i] \
+                if has_abundance_uncertainty else np.nan
+
+            for j, each in enumerate(species):
+                rows.append((index, i, j == 0, element, each) + common + (
+                    has_abundance, abundance, has_abundance_uncertainty,
+                    abundance_uncertainty,
+                    meta.get("chi_sq", np.nan), meta.get("dof", np.nan)))
+
+        return rows
+
+
+    def refresh(self, spectral_models=None):
+        """
+        Rebuild the results from the spectral models.
+
+        :param spectral_models: [optional]
+            A new list of spectral models. By default, the results are rebuilt
+            from the existing list of spectral models.
+        """
+
+        if spectral_models is not None:
+            self.spectral_models = list(spectral_models)
+
+        rows, self._rows = ([], {})
+        for index, model in enumerate(self.spectral_models):
+            model_rows = self._model_rows(index, model)
+            self._rows[id(model)] \
+                = (index, slice(len(rows), len(rows) + len(model_rows)))
+            rows.extend(model_rows)
+
+        self._data = {}
+        for i, (name, dtype) in enumerate(self._columns):
+            self._data[name] = np.array([row[i] for row in rows], dtype=dtype)
+        self._constraint_cache = {}
+        return None
+
+
+    def update(self, spectral_models):
+        """
+        Update the results of some spectral models in place.
+
+        :param spectral_models:
+            The spectral models to update. Models that are not in these results
+            are ignored.
+        """
+
+        for model in spectral_models:
+            try:
+                index, rows = self._rows[id(model)]
+            except KeyError:
+                continue
+
+            model_rows = self._model_rows(index, model)
+            if len(model_rows) != rows.stop - rows.start:
+                # The number of species has changed.
+                return self.refresh()
+
+            for i, (name, dtype) in enumerate(self._columns):
+                self._data[name][rows] = [row[i] for row in model_rows]
+            self._constraint_cache.clear()
+
+        return None
+
+
+    def meets_quality_constraints(self, quality_constraints):
+        """
+        Return whether each spectral model meets some quality constraints. The
+        result is cached until the constraints or any results change.
+
+        :param quality_constraints:
+            A dictionary containing constraint names as keys and a 2-length
+            tuple with the (lower, upper) bounds specified as values.
+
+        :returns:
+            A boolean array with one entry per spectral model.
+        """
+
+        key = tuple(sorted([(name, tuple(bounds)) \
+            for name, bounds in quality_constraints.items()]))
+        try:
+            is_ok = self._constraint_cache[key]
+        except KeyError:
+            is_ok = self._constraint_cache[key] \
+                = evaluate_constraints(self, quality_constraints)
+        return is_ok.copy()
+
+
+    def group_by(self, column, rows=None):
+        """
+        Group the results by the values in a column.
+
+        :param column:
+            The name of the column to group by.
+
+        :param rows: [optional]
+            A boolean mask or indices of the rows to group. By default all rows
+            are grouped.
+
+        :returns:
+            The unique values in the column, and the index of the group that
+            each row belongs to.
+        """
+
+        values = self._data[column]
+        if rows is not None:
+            values = values[rows]
+        return np.unique(values, return_inverse=True)
+
+
+    def summarize(self, organize_by_element=False, use_finite=True):
+        """
+        Summarize the abundances from all acceptable spectral models that are
+        not upper limits.
+
+        :param organize_by_element: [optional]
+            If False (default), summarize by species. If True, summarize by
+            element (all species of an element together).
+
+        :param use_finite: [optional]
+            If True (default), only use finite abundances.
+
+        :returns:
+            A dictionary with species (or elements) as keys, and values of
+            [num_models, logeps, stdev, stderr, [X/H], [X/Fe]].
+        """
+
+        rows = self._data["is_acceptable"] * ~self._data["is_upper_limit"] \
+             * self._data["has_abundance"]
+        if organize_by_element:
+            rows *= self._data["is_first_species"]
+
+        keys, group = self.group_by(
+            "element" if organize_by_element else "species", rows)
+        abundances = self._data["abundance"][rows]
+
+        use = np.isfinite(abundances) if use_finite \
+            else np.ones(abundances.size, dtype=bool)
+        abundances = np.where(use, abundances, 0)
+
+        K = len(keys)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            num_models = np.bincount(group, weights=use, minlength=K)
+            logeps = np.bincount(group, weights=abundances, minlength=K) \
+                / num_models
+            stdev = np.sqrt(np.bincount(group,
+                weights=use * (abundances - logeps[group])**2, minlength=K) \
+                / num_models)
+            stderr = stdev / np.sqrt(num_models)
+
+        if not organize_by_element:
+            keys = [float(key) for key in keys]
+
+        summary_dict = {}
+        for key, N, mean, std, err in zip(keys, num_models, logeps, stdev,
+            stderr):
+            XH = mean - solar_composition(key)
+            summary_dict[key] = [int(N), mean, std, err, XH, np.nan]
+
+        # TODO: using Fe I for now, should make this configurable
+        FeH = summary_dict.get("Fe" if organize_by_element else 26.0,
+            [np.nan] * 5)[4]
+        for summary in summary_dict.values():
+            summary[5] = summary[4] - FeH
+
+        return summary_dict
+
+
+    def as_table(self, rows=None, columns=None):
+        """
+        Return the results as a table.
+
+        :param rows: [optional]
+            A boolean mask or indices of the rows to include. By default all
+            rows are included.
+
+        :param columns: [optional]
+            The names of the columns to include. By default all columns are
+            included.
+        """
+
+        columns = columns or self.columns
+        data = [self._data[column] for column in columns]
+        if rows is not None:
+            data = [each[rows] for each in data]
+        return Table(data, names=columns)
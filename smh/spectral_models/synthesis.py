@@ -16,9 +16,9 @@ import scipy.optimize as op
 import scipy.interpolate
 from collections import OrderedDict
 from six import string_types, iteritems
-from scipy.ndimage import gaussian_filter
 
-from .base import BaseSpectralModel
+from .base import BaseSpectralModel, _hashable
+from .nuisance import NuisanceKernel
 from smh import utils
 from smh.specutils import Spectrum1D
 from smh.photospheres.abundances import asplund_2009 as solar_composition
@@ -37,6 +37,31 @@ def _fix_rt_abundances(rt_abundances):
     
 def approximate_spectral_synthesis(model, centroids, bounds, rt_abundances={},
                                    isotopes={}):
+    """
+    Return a function that approximates the synthesized spectrum of a model
+    by linear interpolation between syntheses on a grid of abundances at
+    +/- `bounds` around the `centroids`.
+
+    The syntheses are kept in a grid on the model, so that repeated calls
+    (e.g., with smaller bounds, or re-fitting the same feature) only need to
+    synthesize the abundance points that have not been calculated before. The
+    grid is discarded when any other input to the synthesis changes.
+
+    :param model:
+        The spectral synthesis model.
+
+    :param centroids:
+        The central abundances of the elements in the model.
+
+    :param bounds:
+        The distance from the centroids (in dex) of the grid points.
+
+    :param rt_abundances: [optional]
+        Explicitly specified abundances for other elements.
+
+    :param isotopes: [optional]
+        Isotopic ratios to use in the synthesis.
+    """
 
     # Generate spectra at +/- the initial bounds. For all elements.
     species \
@@ -47,24 +72,42 @@ def approximate_spectral_synthesis(model, centroids, bounds, rt_abundances={},
     except IndexError:
         centroids = centroids * np.ones(N)
 
-    calculated_abundances = np.array(list(
+    requested_abundances = np.array(list(
         itertools.product(*[[c-bounds, c, c+bounds] for c in centroids])))
 
     # Explicitly specified abundances
     # np.nan goes to -9.0
     rt_abundances = _fix_rt_abundances(rt_abundances)
 
+    # Any change to the other inputs invalidates the grid.
+    key = (tuple(species), _hashable(rt_abundances), _hashable(isotopes),
+        _hashable(model.session.metadata["stellar_parameters"]),
+        tuple(model._transition_hashes))
+    grid = getattr(model, "_synthesis_grid", None)
+    if grid is None or grid["key"] != key:
+        grid = model._synthesis_grid = {
+            "key": key,
+            "abundances": np.zeros((0, N)),
+            "dispersion": None,
+            "fluxes": None,
+            "interpolator": None
+        }
+
+    # Only synthesize the points that are not in the grid already.
+    calculated = set(map(tuple, np.round(grid["abundances"], 6)))
+    calculated_abundances = np.array([a for a in requested_abundances \
+        if tuple(np.round(a, 6)) not in calculated]).reshape(-1, N)
+
     # Group syntheses into 5 where possible.
     M, K = 5, calculated_abundances.shape[0]
-    fluxes = None
-    for i in range(1 + int(K / M)):
+    for i in range(int(np.ceil(K / M))):
         abundances = {}
         for j, specie in enumerate(species):
             abundances[specie] = calculated_abundances[M*i:M*(i + 1), j]
 
         # Include explicitly specified abundances.
         abundances.update(rt_abundances)
-        print(abundances)
+        logger.debug("Synthesizing grid points {}".format(abundances))
 
         spectra = model.session.rt.synthesize(
             model.session.stellar_photosphere, 
@@ -73,21 +116,44 @@ def approximate_spectral_synthesis(model, centroids, bounds, rt_abundances={},
             twd=model.session.twd) # TODO other kwargs?
 
         dispersion = spectra[0][0]
-        if fluxes is None:
-            fluxes = np.nan * np.ones((K, dispersion.size))
+        if grid["dispersion"] is None:
+            grid["dispersion"] = dispersion
+            grid["fluxes"] = np.zeros((0, dispersion.size))
+
+        elif dispersion.size != grid["dispersion"].size \
+        or not np.allclose(dispersion, grid["dispersion"]):
+            # Start again with a new grid.
+            logger.debug("Synthesized dispersion changed; discarding grid")
+            model._synthesis_grid = None
+            return approximate_spectral_synthesis(model, centroids, bounds,
+                rt_abundances, isotopes)
+
+        grid["abundances"] = np.vstack([grid["abundances"],
+            calculated_abundances[M*i:M*(i + 1)]])
+        grid["fluxes"] = np.vstack([grid["fluxes"]] \
+            + [spectrum[1] for spectrum in spectra])
+        grid["interpolator"] = None
+
+    # Triangulate the grid once, not on every evaluation.
+    if grid["interpolator"] is None:
+        if N == 1:
+            grid["interpolator"] = scipy.interpolate.interp1d(
+                grid["abundances"][:, 0], grid["fluxes"], axis=0,
+                bounds_error=False, fill_value=np.nan)
+        else:
+            grid["interpolator"] = scipy.interpolate.LinearNDInterpolator(
+                grid["abundances"], grid["fluxes"])
 
-        for j, spectrum in enumerate(spectra):
-            fluxes[M*i + j, :] = spectrum[1]
+    dispersion, interpolator = (grid["dispersion"], grid["interpolator"])
 
     def call(*parameters):
-        print(*parameters)
-        N = len(model.metadata["elements"])
         if len(parameters) < N:
             raise ValueError("missing parameters")
 
-        flux = scipy.interpolate.griddata(calculated_abundances, fluxes, 
-            np.array(parameters[:N]).reshape(-1, N)).flatten()
-        return (dispersion, flux)
+        # Many points can be given at once as arrays of abundances.
+        points = np.transpose(parameters[:N]).reshape(-1, N)
+        flux = interpolator(points[:, 0] if N == 1 else points)
+        return (dispersion, flux[0] if points.shape[0] == 1 else flux)
 
     # Make sure the function works, otherwise fail early so we can debug.
     assert np.isfinite(call(*centroids)[1]).all()
@@ -97,6 +163,9 @@ def approximate_spectral_synthesis(model, centroids, bounds, rt_abundances={},
 
 class SpectralSynthesisModel(BaseSpectralModel):
 
+    # The number of synthesized spectra to keep in each model's cache.
+    _synthesis_cache_size = 16
+
     def __init__(self, session, transition_hashes, elements, **kwargs):
         """
         Initialize a base class for modelling spectra.
@@ -148,26 +217,31 @@ class SpectralSynthesisModel(BaseSpectralModel):
             rt_abundances[elem] = np.nan
         self.metadata.update({"rt_abundances": rt_abundances})
 
+        if "Fe" not in elements:
+            self.metadata["use_for_stellar_parameter_inference"] = False
+
+        return None
+
+
+    def _representation(self):
+        """
+        Return the wavelength and element(s) that are used to represent this
+        model.
+        """
+
+        wavelength, elements = \
+            super(SpectralSynthesisModel, self)._representation()
         if len(self.elements) == 1:
             # Which of these lines is in the line list?
-            matches = (self.transitions["elem1"] == self.elements[0])
-
-            if not np.any(matches):
-                self._repr_element = ", ".join(self.elements)
-            else:
-                unique_species = np.unique(self.transitions["element"][matches])
+            matches = (self._transition_column("elem1") == self.elements[0])
+            if np.any(matches):
+                unique_species = np.unique(
+                    self._transition_column("element")[matches])
                 if len(unique_species) == 1:
-                    self._repr_element = unique_species[0]
-                else:
-                    self._repr_element = ", ".join(self.elements)
-        else:
-            # Many elements fitted simultaneously.
-            self._repr_element = ", ".join(self.elements)
+                    elements = unique_species[0]
 
-        if "Fe" not in elements:
-            self.metadata["use_for_stellar_parameter_inference"] = False
+        return (wavelength, elements)
 
-        return None
 
     def _verify_elements(self, elements):
         """
@@ -224,6 +298,15 @@ class SpectralSynthesisModel(BaseSpectralModel):
         return species
         
 
+    def _fingerprint_state(self):
+        """
+        Return the state of the parent session that a fit depends on, other
+        than the spectrum.
+        """
+        return (self.session.metadata["stellar_parameters"],
+            self.session.metadata.get("isotopes", {}))
+
+
     def _initial_guess(self, spectrum, **kwargs):
         """
         Return an initial guess about the model parameters.
@@ -331,10 +414,9 @@ class SpectralSynthesisModel(BaseSpectralModel):
         # input kwargs.
         self._update_parameter_names()
         
-        # Build a mask based on the window fitting range, and prepare the data.
-        mask = self.mask(spectrum)
-        x, y = spectrum.dispersion[mask], spectrum.flux[mask]
-        yerr, absolute_sigma = ((1.0/spectrum.ivar[mask])**0.5, True)
+        # Get the data in the window fitting range, excluding masked regions.
+        x, y, ivar, _ = self.windowed_data(spectrum)
+        yerr, absolute_sigma = ((1.0/ivar)**0.5, True)
         if not np.all(np.isfinite(yerr)):
             yerr, absolute_sigma = (np.ones_like(x), False)
 
@@ -394,15 +476,15 @@ class SpectralSynthesisModel(BaseSpectralModel):
             self.session.setting("error_percentiles",(16, 84)))
         if np.all(np.isfinite(cov)):
             p_alt = np.random.multivariate_normal(p_opt, cov, size=draws)
+            # Evaluate all draws at once.
             model_yerr = model_y - np.percentile(
-                [objective_function(x, *_) for _ in p_alt], percentiles, axis=0)
+                objective_function(x, *p_alt.T), percentiles, axis=0)
         else:
             p_alt = np.nan * np.ones((draws, p_opt.size))
             model_yerr = np.nan * np.ones((2, x.size))
         model_yerr = np.max(np.abs(model_yerr), axis=0)
         
         # Calculate chi-square for the points that we modelled.
-        ivar = spectrum.ivar[mask]
         if not np.any(np.isfinite(ivar)): ivar = 1
         residuals = y - model_y
         chi_sq = residuals**2 * ivar
@@ -431,6 +513,10 @@ class SpectralSynthesisModel(BaseSpectralModel):
             self.metadata["manual_rv"] = named_p_opt["vrad"]
         if "sigma_smooth" in self.parameter_names:
             self.metadata["manual_sigma_smooth"] = named_p_opt["sigma_smooth"]
+
+        # Record what this fit depended on.
+        fitting_metadata["fingerprint"] = self.fingerprint(spectrum)
+        self._update_session_results()
         
         return self.metadata["fitted_result"]
 
@@ -454,8 +540,7 @@ class SpectralSynthesisModel(BaseSpectralModel):
         synth_spec.write(synth_fname)
         
         ## Write data only in the mask range
-        mask = self.mask(spectrum)
-        x, y, ivar = spectrum.dispersion[mask], spectrum.flux[mask], spectrum.ivar[mask]
+        x, y, ivar, _ = self.windowed_data(spectrum)
         data_spec = Spectrum1D(x, y, ivar)
         data_spec.write(data_fname)
         
@@ -495,9 +580,9 @@ class SpectralSynthesisModel(BaseSpectralModel):
         fiddle manually you probably don't care about those anyway.
         
         :param synthesize:
-            Not implemented. Eventually should not recalc synth every time.
-            But have to figure out when you need to recalc synth,
-            and where to store the synth.
+            Not used. The synthesized spectrum is cached, so changing only the
+            nuisance parameters (continuum, smoothing, radial velocity) does
+            not re-run the synthesis.
         """
         self._update_parameter_names()
         spectrum = self._verify_spectrum(None)
@@ -542,16 +627,68 @@ class SpectralSynthesisModel(BaseSpectralModel):
         abundances.update(rt_abundances)
 
         # Produce a synthetic spectrum.
-        synth_dispersion, intensities, meta = self.session.rt.synthesize(
-            self.session.stellar_photosphere, self.transitions,
-            abundances=abundances, 
-            isotopes=self.session.metadata["isotopes"],
-            twd=self.session.twd)[0] # TODO: Other RT kwargs......
+        synth_dispersion, intensities = self._synthesize(abundances)
 
         return self._nuisance_methods(
             dispersion, synth_dispersion, intensities, *parameters)
 
 
+    def _synthesis_key(self, abundances):
+        """
+        Return a key that uniquely describes the inputs to the radiative
+        transfer: the abundances, the stellar parameters and isotopes in the
+        parent session, and the transitions.
+
+        :param abundances:
+            A dictionary of abundances that will be passed to the synthesis.
+        """
+        return (
+            _hashable(abundances),
+            _hashable(self.session.metadata["stellar_parameters"]),
+            _hashable(self.session.metadata["isotopes"]),
+            tuple(self._transition_hashes)
+        )
+
+
+    def _synthesize(self, abundances):
+        """
+        Synthesize a spectrum with the given abundances, or return it from the
+        cache if the same spectrum has already been synthesized. The nuisance
+        parameters (continuum, smoothing, radial velocity) are not part of the
+        synthesis, so changing them does not require a new synthesis.
+
+        :param abundances:
+            A dictionary of abundances to pass to the synthesis.
+
+        :returns:
+            The synthesized dispersion and intensities.
+        """
+
+        try:
+            cache = self._synthesis_cache
+        except AttributeError:
+            cache = self._synthesis_cache = OrderedDict()
+
+        key = self._synthesis_key(abundances)
+        try:
+            spectrum = cache.pop(key)
+
+        except KeyError:
+            synth_dispersion, intensities, meta = self.session.rt.synthesize(
+                self.session.stellar_photosphere, self.transitions,
+                abundances=abundances, 
+                isotopes=self.session.metadata["isotopes"],
+                twd=self.session.twd)[0] # TODO: Other RT kwargs......
+            spectrum = (synth_dispersion, intensities)
+
+            # Discard the least recently used spectra.
+            while len(cache) >= self._synthesis_cache_size:
+                cache.popitem(last=False)
+
+        cache[key] = spectrum
+        return spectrum
+
+
     def _nuisance_methods(self, dispersion, synth_dispersion, intensities,
         *parameters):
         """
@@ -576,39 +713,42 @@ class SpectralSynthesisModel(BaseSpectralModel):
 
         :returns:
             A convolved, redshifted model with multiplicatively-entered
-            continuum.
+            continuum. If the intensities or parameters are arrays then many
+            models are calculated at once.
         """
 
         # Continuum.
         names = self.parameter_names
         O = self.metadata["continuum_order"]
         if 0 > O:
-            continuum = 1 * self.metadata["manual_continuum"]
+            continuum = None
+            intensities = intensities * self.metadata["manual_continuum"]
         else:
-            continuum = np.polyval([parameters[names.index("c{}".format(i))] \
-                for i in range(O + 1)][::-1], synth_dispersion)
-
-        model = intensities * continuum
+            continuum = np.transpose([parameters[names.index("c{}".format(i))] \
+                for i in range(O + 1)])
 
         # Smoothing.
         try: # If in parameters to vary, use that
             sigma_smooth = parameters[names.index("sigma_smooth")]
         except (IndexError, ValueError): # Otherwise, use manual value
             sigma_smooth = self.metadata["manual_sigma_smooth"]
-        # Scale value by pixel diff.
-        kernel = abs(sigma_smooth)/np.mean(np.diff(synth_dispersion))
-        if kernel > 0:
-            model = gaussian_filter(model, kernel)
 
         try:
             v = parameters[names.index("vrad")]
         except ValueError:
             v = self.metadata["manual_rv"]
 
-        #print("smooth: {:.4f}, rv: {:.4f}".format(sigma_smooth,v))
-        # Interpolate the model spectrum onto the requested dispersion points.
-        return np.interp(dispersion, synth_dispersion * (1 + v/299792458e-3), 
-            model, left=1, right=1)
+        # The kernel is only rebuilt when the dispersion points change.
+        kernel = getattr(self, "_nuisance_kernel", None)
+        if kernel is None \
+        or not kernel.matches(synth_dispersion, dispersion, max(O, -1)):
+            kernel = self._nuisance_kernel = NuisanceKernel(
+                synth_dispersion, dispersion, max(O, -1), left=1, right=1)
+
+        # Scale smoothing value by pixel diff, and interpolate the model
+        # spectrum onto the requested dispersion points.
+        return kernel(intensities, continuum,
+            np.abs(sigma_smooth)/kernel.pixel_scale, v)
 
 
     """
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Propagate uncertainties in stellar parameters to abundances. """
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+__all__ = ["propagate_stellar_parameter_uncertainties"]
+
+import copy
+import logging
+import multiprocessing
+import numpy as np
+import time
+
+from .spectral_models import ProfileFittingModel, SpectralSynthesisModel
+from .utils import mkdtemp
+
+logger = logging.getLogger(__name__)
+
+# The state shared with the worker processes. This is set by the parent before
+# the pool is forked, so the session and photospheres are not pickled.
+_state = {}
+
+
+def _draw_photospheres(session, covariance, draws, parameters):
+    """
+    Draw stellar parameters from a multivariate normal distribution centered on
+    the current session stellar parameters, and interpolate a photosphere for
+    every draw.
+
+    :param session:
+        The session.
+
+    :param covariance:
+        The covariance matrix of the stellar parameters.
+
+    :param draws:
+        The number of draws to make.
+
+    :param parameters:
+        The names of the stellar parameters described by the covariance matrix.
+
+    :returns:
+        The drawn stellar parameters, and a list of photospheres (or `None` for
+        draws outside the photosphere grid).
+    """
+
+    current = session.metadata["stellar_parameters"]
+    covariance = np.atleast_2d(covariance)
+    if covariance.shape != (len(parameters), len(parameters)):
+        raise ValueError("covariance matrix must be of shape ({0}, {0})".format(
+            len(parameters)))
+
+    samples = np.random.multivariate_normal(
+        [current[p] for p in parameters], covariance, size=draws)
+
+    # Ensure the session photosphere interpolator exists.
+    session.stellar_photosphere
+    interpolator = session._photosphere_interpolator
+
+    photospheres = []
+    for sample in samples:
+        stellar_parameters = current.copy()
+        stellar_parameters.update(dict(zip(parameters, sample)))
+        try:
+            photosphere = interpolator(*[stellar_parameters[k] for k in \
+                ("effective_temperature", "surface_gravity", "metallicity",
+                    "alpha")])
+        except Exception:
+            logger.exception("Could not interpolate photosphere for {}".format(
+                stellar_parameters))
+            photosphere = None
+
+        else:
+            photosphere.meta["stellar_parameters"].update(stellar_parameters)
+
+        photospheres.append(photosphere)
+
+    return (samples, photospheres)
+
+
+def _initialize_worker():
+    """ Give each worker process its own working directory for MOOG. """
+    _state["twd"] = mkdtemp()
+    return None
+
+
+def _measure_abundances(index):
+    """
+    Measure the abundances of all spectral models given one draw of the stellar
+    parameters. This is executed by the worker processes.
+
+    :param index:
+        The index of the stellar parameter draw.
+
+    :returns:
+        A two-length tuple containing the index and a list with the abundances
+        for each spectral model (or `None` if the draw could not be measured).
+    """
+
+    session, photosphere = _state["session"], _state["photospheres"][index]
+    models, transitions = _state["spectral_models"], _state["transitions"]
+    twd = _state.get("twd", session.twd)
+
+    abundances = [None] * len(models)
+    if photosphere is None:
+        return (index, abundances)
+
+    # Profile models can all be measured together from the curve-of-growth.
+    if transitions is not None:
+        try:
+            profile_abundances = session.rt.abundance_cog(photosphere,
+                transitions, twd=twd)
+        except Exception:
+            logger.exception("Exception in measuring abundances for draw {}"\
+                .format(index))
+        else:
+            for i, abundance in zip(_state["profile_indices"],
+                profile_abundances):
+                abundances[i] = [abundance]
+
+    # Synthesis models need to be re-fit at these stellar parameters.
+    if _state["synthesis_indices"]:
+        original_stellar_parameters = session.metadata["stellar_parameters"]
+        original_twd = session.twd
+        session.metadata["stellar_parameters"] \
+            = photosphere.meta["stellar_parameters"]
+        session.twd = twd
+        try:
+            for i in _state["synthesis_indices"]:
+                model = models[i]
+                original_metadata = copy.deepcopy(model.metadata)
+                try:
+                    named_p_opt, cov, meta = model.fit()
+                    abundances[i] = list(meta["abundances"])
+                except Exception:
+                    logger.exception("Exception in fitting {} for draw {}"\
+                        .format(model, index))
+                finally:
+                    model.metadata = original_metadata
+                    session.update_spectral_model_results([model])
+
+        finally:
+            session.metadata["stellar_parameters"] = original_stellar_parameters
+            session.twd = original_twd
+
+    return (index, abundances)
+
+
+def propagate_stellar_parameter_uncertainties(session, covariance, draws=100,
+    parameters=("effective_temperature", "surface_gravity", "metallicity",
+        "microturbulence"), spectral_models=None, include_synthesis=True,
+    processes=None, save_uncertainties=True, callback=None):
+    """
+    Propagate the uncertainties in stellar parameters to the abundances of all
+    acceptable spectral models by Monte Carlo sampling.
+
+    Stellar parameters are drawn from a multivariate normal distribution that
+    is centered on the current session stellar parameters, and the abundances
+    of all spectral models are measured for every draw in parallel. Profile
+    models are measured from the curve-of-growth given their current
+    equivalent widths, and synthesis models are re-fit.
+
+    :param session:
+        The session with measured spectral models.
+
+    :param covariance:
+        The covariance matrix of the stellar parameters, in the order given by
+        `parameters`.
+
+    :param draws: [optional]
+        The number of stellar parameter draws to make.
+
+    :param parameters: [optional]
+        The names of the stellar parameters described by the covariance matrix.
+
+    :param spectral_models: [optional]
+        The spectral models to propagate uncertainties to. By default, all
+        acceptable spectral models that are not upper limits are used.
+
+    :param include_synthesis: [optional]
+        Re-fit synthesis models for every draw. This is much slower than
+        measuring profile models.
+
+    :param processes: [optional]
+        The number of worker processes to use. If `None` is given then one
+        process per CPU will be used. If 1 is given then the draws are measured
+        in this process.
+
+    :param save_uncertainties: [optional]
+        Save the systematic uncertainties in the session: per spectral model in
+        the `systematic_abundance_uncertainties` key of the fitting metadata,
+        and per species in the `systematic_abundance_uncertainties` key of the
+        session metadata.
+
+    :param callback: [optional]
+        A function that is called with the number of draws completed and the
+        total number of draws as each draw is finished.
+
+    :returns:
+        A dictionary containing the stellar parameter draws, the spectral
+        models, the abundances of each spectral model for every draw (as an
+        array of shape (draws, elements)), and the standard deviation of the
+        abundances for each spectral model and each species.
+    """
+
+    if spectral_models is None:
+        spectral_models = [model for model in session.metadata.get(
+            "spectral_models", []) \
+            if model.is_acceptable and not model.is_upper_limit]
+
+    # Only models that have been fit (and measured) can be propagated.
+    profile_indices, synthesis_indices, equivalent_widths, transition_indices \
+        = [], [], [], []
+    for i, model in enumerate(spectral_models):
+        try:
+            meta = model.metadata["fitted_result"][2]
+        except KeyError:
+            continue
+
+        if isinstance(model, ProfileFittingModel):
+            equivalent_width = 1e3 * meta["equivalent_width"][0]
+            if np.isfinite(equivalent_width) and equivalent_width > 0.01:
+                profile_indices.append(i)
+                equivalent_widths.append(equivalent_width)
+                transition_indices.append(model._transition_indices[0])
+
+        elif isinstance(model, SpectralSynthesisModel) and include_synthesis:
+            synthesis_indices.append(i)
+
+    transitions = None
+    if profile_indices:
+        transitions = session.metadata["line_list"][
+            np.array(transition_indices, dtype=int)].copy()
+        transitions["equivalent_width"] = equivalent_widths
+
+    start = time.time()
+    samples, photospheres = _draw_photospheres(
+        session, covariance, draws, parameters)
+    logger.debug("Time to interpolate {} photospheres: {:.1f}".format(
+        draws, time.time() - start))
+
+    _state.update({
+        "session": session,
+        "photospheres": photospheres,
+        "spectral_models": spectral_models,
+        "transitions": transitions,
+        "profile_indices": profile_indices,
+        "synthesis_indices": synthesis_indices
+    })
+    _state.pop("twd", None)
+
+    if processes == 1:
+        pool = None
+        results = (_measure_abundances(i) for i in range(draws))
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_initialize_worker)
+        results = pool.imap_unordered(_measure_abundances, range(draws))
+
+    abundances = [np.nan * np.ones((draws, len(model.elements))) \
+        for model in spectral_models]
+    try:
+        for N, (index, draw_abundances) in enumerate(results, start=1):
+            for i, abundance in enumerate(draw_abundances):
+                if abundance is not None:
+                    abundances[i][index] = abundance
+            if callback is not None:
+                callback(N, draws)
+
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+
+    else:
+        if pool is not None:
+            pool.close()
+
+    finally:
+        if pool is not None:
+            pool.join()
+        _state.clear()
+
+    logger.info("Time to propagate stellar parameter uncertainties with {} "
+        "draws to {} spectral models: {:.1f}".format(draws,
+            len(profile_indices) + len(synthesis_indices), time.time() - start))
+
+    model_uncertainties = [np.nanstd(a, axis=0) \
+        if np.any(np.isfinite(a)) else np.nan * np.ones(a.shape[1]) \
+        for a in abundances]
+
+    # Abundances of the same species are correlated between spectral models,
+    # so the species uncertainty is from the mean abundance of each draw.
+    species_abundances = {}
+    for model, model_abundances in zip(spectral_models, abundances):
+        for j, species in enumerate(model.species):
+            # Synthesis models can have multiple species per element.
+            for s in np.atleast_1d(species).flatten():
+                species_abundances.setdefault(float(s), []).append(
+                    model_abundances[:, j])
+
+    species_uncertainties = {}
+    for species, values in species_abundances.items():
+        values = np.array(values)
+        measured = np.any(np.isfinite(values), axis=0)
+        if np.any(measured):
+            species_uncertainties[species] = np.std(
+                np.nanmean(values[:, measured], axis=0))
+
+    if save_uncertainties:
+        for model, uncertainties in zip(spectral_models, model_uncertainties):
+            if "fitted_result" in model.metadata:
+                model.metadata["fitted_result"][2][
+                    "systematic_abundance_uncertainties"] = list(uncertainties)
+
+        session.metadata["systematic_abundance_uncertainties"] = {
+            "parameters": tuple(parameters),
+            "covariance": np.atleast_2d(covariance),
+            "draws": draws,
+            "species": species_uncertainties
+        }
+
+    return {
+        "stellar_parameters": samples,
+        "spectral_models": spectral_models,
+        "abundances": abundances,
+        "abundance_uncertainties": model_uncertainties,
+        "species_uncertainties": species_uncertainties
+    }
@@ -0,0 +1,40 @@
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import os
+import numpy as np
+import pytest
+
+import smh
+from smh.linelists import LineList
+from smh.spectral_models import ProfileFittingModel
+
+datadir = os.path.dirname(os.path.abspath(__file__))+'/test_data'
+
+@pytest.fixture
+def profile_session():
+    """
+    Return a function that creates a session of hd122563 with a profile model
+    for each of the first N lines of some species in the complete line list.
+    """
+
+    def make_session(species=(26.0, ), N=None, normalized=True, models=True):
+        session = smh.Session([datadir+"/spectra/hd122563.fits"])
+        if normalized:
+            session.normalized_spectrum = smh.specutils.Spectrum1D.read(
+                datadir+"/spectra/hd122563.fits")
+
+        # By default, all atomic lines
+        line_list = LineList.read(datadir+"/linelists/complete.list")
+        use = line_list["species"] < 100 if species is None \
+            else np.in1d(line_list["species"], species)
+        session.metadata["line_list"] = line_list[use][:N]
+        session.index_spectral_models()
+
+        if models:
+            session.metadata["spectral_models"] = [
+                ProfileFittingModel(session, [h]) \
+                for h in session.metadata["line_list"]["hash"]]
+        return session
+
+    return make_session
@@ -0,0 +1,104 @@
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from astropy.table import Table
+
+from smh import batch
+
+solved = []
+
+def _solve_star(args):
+    path, initial_guess, kwargs = args
+    solved.append(path)
+    name = os.path.basename(path)
+    row = dict(path=path, name=name, tolerance_achieved=True, error="",
+        effective_temperature=5000.0, microturbulence=1.5, surface_gravity=2.5,
+        metallicity=-1.0, num_transitions=10, time_elapsed=1.0)
+    if name in kwargs.get("fail", ()):
+        row.update(tolerance_achieved=False, error="ValueError: failed")
+    return row
+
+def _solve(paths, output_path, **kwargs):
+    del solved[:]
+    original, batch._solve_star = (batch._solve_star, _solve_star)
+    batch._photosphere_interpolator = lambda *args: None
+    try:
+        N = batch.solve_stellar_parameters(paths, output_path, processes=1,
+            **kwargs)
+    finally:
+        batch._solve_star = original
+        batch._photosphere_interpolator = None
+    assert N == len(solved)
+    return list(solved)
+
+def test_solve_stellar_parameters_resume():
+    twd = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(twd, name) for name in "ABCD"]
+        output_path = os.path.join(twd, "output.tsv")
+
+        assert _solve(paths[:3], output_path, fail=("B", )) == paths[:3]
+
+        # A crash while writing the last row leaves a partial row.
+        with open(output_path, "r") as fp:
+            content = fp.read()
+        with open(output_path, "w") as fp:
+            fp.write(content[:content.rfind(paths[2]) + 5])
+
+        assert _solve(paths, output_path) == paths[2:]
+        assert _solve(paths, output_path) == []
+        assert _solve(paths, output_path, retry_failed=True) == paths[1:2]
+
+        table = Table.read(output_path, format="ascii.tab")
+        assert list(table["path"]) == paths[:2] + paths[2:] + paths[1:2]
+        assert list(table["tolerance_achieved"]) == [1, 0, 1, 1, 1]
+
+        assert _solve(paths, output_path, resume=False) == paths
+        assert len(Table.read(output_path, format="ascii.tab")) == len(paths)
+    finally:
+        shutil.rmtree(twd)
+
+def test_fit_profiles(profile_session):
+    equivalent_widths = []
+    for processes in (1, 2):
+        session = profile_session(N=4)
+        models = session.metadata["spectral_models"]
+        results = session.spectral_model_results
+        assert not np.any(results["is_fitted"])
+
+        progress = []
+        N = session.fit_profiles(processes=processes,
+            callback=lambda model, N, total: progress.append((model, N, total)))
+        assert N == len(models)
+        assert [(N, total) for model, N, total in progress] \
+            == [(i + 1, len(models)) for i in range(len(models))]
+        assert set([id(model) for model, N, total in progress]) \
+            == set([id(model) for model in models])
+
+        # Results from the workers are merged back into the models and the
+        # session results.
+        assert np.all(results["is_fitted"])
+        ews = [1e3 * model.metadata["fitted_result"][2]["equivalent_width"][0] \
+            for model in models]
+        assert np.allclose(results["equivalent_width"], ews)
+        equivalent_widths.append(ews)
+
+    assert np.allclose(equivalent_widths[0], equivalent_widths[1])
+
+def test_fit_profiles_cancel(profile_session):
+    for processes in (1, 2):
+        session = profile_session(N=4)
+        models = session.metadata["spectral_models"]
+        progress = []
+        N = session.fit_profiles(processes=processes,
+            callback=lambda model, N, total: progress.append(model),
+            cancel=lambda: True)
+        assert N == 1
+        assert len(progress) == 1
+        assert [model for model in models \
+            if "fitted_result" in model.metadata] == progress
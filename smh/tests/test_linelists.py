@@ -2,6 +2,7 @@ from __future__ import (division, print_function, absolute_import,
                         unicode_literals)
 
 import os
+import shutil
 
 from smh import linelists, utils
 from smh.linelists import LineList
@@ -62,6 +63,171 @@ def test_duplicates():
     duplicate_indices,duplicate_lines = ll.find_duplicates(thresh=.01)
     assert_equals(2*N,len(duplicate_indices))
 
+def test_hashes():
+    for ll in lls:
+        hashes = [LineList.hash(line) for line in ll]
+        assert_equals(hashes, list(ll['hash']))
+        assert_equals(hashes, LineList.compute_hashes(ll))
+
+def test_read_moog_filter():
+    fname = datadir+'/linelists/masseron_linch.txt'
+    ll = LineList.read_moog(fname)
+    wmin, wmax = np.percentile(ll['wavelength'], [25, 75])
+    ion_species = np.floor(ll['species']*10+1e-8)/10
+    species = [ion_species[0]]
+    keep = (ll['wavelength'] >= wmin) & (ll['wavelength'] <= wmax) \
+         & (ion_species == species[0])
+    ll2 = LineList.read_moog(fname, wavelength_range=(wmin, wmax), species=species)
+    assert_equals(list(ll['hash'][keep]), list(ll2['hash']))
+
+    # Reading in chunks gives the same lines
+    keep *= (ll['loggf'] >= -2) & (ll['loggf'] <= 0)
+    ll3 = LineList.read_moog(fname, wavelength_range=(wmin, wmax), species=species,
+                             loggf_range=(-2, 0), chunk_size=100)
+    assert_equals(list(ll['hash'][keep]), list(ll3['hash']))
+
+def _write_ges_line_list(fname, N=500):
+    """
+    Write a synthetic GES line list (FITS) of atoms, ions and molecules,
+    some with isotopes, like scripts/benchmark_read_ges.py
+    """
+    # elem1, elem2, isotope1, isotope2, ion
+    transitions = [('Fe', '', 0, 0, 1), ('Fe', '', 0, 0, 2), ('Ba', '', 137, 0, 2),
+                   ('C', 'H', 0, 0, 1), ('H', 'C', 1, 13, 1), ('C', 'N', 12, 0, 1),
+                   ('Ti', 'O', 0, 0, 1)]
+    np.random.seed(0)
+    which = np.random.randint(0, len(transitions), size=N)
+    elem1, elem2, isotope1, isotope2, ion = zip(*[transitions[i] for i in which])
+    tab = table.Table()
+    tab["LAMBDA"] = np.random.uniform(4000, 5000, size=N)
+    tab["NAME"] = np.array([elem1, elem2], dtype="S2").T
+    tab["ISOTOPE"] = np.array([isotope1, isotope2], dtype=np.int16).T
+    tab["ION"] = np.array(ion, dtype=np.int16)
+    tab["E_LOW"] = np.random.uniform(0, 5, size=N)
+    tab["LOG_GF"] = np.random.uniform(-4, 1, size=N)
+    for column in ("VDW_DAMP", "E_UP", "LANDE_UP", "LANDE_LOW", "STARK_DAMP",
+        "RAD_DAMP"):
+        tab[column] = np.random.uniform(size=N)
+    tab["LOG_GF_REF"] = np.array(["synthetic"] * N)
+    tab.write(fname, format="fits", overwrite=True)
+
+def test_read_GES():
+    fname = '_test_ges.fits'
+    _write_ges_line_list(fname)
+    try:
+        ll = LineList.read_GES(fname)
+        tab = table.Table.read(fname)
+    finally:
+        os.remove(fname)
+    assert_equals(len(tab), len(ll))
+    ok_(np.any(ll['numelems'] == 2))
+    for row, line in zip(tab, ll):
+        elem1, elem2 = [name.strip() for name in row['NAME']]
+        isotope1, isotope2 = row['ISOTOPE']
+        species = utils.elems_isotopes_ion_to_species(
+            elem1, elem2, isotope1, isotope2, row['ION'])
+        assert_equals(species, line['species'])
+        assert_equals((elem1, elem2, isotope1, isotope2, row['ION']),
+            (line['elem1'], line['elem2'], line['isotope1'], line['isotope2'], line['ion']))
+        assert_equals(1 if elem2 == '' else 2, line['numelems'])
+
+def test_read_GES_filter():
+    fname = '_test_ges.fits'
+    _write_ges_line_list(fname)
+    try:
+        ll = LineList.read_GES(fname)
+        cuts = [dict(wavelength_range=(4200, 4700)),
+                dict(species=[26.0, 106.0]),
+                dict(wavelength_range=(4200, 4700), species=[26.1, 106.0], loggf_range=(-2, 0)),
+                dict(wavelength_range=(6000, 7000))]
+        for kwargs in cuts:
+            keep = ll.filter_lines(**kwargs)
+            for chunk_size in (7, 100000):
+                ll2 = LineList.read_GES(fname, chunk_size=chunk_size, **kwargs)
+                assert_equals(len(keep), len(ll2))
+                for col in ll2.colnames:
+                    a, b = np.asarray(keep[col]), np.asarray(ll2[col])
+                    # nan != nan
+                    ok_(np.all((a == b) | (a != a)), col)
+        # The last cut matches no lines
+        assert_equals(0, len(ll2))
+    finally:
+        os.remove(fname)
+
+def test_merge_in_place():
+    ll1 = LineList.read_moog(datadir+'/linelists/complete.list')
+    ll2 = LineList.read_moog(datadir+'/linelists/tiII.moog')
+    merged = ll1.merge(ll2, raise_exception=False, in_place=False)
+    ll1.merge(ll2, raise_exception=False)
+    assert_equals(list(merged['hash']), list(ll1['hash']))
+
+    N = len(ll1)
+    ll1.merge(ll2, ignore_conflicts=True)
+    assert_equals(N + len(ll2), len(ll1))
+
+def test_in_wavelength_range():
+    def check(ll, lower, upper):
+        expected = np.where((ll['wavelength'] >= lower) & (ll['wavelength'] <= upper))[0]
+        assert_equals(list(expected), list(ll.in_wavelength_range(lower, upper, return_indices=True)))
+
+    ll = LineList.read_moog(datadir+'/linelists/complete.list')
+    for lower, upper in [(4000, 4100), (5000, 5000.5), (0, 1e5), (1e5, 1e6)]:
+        check(ll, lower, upper)
+    lower, upper = ll['wavelength'][10], ll['wavelength'][20]
+    ll.sort('loggf')
+    assert_equals(list(ll[(ll['wavelength'] >= lower) & (ll['wavelength'] <= upper)]['hash']),
+                  list(ll.in_wavelength_range(lower, upper)['hash']))
+
+    # The index follows any change to the lines
+    w = ll['wavelength'][10]
+    check(ll, w - 0.01, w + 0.01)
+    new = ll[10:11].copy()
+    new['wavelength'] += 0.05
+    ll.merge(new, raise_exception=False, override_current=True)
+    check(ll, w + 0.01, w + 0.06)
+    ok_(10 in ll.in_wavelength_range(w + 0.01, w + 0.06, return_indices=True))
+
+    w = ll['wavelength'][5]
+    ll.reverse()
+    check(ll, w - 0.01, w + 0.01)
+
+    row = ll[0]
+    ll[5] = row
+    ll['wavelength'][6] = 1e4
+    ll.reset_wavelength_index()
+    for lower, upper in [(row['wavelength'], row['wavelength']), (9999, 10001), (4000, 4100)]:
+        check(ll, lower, upper)
+
+def test_read_cache():
+    fname = '_test_cache.moog'
+    shutil.copy(datadir+'/linelists/masseron_linch.txt', fname)
+    try:
+        ll = LineList.read(fname)
+        ok_(os.path.exists(LineList.cache_path(fname)))
+        ll2 = LineList.read_cache(fname)
+        for col in ll.colnames:
+            a, b = np.asarray(ll[col]), np.asarray(ll2[col])
+            # nan != nan
+            ok_(np.all((a == b) | (a != a)), col)
+        assert_equals(list(ll['hash']), list(LineList.read(fname)['hash']))
+
+        # A cached read matches a fresh parse, however the filename is spelled
+        for filename in (os.path.abspath(fname), fname, './'+fname):
+            ll2 = LineList.read(filename)
+            ll3 = LineList.read(filename, cache=False)
+            assert_equals(filename, ll2['references'][0])
+            for col in ll3.colnames:
+                a, b = np.asarray(ll3[col]), np.asarray(ll2[col])
+                ok_(np.all((a == b) | (a != a)), col)
+
+        # The cache is out of date once the file changes
+        with open(fname, 'a') as f:
+            f.write("\n")
+        ok_(LineList.read_cache(fname) is None)
+    finally:
+        os.remove(fname)
+        shutil.rmtree(LineList.cache_path(fname), True)
+
 def test_readwrite_moog(fname=datadir+'/linelists/masseron_linch.txt'):
     ll = LineList.read(fname)
     ll = LineList.read(fname,format='moog')
@@ -73,6 +239,7 @@ def test_readwrite_moog(fname=datadir+'/linelists/masseron_linch.txt'):
             diff = np.sum(np.abs(ll[i][col] - ll2[i][col]))
             assert np.isnan(diff) or diff < .001, "{} {}".format(ll[i][col],ll2[i][col])
     os.remove('_test.moog')
+    shutil.rmtree(LineList.cache_path('_test.moog'), True)
 def test_writeread(fname=datadir+'/linelists/masseron_linch.txt'):
     ll = LineList.read(fname)
     ll.write('line_list.fits',format='fits')
@@ -0,0 +1,196 @@
+import numpy as np
+import pickle
+
+import smh
+from scipy import ndimage
+from smh.spectral_models import ProfileFittingModel, SpectralModelResults
+from smh.spectral_models.nuisance import NuisanceKernel
+
+def test_refresh_stale_models(profile_session):
+    session = profile_session(N=3)
+    models = session.metadata["spectral_models"]
+    assert all([model.is_stale for model in models])
+
+    stale, remeasured = session.refresh_spectral_models(
+        processes=1, measure_abundances=False)
+    assert stale == models
+    assert not any([model.is_stale for model in models])
+
+    # Only inputs to the fit make a model stale.
+    models[0].is_acceptable = not models[0].is_acceptable
+    models[1].metadata["mask"] = [[models[1].wavelength - 0.05,
+                                   models[1].wavelength + 0.05]]
+    assert not models[0].is_stale
+    assert models[1].is_stale
+    stale, remeasured = session.refresh_spectral_models(
+        processes=1, measure_abundances=False)
+    assert stale == [models[1]]
+
+
+def test_spectral_model_results(profile_session):
+    session = profile_session((26.0, 26.1), N=6)
+    models = session.metadata["spectral_models"]
+    session.fit_profiles(processes=1)
+
+    results = session.spectral_model_results
+    assert len(results) == len(models)
+    for i, model in enumerate(models):
+        if "fitted_result" in model.metadata:
+            model.metadata["fitted_result"][2]["abundances"] = [7.0 + 0.1 * i]
+    session.update_spectral_model_results(models)
+    models[0].is_acceptable = False
+
+    summary = session.summarize_spectral_models()
+    for species in (26.0, 26.1):
+        abundances = [model.abundances[0] for model in models \
+            if model.is_acceptable and model.species[0] == species]
+        if not abundances: continue
+        assert summary[species][0] == len(abundances)
+        assert np.allclose(summary[species][1:4], [np.mean(abundances),
+            np.std(abundances), np.std(abundances)/np.sqrt(len(abundances))])
+
+    quality_constraints = {"abundance": [7.15, 10], "equivalent_width": [1, 1000],
+        "reduced_equivalent_width": [-10, -3]}
+    is_ok = results.meets_quality_constraints(quality_constraints)
+    assert list(is_ok) == [model.meets_quality_constraints(quality_constraints) \
+        for model in models]
+
+
+def test_restore_spectral_models(profile_session):
+    session = profile_session(None, N=5, normalized=False)
+    models = session.metadata["spectral_models"]
+    models[1].metadata["continuum_order"] = 2
+    models[1]._update_parameter_names()
+    restored = session._reconstruct_spectral_models(
+        [model.__getstate__() for model in models])
+
+    # Nothing is created until it is needed.
+    assert all([model._transitions is None for model in restored])
+    results = SpectralModelResults(restored)
+    assert list(results["wavelength"]) == [model.wavelength for model in models]
+    assert all([model._transitions is None for model in restored])
+
+    for model, restored_model in zip(models, restored):
+        assert restored_model.parameter_names == model.parameter_names
+        assert restored_model._repr_element == model._repr_element
+        assert restored_model._repr_wavelength == model._repr_wavelength
+        assert restored_model.transitions["hash"][0] \
+            == model.transitions["hash"][0]
+
+
+def test_reindex_spectral_models(profile_session):
+    session = profile_session(None, N=50, normalized=False, models=False)
+    hashes = session.metadata["line_list"]["hash"][[5, 20, 35]]
+    models = [ProfileFittingModel(session, [h]) for h in hashes]
+    wavelengths = [model.wavelength for model in models]
+    reprs = [model._repr_wavelength for model in models]
+    models[0].transitions
+    session.metadata["spectral_models"] = models
+    results = session.spectral_model_results
+
+    def check():
+        line_list = session.metadata["line_list"]
+        for model, h, wavelength, r in zip(models, hashes, wavelengths, reprs):
+            assert model.transitions["hash"][0] == h
+            assert line_list["hash"][model._transition_indices[0]] == h
+            assert model.wavelength == wavelength
+            assert model._repr_wavelength == r
+
+    # Sort the line list in place, without re-indexing the models.
+    session.metadata["line_list"].sort("loggf")
+    session.metadata["line_list"].reverse()
+    check()
+
+    # Remove lines (but not those of the models).
+    line_list = session.metadata["line_list"]
+    session.metadata["line_list"] = line_list[np.in1d(line_list["hash"],
+        list(hashes) + list(line_list["hash"][::3]))]
+    check()
+
+    # Re-indexing also updates the results.
+    session.index_spectral_models()
+    assert list(results["transition_index"]) \
+        == [model._transition_indices[0] for model in models]
+    check()
+
+
+def test_fitting_metadata_arrays(profile_session):
+    session = profile_session(N=1)
+    model = session.metadata["spectral_models"][0]
+    named_p_opt, cov, meta = model.fit()
+
+    # The arrays that show the fit are calculated when needed.
+    assert "model_x" not in meta
+    x, y, residual = (meta["model_x"], meta["model_y"], meta["residual"])
+    assert x.size == y.size == residual.size == meta["model_yerr"].size
+    assert np.sum(np.isfinite(residual)) == len(meta["data_indices"])
+
+    # But they are not saved.
+    restored = pickle.loads(pickle.dumps(model.metadata, 2))
+    assert "model_x" not in restored["fitted_result"][2]
+    model.metadata = restored
+    assert np.allclose(model.metadata["fitted_result"][2]["model_y"], y)
+
+    # If the inputs change after the fit, the arrays still show the fitted
+    # model over the window that was fit, but there are no residuals.
+    spectrum = session.normalized_spectrum
+    for change in ("normalization", "mask"):
+        session.normalized_spectrum = spectrum
+        model.metadata = pickle.loads(pickle.dumps(restored, 2))
+        assert not model.is_stale
+        if change == "normalization":
+            session.normalized_spectrum = smh.specutils.Spectrum1D(
+                spectrum.dispersion, 1.05 * spectrum.flux, spectrum.ivar)
+        else:
+            model.metadata["mask"] = [[x[0] - 1, np.mean(x)]]
+        assert model.is_stale
+
+        meta = model.metadata["fitted_result"][2]
+        assert np.all(meta["model_x"] == x)
+        assert np.allclose(meta["model_y"], y)
+        assert np.all(np.isnan(meta["residual"]))
+
+
+def test_nuisance_kernel():
+    def nuisance(model_dispersion, flux, dispersion, continuum, sigma, v,
+        left=None, right=None):
+        if continuum is not None:
+            flux = flux * np.polyval(continuum[::-1], model_dispersion)
+        if sigma > 0:
+            flux = ndimage.gaussian_filter1d(flux, sigma)
+        return np.interp(dispersion,
+            model_dispersion * (1 + v/NuisanceKernel._speed_of_light), flux,
+            left=left, right=right)
+
+    np.random.seed(0)
+    uniform = np.linspace(5000, 5010, 1001)
+    non_uniform = np.sort(np.random.uniform(5000, 5010, 1001))
+    flux = 1 - 0.5 * np.exp(-0.5 * ((uniform - 5005)/0.1)**2) \
+        + np.random.normal(0, 0.01, uniform.size)
+    for model_dispersion in (uniform, non_uniform):
+        # Edge pixels: points outside, on, and just inside the model grid.
+        dispersion = np.hstack([4999.5, model_dispersion[[0, 1, -2, -1]],
+            np.linspace(5004, 5006, 50), 5010.5])
+        for continuum_order, left, right in ((-1, None, None), (1, 1, 1)):
+            kernel = NuisanceKernel(model_dispersion, dispersion,
+                continuum_order, left=left, right=right)
+            continuum = None if continuum_order < 0 else np.array([1.2, -1e-4])
+            for sigma in (0, 0.1, 2.5, 10):
+                for v in (0, -20.0, 300.0):
+                    expected = nuisance(model_dispersion, flux, dispersion,
+                        continuum, sigma, v, left, right)
+                    assert np.allclose(kernel(flux, continuum, sigma, v),
+                        expected, rtol=0, atol=1e-10)
+
+            # Many spectra, smoothing widths and velocities at once.
+            sigma, v = (np.array([0, 2.5, 2.5]), np.array([-20.0, 0, 300.0]))
+            fluxes = np.array([flux, flux[::-1], flux**2])
+            continua = None if continuum is None \
+                else np.array([continuum, continuum, [1, 0]])
+            y = kernel(fluxes, continua, sigma, v)
+            assert y.shape == (3, dispersion.size)
+            for i in range(3):
+                expected = nuisance(model_dispersion, fluxes[i], dispersion,
+                    None if continua is None else continua[i], sigma[i], v[i],
+                    left, right)
+                assert np.allclose(y[i], expected, rtol=0, atol=1e-10)
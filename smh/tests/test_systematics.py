@@ -0,0 +1,74 @@
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+
+from smh import systematics
+
+class _Photosphere(object):
+    def __init__(self, teff, logg, feh, alpha):
+        self.meta = {"stellar_parameters": dict(effective_temperature=teff,
+            surface_gravity=logg, metallicity=feh, alpha=alpha)}
+
+class _RadiativeTransfer(object):
+    # The abundance of every line depends only on the stellar parameters.
+    @staticmethod
+    def abundance_cog(photosphere, transitions, twd=None):
+        sp = photosphere.meta["stellar_parameters"]
+        return np.ones(len(transitions)) * (sp["effective_temperature"]/1000. \
+            + sp["metallicity"] + sp["microturbulence"])
+
+class _Session(object):
+    rt = _RadiativeTransfer
+    stellar_photosphere = None
+    twd = None
+
+    def __init__(self, session):
+        self.metadata = session.metadata
+        self._photosphere_interpolator = _Photosphere
+
+    def update_spectral_model_results(self, spectral_models):
+        return None
+
+def _session(profile_session):
+    session = profile_session(N=4, normalized=False)
+    for model in session.metadata["spectral_models"]:
+        model.metadata.update(is_acceptable=True,
+            fitted_result=({}, None, {"equivalent_width": [0.05, 0, 0]}))
+    return _Session(session)
+
+def test_propagate_stellar_parameter_uncertainties(profile_session):
+    session = _session(profile_session)
+    models = session.metadata["spectral_models"]
+    draws, parameters = (20, ("effective_temperature", "metallicity"))
+
+    # No covariance, no spread.
+    for processes in (1, 2):
+        result = systematics.propagate_stellar_parameter_uncertainties(session,
+            np.zeros((2, 2)), draws=draws, parameters=parameters,
+            processes=processes)
+        assert result["stellar_parameters"].shape == (draws, len(parameters))
+        assert len(result["abundances"]) == len(models)
+        for model, abundances in zip(models, result["abundances"]):
+            assert abundances.shape == (draws, len(model.elements))
+            assert np.all(np.isfinite(abundances))
+        assert np.allclose(result["abundance_uncertainties"], 0)
+        assert np.allclose(list(result["species_uncertainties"].values()), 0)
+        assert list(result["species_uncertainties"].keys()) == [26.0]
+
+    # Uncertainties are saved with the models and the session.
+    assert np.allclose(models[0].metadata["fitted_result"][2][
+        "systematic_abundance_uncertainties"], 0)
+    assert session.metadata["systematic_abundance_uncertainties"]["draws"] \
+        == draws
+
+    # The spread follows the uncertainty in temperature (1 dex per 1000 K).
+    np.random.seed(0)
+    result = systematics.propagate_stellar_parameter_uncertainties(session,
+        np.diag([200.**2, 0]), draws=1000, parameters=parameters, processes=1,
+        save_uncertainties=False)
+    for uncertainty in result["abundance_uncertainties"]:
+        assert np.allclose(uncertainty, 0.2, rtol=0.1)
+    # All lines move together, so the species spread is not reduced.
+    assert np.allclose(result["species_uncertainties"][26.0], 0.2, rtol=0.1)
+    assert np.allclose(result["abundances"][0], result["abundances"][-1])
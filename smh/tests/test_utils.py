@@ -0,0 +1,54 @@
+from smh import utils
+import numpy as np
+from astropy.table import Table
+
+def test_equilibrium_state():
+    np.random.seed(42)
+    N = 100
+    transitions = Table(dict(
+        species=np.random.choice([26.0, 26.1, 22.1], N),
+        expot=np.random.uniform(0, 5, N),
+        rew=np.random.uniform(-6, -4, N),
+        abundance=np.random.normal(7, 0.2, N),
+        e_abundance=np.random.uniform(0.05, 0.2, N)))
+    transitions["abundance"][0] = np.nan
+    # A species with a single line cannot have a trend.
+    transitions.add_row(dict(species=12.0, expot=1.0, rew=-5.0,
+        abundance=6.0, e_abundance=0.1))
+
+    state = utils.equilibrium_state(transitions, yerr_column="e_abundance",
+        full_output=True)
+    assert 12.0 not in state
+
+    for species in np.unique(transitions["species"]):
+        if species == 12.0: continue
+        in_group = (transitions["species"] == species) \
+            * np.isfinite(transitions["abundance"])
+        y = transitions["abundance"][in_group]
+        yerr = transitions["e_abundance"][in_group]
+        for column in ("expot", "rew"):
+            x = transitions[column][in_group]
+            w = 1.0/yerr**2
+            x_mean = np.sum(w * x)/np.sum(w)
+            m, b, median, std, n, m_err, b_err = state[species][column]
+            assert np.allclose([m, b], np.polyfit(x, y, 1, w=1.0/yerr))
+            assert np.allclose(m_err, np.sum(w * (x - x_mean)**2)**-0.5)
+            assert np.allclose([median, std, n], [np.median(y), np.std(y), len(y)])
+
+    state = utils.equilibrium_state(transitions, bootstrap=100,
+        full_output=True)
+    assert np.all(np.isfinite(state[26.0]["expot"]))
+
+
+def test_species_arrays():
+    species = np.array([26.0, 26.1, 106.00112, 26.0, 56.1152, 607.0])
+    assert list(utils.species_to_element_array(species)) \
+        == [utils.species_to_element(s) for s in species]
+    assert [tuple(x) for x in zip(*utils.species_to_elems_isotopes_ion_array(
+        species))] == [utils.species_to_elems_isotopes_ion(s) for s in species]
+
+    elements = np.array(["Fe I", "Fe II", "C-H", "Ti II", "Fe I"])
+    assert list(utils.element_to_species_array(elements)) \
+        == [utils.element_to_species(e) for e in elements]
+    assert utils.element_to_atomic_number("Fe II") == 26
+    assert utils.species_to_element_array([]).size == 0
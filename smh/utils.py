@@ -12,8 +12,10 @@ import string
 import sys
 import traceback
 import tempfile
+import warnings
 
 from collections import Counter
+from functools import wraps
 
 from commands import getstatusoutput
 from hashlib import sha1 as sha
@@ -67,7 +69,8 @@ __all__ = ["element_to_species", "element_to_atomic_number", "species_to_element
     "elems_isotopes_ion_to_species", "species_to_elems_isotopes_ion", \
     "find_common_start", "extend_limits", "get_version", \
     "approximate_stellar_jacobian", "approximate_sun_hermes_jacobian",\
-    "hashed_id"]
+    "hashed_id", "element_to_species_array", "species_to_element_array", \
+    "species_to_elems_isotopes_ion_array"]
 
 logger = logging.getLogger(__name__)
 
@@ -91,8 +94,61 @@ def random_string(N=10):
     return ''.join(choice(string.ascii_uppercase + string.digits) for _ in range(N))
 
 
+def _grouped_linear_fits(keys, x, y, weights, K):
+    """
+    Perform weighted straight-line fits (y = m * x + b) to many groups of data
+    at once using grouped sums.
+
+    :param keys:
+        An integer array giving the group (0 <= key < K) of each data point.
+
+    :param x:
+        The x-values of the data points.
+
+    :param y:
+        The y-values of the data points.
+
+    :param weights:
+        The weight (inverse variance) of each data point. Points with zero
+        weight do not contribute to the fits.
+
+    :param K:
+        The total number of groups.
+
+    :returns:
+        Arrays of length K containing the slope, intercept, and their
+        uncertainties. Groups where a line cannot be fit (e.g., fewer than two
+        points, or all at the same x) have non-finite values.
+    """
+
+    S = np.bincount(keys, weights=weights, minlength=K)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_mean = np.bincount(keys, weights=weights * x, minlength=K) / S
+        y_mean = np.bincount(keys, weights=weights * y, minlength=K) / S
+
+        # Centre the data on the weighted means for numerical stability.
+        dx = x - x_mean[keys]
+        dy = y - y_mean[keys]
+        Sxx = np.bincount(keys, weights=weights * dx * dx, minlength=K)
+        Sxy = np.bincount(keys, weights=weights * dx * dy, minlength=K)
+
+        # Treat x-ranges at the level of numerical noise as degenerate.
+        x_scale = np.bincount(keys, weights=weights * x * x, minlength=K)
+        degenerate = ~(Sxx > np.finfo(float).eps * x_scale)
+
+        m = Sxy / Sxx
+        b = y_mean - m * x_mean
+        m_err = np.sqrt(1.0 / Sxx)
+        b_err = np.sqrt(1.0 / S + x_mean**2 / Sxx)
+
+    for value in (m, b, m_err, b_err):
+        value[degenerate] = np.nan
+
+    return (m, b, m_err, b_err)
+
+
 def equilibrium_state(transitions, columns=("expot", "rew"), group_by="species",
-    ycolumn="abundance", yerr_column=None):
+    ycolumn="abundance", yerr_column=None, full_output=False, bootstrap=0):
     """
     Perform linear fits to the abundances provided in the transitions table
     with respect to x-columns.
@@ -101,60 +157,111 @@ def equilibrium_state(transitions, columns=("expot", "rew"), group_by="species",
         A table of atomic transitions with measured equivalent widths and
         abundances.
 
-    :param x: [optional]
+    :param columns: [optional]
         The names of the columns to make fits against.
 
     :param group_by: [optional]
         The name of the column in `transitions` to calculate states.
-    """
 
-    lines = {}
-    transitions = transitions.group_by(group_by)
-    for i, start_index in enumerate(transitions.groups.indices[:-1]):
-        end_index = transitions.groups.indices[i + 1]
+    :param ycolumn: [optional]
+        The name of the column to fit against the x-columns.
 
-        # Do excitation potential first.
-        group_lines = {}
-        for x_column in columns:
-            x = transitions[x_column][start_index:end_index]
-            y = transitions["abundance"][start_index:end_index]
-
-            if yerr_column is not None:
-                try:
-                    yerr = transitions[yerr_column][start_index:end_index]
-
-                except KeyError:
-                    logger.exception("Cannot find yerr column '{}':".format(
-                        yerr_column))
-                    
-                    yerr = np.ones(len(y))
-            
-            else:
-                yerr = np.ones(len(y))
+    :param yerr_column: [optional]
+        The name of the column with uncertainties in `ycolumn`, which are used
+        to weight the fits.
 
-            # Only use finite values.
-            finite = np.isfinite(x * y * yerr)
-            if not np.any(finite):
-                #group_lines[x_column] = (np.nan, np.nan, np.nan, np.nan, 0)
-                continue
+    :param full_output: [optional]
+        Also return the uncertainties in the slope and intercept of each fit.
 
-            x, y, yerr = x[finite], y[finite], yerr[finite]
+    :param bootstrap: [optional]
+        The number of bootstrap resamples (with replacement, within each group)
+        to use to estimate the uncertainty in the slope and intercept. If zero,
+        the uncertainties are from the covariance matrix of the fit.
+
+    :returns:
+        A dictionary with the unique values of `group_by` as keys. Each value
+        is a dictionary containing the x-column names as keys, and a tuple of
+        (slope, intercept, median, standard deviation, number of points) for
+        each fit. If `full_output` is True, the uncertainty in the slope and
+        intercept are appended to each tuple.
+    """
 
-            A = np.vstack((np.ones_like(x), x)).T
-            C = np.diag(yerr**2)
-            try:
-                cov = np.linalg.inv(np.dot(A.T, np.linalg.solve(C, A)))
-                b, m = np.dot(cov, np.dot(A.T, np.linalg.solve(C, y)))
+    identifiers, groups = np.unique(np.asarray(transitions[group_by]),
+        return_inverse=True)
+    G, C = len(identifiers), len(columns)
 
-            except np.linalg.LinAlgError:
-                #group_lines[x_column] \
-                #    = (np.nan, np.nan, np.median(y), np.std(y), len(x))
-                None
+    y = np.asarray(transitions[ycolumn], dtype=float)
+    yerr = None
+    if yerr_column is not None:
+        try:
+            yerr = np.asarray(transitions[yerr_column], dtype=float)
 
-            else:
-                group_lines[x_column] = (m, b, np.median(y), np.std(y), len(x))
+        except KeyError:
+            logger.exception("Cannot find yerr column '{}':".format(
+                yerr_column))
+    if yerr is None:
+        yerr = np.ones(len(y))
+
+    # Fit all x-columns for all groups at once: each (column, group) pair is
+    # one key, and only finite points are used in each fit.
+    x = np.hstack([np.asarray(transitions[c], dtype=float) for c in columns])
+    y, yerr = np.tile(y, C), np.tile(yerr, C)
+    keys = (np.repeat(np.arange(C), len(groups)) * G + np.tile(groups, C))
+
+    finite = np.isfinite(x * y * yerr)
+    x, y, yerr, keys = x[finite], y[finite], yerr[finite], keys[finite]
+    K = C * G
+
+    weights = 1.0/yerr**2
+    m, b, m_err, b_err = _grouped_linear_fits(keys, x, y, weights, K)
+
+    # Median and standard deviation of the y-values in each fit.
+    order = np.lexsort((y, keys))
+    sorted_y = y[order]
+    n = np.bincount(keys, minlength=K)
+    starts = np.hstack([0, np.cumsum(n)[:-1]])
+    valid = n > 0
+    median = np.nan * np.ones(K)
+    median[valid] = 0.5 * (sorted_y[(starts + (n - 1) // 2)[valid]] \
+                        +  sorted_y[(starts + n // 2)[valid]])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y_mean = np.bincount(keys, weights=y, minlength=K) / n
+        std = np.sqrt(
+            np.bincount(keys, weights=(y - y_mean[keys])**2, minlength=K) / n)
+
+    if bootstrap > 0 and len(y) > 0:
+        # Resample with replacement within each fit, for all fits at once.
+        sorted_keys, sorted_x = keys[order], x[order]
+        sorted_weights = weights[order]
+        draws = (starts[sorted_keys] + np.floor(np.random.uniform(
+            size=(bootstrap, len(y))) * n[sorted_keys]).astype(int))
+        draw_keys = (np.arange(bootstrap)[:, None] * K + sorted_keys).flatten()
+
+        bootstrap_m, bootstrap_b, _, __ = _grouped_linear_fits(draw_keys,
+            sorted_x[draws].flatten(), sorted_y[draws].flatten(),
+            sorted_weights[draws].flatten(), bootstrap * K)
+
+        with warnings.catch_warnings():
+            # All-NaN slices for fits that cannot be made.
+            warnings.simplefilter("ignore", RuntimeWarning)
+            m_err = np.nanstd(bootstrap_m.reshape(bootstrap, K), axis=0)
+            b_err = np.nanstd(bootstrap_b.reshape(bootstrap, K), axis=0)
+        m_err[~np.isfinite(m)] = np.nan
+        b_err[~np.isfinite(m)] = np.nan
+
+    lines = {}
+    for i, identifier in enumerate(identifiers):
+        group_lines = {}
+        for j, x_column in enumerate(columns):
+            k = j * G + i
+            if not np.isfinite(m[k]): continue
+
+            state = (m[k], b[k], median[k], std[k], n[k])
+            if full_output:
+                state += (m_err[k], b_err[k])
+            group_lines[x_column] = state
 
-        identifier = transitions[group_by][start_index]
         if group_lines:
             lines[identifier] = group_lines
 
@@ -237,6 +344,75 @@ periodic_table = periodic_table.replace(" Ba ", " Ba " + lanthanoids + " ") \
     .replace(" Ra ", " Ra " + actinoids + " ").split()
 del actinoids, lanthanoids
 
+# Atomic numbers by element, so they do not need a periodic_table.index() scan.
+_atomic_numbers = dict([(element, Z) for Z, element in enumerate(periodic_table, 1)])
+
+# Atomic masses (rounded), used as default isotopes for molecules. These are
+# taken from MOOG for Z=1 to 95.
+_atomic_masses = [int(round(x, 0)) for x in (
+    1.008,4.003,6.941,9.012,10.81,12.01,14.01,16.00,19.00,20.18,
+    22.99,24.31,26.98,28.08,30.97,32.06,35.45,39.95,39.10,40.08,
+    44.96,47.90,50.94,52.00,54.94,55.85,58.93,58.71,63.55,65.37,
+    69.72,72.59,74.92,78.96,79.90,83.80,85.47,87.62,88.91,91.22,
+    92.91,95.94,98.91,101.1,102.9,106.4,107.9,112.4,114.8,118.7,
+    121.8,127.6,126.9,131.3,132.9,137.3,138.9,140.1,140.9,144.2,
+    145.0,150.4,152.0,157.3,158.9,162.5,164.9,167.3,168.9,173.0,
+    175.0,178.5,181.0,183.9,186.2,190.2,192.2,195.1,197.0,200.6,
+    204.4,207.2,209.0,210.0,210.0,222.0,223.0,226.0,227.0,232.0,
+    231.0,238.0,237.0,244.0,243.0)]
+
+# The maximum number of results to keep for each memoized conversion.
+_maximum_cached_conversions = 10000
+
+
+def _memoize(function):
+    """
+    Keep the results of a conversion function that is called with hashable
+    arguments, so that repeated conversions (e.g., in loops over the lines of
+    a line list) are dictionary lookups. Exceptions are not kept.
+    """
+
+    cache = {}
+
+    @wraps(function)
+    def wrapper(*args):
+        try:
+            return cache[args]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable arguments.
+            return function(*args)
+
+        result = cache[args] = function(*args)
+        if len(cache) > _maximum_cached_conversions:
+            cache.clear()
+        return result
+
+    return wrapper
+
+
+def _convert_unique(function, values, dtype=None):
+    """
+    Apply a conversion function to each unique value of an array, and return
+    an array of the results for all values.
+
+    :param function:
+        The conversion function.
+
+    :param values:
+        An array of values to convert.
+
+    :param dtype: [optional]
+        The data type of the converted values.
+    """
+
+    values = np.asarray(values)
+    unique, inverse = np.unique(values, return_inverse=True)
+    converted = np.array([function(value) for value in unique.tolist()],
+        dtype=dtype)
+    return converted[inverse].reshape(values.shape)
+
 
 
 def hashed_id():
@@ -296,6 +472,7 @@ def approximate_sun_hermes_jacobian(stellar_parameters, *args):
     return full_jacobian.T
 
 
+@_memoize
 def element_to_species(element_repr):
     """ Converts a string representation of an element and its ionization state
     to a floating point """
@@ -308,7 +485,7 @@ def element_to_species(element_repr):
     else:
         element, ionization = element_repr, "I"
     
-    if element not in periodic_table:
+    if element not in _atomic_numbers:
         try:
             return common_molecule_name2species[element]
         except KeyError:
@@ -316,10 +493,11 @@ def element_to_species(element_repr):
             return float(element_repr)
     
     ionization = max([0, ionization.upper().count("I") - 1]) /10.
-    transition = periodic_table.index(element) + 1 + ionization
+    transition = _atomic_numbers[element] + ionization
     return transition
 
 
+@_memoize
 def element_to_atomic_number(element_repr):
     """
     Converts a string representation of an element and its ionization state
@@ -335,24 +513,20 @@ def element_to_atomic_number(element_repr):
     
     element = element_repr.title().strip().split()[0]
     try:
-        index = periodic_table.index(element)
+        return _atomic_numbers[element]
 
-    except IndexError:
-        raise ValueError("unrecognized element '{}'".format(element_repr))
-    except ValueError:
+    except KeyError:
         try:
             return common_molecule_name2Z[element]
         except KeyError:
             raise ValueError("unrecognized element '{}'".format(element_repr))
-        
-
-    return 1 + index
     
 
 
 
 
 
+@_memoize
 def species_to_element(species):
     """ Converts a floating point representation of a species to a string
     representation of the element and its ionization state """
@@ -382,6 +556,7 @@ def species_to_element(species):
     return "%s %s" % (element, "I" * ionization)
 
 
+@_memoize
 def elems_isotopes_ion_to_species(elem1,elem2,isotope1,isotope2,ion):
     Z1 = int(element_to_species(elem1.strip()))
     if isotope1==0: isotope1=''
@@ -394,18 +569,7 @@ def elems_isotopes_ion_to_species(elem1,elem2,isotope1,isotope2,ion):
         Z2 = int(element_to_species(elem2.strip()))
 
         # If one isotope is specified but the other isn't, use a default mass
-        # These masses are taken from MOOG for Z=1 to 95
-        amu = [1.008,4.003,6.941,9.012,10.81,12.01,14.01,16.00,19.00,20.18,
-               22.99,24.31,26.98,28.08,30.97,32.06,35.45,39.95,39.10,40.08,
-               44.96,47.90,50.94,52.00,54.94,55.85,58.93,58.71,63.55,65.37,
-               69.72,72.59,74.92,78.96,79.90,83.80,85.47,87.62,88.91,91.22,
-               92.91,95.94,98.91,101.1,102.9,106.4,107.9,112.4,114.8,118.7,
-               121.8,127.6,126.9,131.3,132.9,137.3,138.9,140.1,140.9,144.2,
-               145.0,150.4,152.0,157.3,158.9,162.5,164.9,167.3,168.9,173.0,
-               175.0,178.5,181.0,183.9,186.2,190.2,192.2,195.1,197.0,200.6,
-               204.4,207.2,209.0,210.0,210.0,222.0,223.0,226.0,227.0,232.0,
-               231.0,238.0,237.0,244.0,243.0]
-        amu = [int(round(x,0)) for x in amu]
+        amu = _atomic_masses
         if isotope1 == '':
             if isotope2 == 0:
                 isotope2 = ''
@@ -424,6 +588,7 @@ def elems_isotopes_ion_to_species(elem1,elem2,isotope1,isotope2,ion):
 
     return float(mystr)
 
+@_memoize
 def species_to_elems_isotopes_ion(species):
     element = species_to_element(species)
     if species >= 100:
@@ -473,6 +638,55 @@ def species_to_elems_isotopes_ion(species):
     return elem1,elem2,isotope1,isotope2,ion
 
 
+def element_to_species_array(elements):
+    """
+    Convert an array of string representations of elements (and their
+    ionization states) to species. Each unique element is converted once.
+
+    :param elements:
+        An array of element representations, e.g. 'Fe I' or 'C-H'.
+
+    :returns:
+        An array of species with the same shape as `elements`.
+    """
+    return _convert_unique(element_to_species, elements, dtype=float)
+
+
+def species_to_element_array(species):
+    """
+    Convert an array of species to string representations of the elements and
+    their ionization states. Each unique species is converted once.
+
+    :param species:
+        An array of species.
+
+    :returns:
+        An array of element representations with the same shape as `species`.
+    """
+    return _convert_unique(species_to_element, species, dtype=str)
+
+
+def species_to_elems_isotopes_ion_array(species):
+    """
+    Convert an array of species to the first element, second element, first
+    isotope, second isotope and ionization state of each, as in
+    `species_to_elems_isotopes_ion`. Each unique species is converted once.
+
+    :param species:
+        An array of species.
+
+    :returns:
+        A five-length tuple of arrays with the same shape as `species`.
+    """
+
+    species = np.asarray(species)
+    unique, inverse = np.unique(species, return_inverse=True)
+    converted = [species_to_elems_isotopes_ion(s) for s in unique.tolist()]
+    return tuple([np.array(column, dtype=dtype)[inverse].reshape(species.shape) \
+        for column, dtype in zip(zip(*converted) or [()] * 5,
+            (str, str, int, int, int))])
+
+
 def get_common_letters(strlist):
     return "".join([x[0] for x in zip(*strlist) \
         if reduce(lambda a,b:(a == b) and a or None,x)])